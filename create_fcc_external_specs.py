@@ -3,13 +3,31 @@
 # Parse an installation of the FCC Externals in CVMFS and generate
 # a configuration file to be added to the packages.yaml in the 
 # Spack configuration.
+#
+# Without --platform, every platform installed under the prefix is parsed,
+# in a pool of threads, and <version>-<platform>-fcc_externals.yaml is
+# written for each of them. The modification times of the directories of
+# each platform are kept in .<version>-fcc_externals.json next to the
+# files: platforms that did not change since the last run are skipped,
+# which makes running it after each CVMFS publication cheap.
 
 
 import argparse
-import yaml
+import yamlio
+import pathcheck
 import sys
-import glob 
 import os
+import json
+import time
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 compiler_labels={
     "gcc62":"gcc-6.2.0",
@@ -51,59 +69,175 @@ def get_externals_version(prefix):
         return version
     raise Exception("Version not detected in prefix: %s" % prefix)
 
-def generate_config_file(platform, prefix):
+def list_directory(path):
     """
-    Write a configuration file with the metadata of the packages installed in a given path.
-    Assumes the following hierarchy of directories:
-
-    <prefix>/<platform/><spack_platform>/<spack_compiler>/packages
-
-    For example:
-     
-        |------------- prefix ------------------------||--------platform--------||--spack platoform--||compiler|
-        /cvmfs/fcc.cern.ch/sw/releases/externals/94.3.0/x86_64-centos7-gcc62-opt/linux-centos7-x86_64/gcc-6.2.0/packages
+    Return the names of the entries of a directory that are directories themselves (following
+    symbolic links), in a single scandir() pass where available. Hidden entries are left out.
     """
+    if scandir is not None:
+        return [entry.name for entry in scandir(path) if not entry.name.startswith(".") and entry.is_dir()]
+    return [name for name in os.listdir(path) if not name.startswith(".") and os.path.isdir(os.path.join(path, name))]
 
+def locate_packages(prefix, platform):
+    """
+    Return the (spack platform, spack compiler) directories holding the packages of a platform,
+    found from the platform name, or as the only ones there, or None
+    """
+    platform_dir = os.path.join(prefix, platform)
+    try:
+        spack_platforms = [get_spack_platform(platform)]
+    except Exception:
+        spack_platforms = list_directory(platform_dir)
+    if len(spack_platforms) != 1:
+        return None
+    try:
+        spack_compilers = [get_compiler_spec(platform)]
+    except Exception:
+        spack_compilers = list_directory(os.path.join(platform_dir, spack_platforms[0]))
+    if len(spack_compilers) != 1:
+        return None
+    return spack_platforms[0], spack_compilers[0]
+
+def get_packages_dict(package_dir, spack_platform, spack_compiler):
+    """
+    Return the packages installed in a <spack_platform>/<spack_compiler> directory
+    """
     packages_dict = {"packages" : {}}
-
-    spack_compiler = get_compiler_spec(platform)
-    spack_platform = get_spack_platform(platform)
-    externals_version = get_externals_version(prefix)    
-
-    package_paths = glob.glob(os.path.join(prefix, platform, spack_platform, spack_compiler, "*"))
-    packages = [ Package(path.split("/")[-1], path) for path in package_paths ]
-
     spec_template = "{name}@{version}%{compiler} arch={platform}"
-    
-    for pkg in packages:
+
+    for name in list_directory(package_dir):
+        if name.count("-") < 2:
+            print("Ignoring %s, not a <name>-<version>-<hash> directory" % os.path.join(package_dir, name))
+            continue
+        pkg = Package(name, os.path.join(package_dir, name))
         spec_string = spec_template.format(name=pkg.name,
                                            version=pkg.version,
                                            compiler=spack_compiler.replace('-','@'),
                                            platform=spack_platform)
-    
+
         packages_dict['packages'][pkg.name] = {
             "buildable": False,
-       	    "version": [pkg.version],
+            "version": [pkg.version],
             "paths": {
                 spec_string : pkg.prefix_path
             }
         }
+    return packages_dict
 
+def write_config_file(packages_dict, filename):
     try:
-        # Example: 94.3.0-fcc_externals.yaml
-        filename = externals_version + "-fcc_externals.yaml"
         with open(filename, 'w') as f:
-           f.write(yaml.dump(packages_dict))
+           yamlio.dump(packages_dict, f)
            print("{} successfully written".format(filename))
+        return True
     except IOError as e:
-	print("Configuration file could not be written: (%s)." % e) 
+        print("Configuration file could not be written: (%s)." % e)
+        return False
+
+def generate_config_files(prefix, output_dir=".", jobs=4, force=False, check_paths=pathcheck.DEFAULT_MODE):
+    """
+    Write <version>-<platform>-fcc_externals.yaml for every platform installed in prefix whose
+    directories changed since the last run (all of them with force)
+    """
+    externals_version = get_externals_version(prefix)
+    state_file = os.path.join(output_dir, ".%s-fcc_externals.json" % externals_version)
+    state = {}
+    if not force and os.path.exists(state_file):
+        with open(state_file) as f:
+            state = json.load(f)
+    start = time.time()
+
+    def scan(platform):
+        """Return (platform, packages dict or None if unchanged, directory mtimes)"""
+        located = locate_packages(prefix, platform)
+        if located is None:
+            print("Ignoring %s, packages not found" % os.path.join(prefix, platform))
+            return platform, None, None
+        spack_platform, spack_compiler = located
+        dirs = [os.path.join(prefix, platform), os.path.join(prefix, platform, spack_platform),
+                os.path.join(prefix, platform, spack_platform, spack_compiler)]
+        try:
+            mtimes = [os.stat(d).st_mtime for d in dirs]
+        except OSError as e:
+            print("Ignoring %s: %s" % (platform, e))
+            return platform, None, None
+        filename = os.path.join(output_dir, "%s-%s-fcc_externals.yaml" % (externals_version, platform))
+        if state.get(platform) == mtimes and os.path.exists(filename):
+            return platform, None, mtimes
+        return platform, get_packages_dict(dirs[-1], spack_platform, spack_compiler), mtimes
+
+    platforms = sorted(list_directory(prefix))
+    pool = ThreadPool(max(1, min(jobs, len(platforms))))
+    try:
+        results = pool.map(scan, platforms)
+    finally:
+        pool.close()
+        pool.join()
+
+    new_state = {}
+    path_cache = pathcheck.PathCache()
+    written = 0
+    for platform, packages_dict, mtimes in results:
+        if mtimes is None:
+            continue
+        if packages_dict is not None:
+            pathcheck.print_check(pathcheck.check_packages(packages_dict, check_paths, path_cache), check_paths)
+            filename = os.path.join(output_dir, "%s-%s-fcc_externals.yaml" % (externals_version, platform))
+            if not write_config_file(packages_dict, filename):
+                continue
+            written += 1
+        new_state[platform] = mtimes
+
+    tmp = state_file + ".tmp"
+    with open(tmp, 'w') as f:
+        json.dump(new_state, f, indent=1, sort_keys=True)
+    os.rename(tmp, state_file)
+    print("%d platforms, %d written, %d unchanged in %.2fs" % (len(platforms), written, len(new_state) - written,
+                                                               time.time() - start))
+
+def generate_config_file(platform, prefix, check_paths=pathcheck.DEFAULT_MODE):
+    """
+    Write a configuration file with the metadata of the packages installed in a given path.
+    Assumes the following hierarchy of directories:
+
+    <prefix>/<platform/><spack_platform>/<spack_compiler>/packages
+
+    For example:
+     
+        |------------- prefix ------------------------||--------platform--------||--spack platoform--||compiler|
+        /cvmfs/fcc.cern.ch/sw/releases/externals/94.3.0/x86_64-centos7-gcc62-opt/linux-centos7-x86_64/gcc-6.2.0/packages
+    """
+
+    spack_compiler = get_compiler_spec(platform)
+    spack_platform = get_spack_platform(platform)
+    externals_version = get_externals_version(prefix)    
+
+    packages_dict = get_packages_dict(os.path.join(prefix, platform, spack_platform, spack_compiler),
+                                      spack_platform, spack_compiler)
+
+    pathcheck.print_check(pathcheck.check_packages(packages_dict, check_paths), check_paths)
+
+    # Example: 94.3.0-fcc_externals.yaml
+    write_config_file(packages_dict, externals_version + "-fcc_externals.yaml")
 
 if __name__ == '__main__':
     desc = 'Parse and generate configuration file for FCC Externals installed in CVMFS'
     parser = argparse.ArgumentParser(description=desc)
 
-    parser.add_argument('--platform', action="store", dest="platform")
+    parser.add_argument('--platform', action="store", dest="platform",
+                        help="Only this platform, written to <version>-fcc_externals.yaml; all of them by default")
     parser.add_argument('--prefix', action="store", dest="prefix")
+    parser.add_argument('--output-dir', action="store", dest="output_dir", default=".",
+                        help="Where the files of all the platforms are written")
+    parser.add_argument('-j', '--jobs', action="store", dest="jobs", type=int, default=4,
+                        help="Number of platforms parsed in parallel")
+    parser.add_argument('--force', action="store_true", dest="force",
+                        help="Write the files of all the platforms, even unchanged ones")
+    parser.add_argument('--check-paths', action="store", dest="check_paths", choices=pathcheck.CHECK_MODES, default=pathcheck.DEFAULT_MODE,
+                        help="Check that package prefixes exist, warn about or drop the missing ones")
 
     args = parser.parse_args()
-    generate_config_file(args.platform, args.prefix)
+    if args.platform:
+        generate_config_file(args.platform, args.prefix, args.check_paths)
+    else:
+        generate_config_files(args.prefix, args.output_dir, args.jobs, args.force, args.check_paths)
@@ -1,8 +1,14 @@
 import os
-import yaml
+import yamlio
+import pathcheck
 import argparse
 import re
 import glob
+import errno
+import hashlib
+import cPickle
+import tempfile
+import multiprocessing
 
 
 OS_SHORT_TO_LONG = {"slc6":"scientificcernslc6", "centos7":"centos7", "ubuntu1604":"ubuntu1604"}
@@ -13,6 +19,8 @@ lcg_pkgs_variants = {
 	"doxygen" : "+graphviz",
 }
 
+SPEC_TEMPLATE = "{pkg}@{pkg_version}%{compiler}{type} {variants} arch={arch}-{os_str}"
+
 def convert_lcg_spec_file(lcg_spec, basepath, pck_dict, verbosity, limited=None):
     ''' converts lcg spec files into dict format that is expected by spack for package specs.
     each package specification looks something like this:
@@ -23,84 +31,141 @@ def convert_lcg_spec_file(lcg_spec, basepath, pck_dict, verbosity, limited=None)
             cmake@3.4.1%gcc@4.8.3 arch=x86_64-slc6: /afs/cern.ch/sw/lcg/releases/LCG_83/CMake/x86_64-slc6-gcc48-opt
           buildable: False
     '''
-    fname = lcg_spec["fname"]
-    spec_template = "{pkg}@{pkg_version}%{compiler}{type} {variants} arch={arch}-{os_str}"
-    spec_qualifiers = {}
-    if verbosity > 1:
-        print "-- parsing:", lcg_spec["type"], "built for", lcg_spec["arch"], \
-              lcg_spec["os"], "with", lcg_spec["compiler"], "as", lcg_spec["build_type"]
+    selected, messages = parse_lcg_spec_file(lcg_spec, basepath, verbosity, limited)
+    for message in messages:
+        print message
+    merge_lcg_packages(pck_dict, selected)
+
+
+def spack_package_name(pkg):
+    ''' returns the spack name of an LCG package '''
+    pkg_lower = pkg.lower()
+
+    if (pkg_lower.startswith("py") or pkg_lower in ["qmtest"]) and pkg_lower not in ["pythia8", "pythia6", "python"]:
+        pkg_lower = "py-" + pkg_lower
+    #if pkg_lower == "pythia8":
+    #    pkg_lower = "pythia"
+    return pkg_lower
+
+
+def spack_package_version(pkg_lower, version):
+    ''' returns the spack version of an LCG package version '''
+    # Convert Root version: remove 'v' and replaces dashes by dots
+    if 'root' in pkg_lower:
+        version = version.replace("v","").replace("-", ".", 2)
+    return version
+
+
+def spack_spec_string(pkg_lower, version, compiler, lcg_spec):
+    ''' returns the spec of a package built with compiler (as in the COMPILER line, name@version)
+    for the platform described by lcg_spec '''
     type_spec = ""
     if lcg_spec["build_type"] == "dbg":
         type_spec = "+debug"
-
-    if verbosity > 0:
-        print "-- (", fname, ")"
-    lcg_packages = {}
+    return SPEC_TEMPLATE.format(pkg=pkg_lower,
+                                pkg_version=version,
+                                variants=lcg_pkgs_variants.get(pkg_lower, ""),
+                                compiler=compiler,
+                                type=type_spec,
+                                arch=lcg_spec["arch"],
+                                os_str=OS_SHORT_TO_LONG[lcg_spec["os"]])
+
+
+def read_lcg_spec_file(fname):
+    ''' reads an lcg spec file, returns its qualifiers ("NAME: value" lines, with the COMPILER as
+    name@version), its package lines as (line number, name, sha, version, path) and warnings
+    about the lines that were skipped.
+    '''
+    qualifiers = {}
+    rows = []
+    messages = []
     with open(fname, 'r') as fobj:
         for i, l in enumerate(fobj):
             if ":" in l:
-                try:
-                    attr, value = l.split(":")
-                except:
-                    print "Error in file: {0}\nLine: {1}".format(fname,l)
-                if attr == "COMPILER":
-                    cmp, ver = value.split(";")
+                attr, value = l.split(":", 1)
+                if attr == "COMPILER" and ";" in value:
+                    cmp, ver = value.split(";", 1)
                     value = "%s@%s" % (cmp.strip(), ver.strip())
-                spec_qualifiers[attr] = value.strip()
+                if attr == "COMPILER" and qualifiers.get(attr, value.strip()) != value.strip():
+                    messages.append("warning: several COMPILER lines in %s, using %s for all packages"
+                                    % (fname, value.strip()))
+                qualifiers[attr] = value.strip()
                 continue
             spec = [p.strip() for p in l.split(";")]
-            pkg, sha, version, path = spec[0], spec[1], spec[2], spec[3]
-
-            pkg_lower = pkg.lower()
-
-            if (pkg_lower.startswith("py") or pkg_lower in ["qmtest"]) and pkg_lower not in ["pythia8", "pythia6", "python"]:
-                pkg_lower = "py-" + pkg_lower
-            #if pkg_lower == "pythia8":
-            #    pkg_lower = "pythia"
-
-            if pkg_lower in virtual_packages or pkg_lower in blacklist:
-               continue
-
-            # Convert Root version: remove 'v' and replaces dashes by dots
-            if 'root' in pkg_lower:
-                version = version.replace("v","").replace("-", ".", 2)
+            if len(spec) < 4:
+                if l.strip():
+                    messages.append("Error in file: {0}\nLine: {1} (skipped)".format(fname, l.rstrip()))
+                continue
+            rows.append((i, spec[0], spec[1], spec[2], spec[3]))
+    return qualifiers, rows, messages
 
-            spec_string = spec_template.format(pkg=pkg_lower,
-                                               pkg_version=version,
-                                               variants=lcg_pkgs_variants.get(pkg_lower, ""),
-                                               compiler=spec_qualifiers["COMPILER"],
-                                               type=type_spec,
-                                               arch=lcg_spec["arch"],
-                                               os_str=OS_SHORT_TO_LONG[lcg_spec["os"]])
 
-            pkg_path = os.path.abspath(os.path.join(basepath, path))
+def select_highest_versions(packages, excluded=None):
+    ''' takes the (spack name, spack version, path) of the package lines of an lcg spec file, in order,
+    and returns the (spack name, version, path) of the highest version of each package, the last line
+    winning for a same version. virtual and blacklisted packages are left out.
+    '''
+    if excluded is None:
+        excluded = blacklist
+    versions = {}
+    for pkg_lower, version, pkg_path in packages:
+        if pkg_lower in virtual_packages or pkg_lower in excluded:
+            continue
+        # accumulate all versions of a package in the dict
+        versions.setdefault(pkg_lower, {})[version] = pkg_path
+    highest = []
+    for pkg_lower, paths in versions.items():
+        version = max(paths)
+        highest.append((pkg_lower, version, paths[version]))
+    return highest
+
+
+def parse_lcg_spec_file(lcg_spec, basepath, verbosity, limited=None, excluded=None):
+    ''' parses one lcg spec file without touching any shared state, so that files can be parsed in parallel.
+    returns the (pkg, spec, path) of the highest version of each package, and the messages to print.
+    '''
+    messages = []
+    fname = lcg_spec["fname"]
+    if verbosity > 1:
+        messages.append(" ".join(["-- parsing:", lcg_spec["type"], "built for", lcg_spec["arch"],
+                                  lcg_spec["os"], "with", lcg_spec["compiler"], "as", lcg_spec["build_type"]]))
 
-            # accumulate all versions of a package in the dict
-            if pkg_lower not in lcg_packages.keys(): # new package
-                lcg_packages[pkg_lower] = {version: (spec_string,  pkg_path)}
-            else: # new version of known package
-                lcg_packages[pkg_lower][version] = (spec_string,  pkg_path)
+    if verbosity > 0:
+        messages.append("-- ( %s )" % fname)
+    spec_qualifiers, rows, warnings = read_lcg_spec_file(fname)
+    messages.extend(warnings)
+    packages = []
+    for i, pkg, sha, version, path in rows:
+        pkg_lower = spack_package_name(pkg)
+        packages.append((pkg_lower, spack_package_version(pkg_lower, version),
+                         os.path.abspath(os.path.join(basepath, path))))
+    lcg_packages = select_highest_versions(packages, excluded)
 
     # Prune unwanted packages:
     if limited is not None:
-        unwanted_packages = [ pkg for pkg in lcg_packages.keys() if pkg not in limited]
-        for pkg in unwanted_packages:
-            if verbosity > 0:
-                print "-- Ignoring package: %s " % pkg
-            del lcg_packages[pkg]
-
-    for pkg in lcg_packages.keys():
-        # now select the highest version of each spec
-        highest_version = max(lcg_packages[pkg])
+        for pkg, version, pkg_path in lcg_packages:
+            if pkg not in limited and verbosity > 0:
+                messages.append("-- Ignoring package: %s " % pkg)
+        lcg_packages = [highest for highest in lcg_packages if highest[0] in limited]
+
+    selected = []
+    for pkg, highest_version, pkg_path in lcg_packages:
         if verbosity > 2:
-            print "---- selecting", highest_version, "for", pkg
+            messages.append("---- selecting %s for %s" % (highest_version, pkg))
+        spec_string = spack_spec_string(pkg, highest_version, spec_qualifiers["COMPILER"], lcg_spec)
+        selected.append((pkg, spec_string, pkg_path))
+    return selected, messages
+
+
+def merge_lcg_packages(pck_dict, selected):
+    ''' adds the packages selected by parse_lcg_spec_file to pck_dict '''
+    for pkg, spec_string, pkg_path in selected:
         # since different OSes / compilers are in different LCG files, check:
         if not pkg in pck_dict['packages'].keys():
-            pck_dict['packages'][pkg] = {"paths": {lcg_packages[pkg][highest_version][0]:
-                                                   lcg_packages[pkg][highest_version][1]},
+            pck_dict['packages'][pkg] = {"paths": {spec_string: pkg_path},
                                                     "buildable": False}
         else:
-            pck_dict['packages'][pkg]["paths"][lcg_packages[pkg][highest_version][0]] = lcg_packages[pkg][highest_version][1]
+            pck_dict['packages'][pkg]["paths"][spec_string] = pkg_path
 
 
 def convert_lcg_contrib_file(lcg_spec, basepath, compiler_dict, verbosity):
@@ -116,15 +181,25 @@ def convert_lcg_contrib_file(lcg_spec, basepath, compiler_dict, verbosity):
           fc: /path/bin/gfortran
         spec: gcc@4.9.3:
     '''
+    compilers, messages = parse_lcg_contrib_file(lcg_spec, basepath, verbosity)
+    for message in messages:
+        print message
+    compiler_dict["compilers"].extend(compilers)
+
+
+def parse_lcg_contrib_file(lcg_spec, basepath, verbosity):
+    ''' parses one lcg contrib file, returns its compiler entries and the messages to print '''
+    messages = []
+    compilers = []
     fname = lcg_spec["fname"]
     if lcg_spec["build_type"] == "dbg":
-        print "-- ignoring debug contrib files (since they contain the same as opt)"
-        return
+        messages.append("-- ignoring debug contrib files (since they contain the same as opt)")
+        return compilers, messages
     if verbosity > 1:
-        print "-- parsing:", lcg_spec["type"], "built for", lcg_spec["arch"], \
-              lcg_spec["os"], "with", lcg_spec["compiler"], "as", lcg_spec["build_type"]
+        messages.append(" ".join(["-- parsing:", lcg_spec["type"], "built for", lcg_spec["arch"],
+                                  lcg_spec["os"], "with", lcg_spec["compiler"], "as", lcg_spec["build_type"]]))
     if verbosity > 0:
-        print "-- (", fname, ")"
+        messages.append("-- ( %s )" % fname)
 
     compiler_list = []
     with open(fname, 'r') as fobj:
@@ -138,7 +213,7 @@ def convert_lcg_contrib_file(lcg_spec, basepath, compiler_dict, verbosity):
             compiler_spec["paths"] = {}
             # FIXME this is for gcc, only!
             if compiler != "gcc":
-                print "[WARNING] automatic compiler list gen is only enabled for gcc at the moment!"
+                messages.append("[WARNING] automatic compiler list gen is only enabled for gcc at the moment!")
                 continue
             full_path = os.path.abspath(os.path.join(basepath, path))
             compiler_spec["paths"]["cxx"] = os.path.join(full_path, "bin/g++")
@@ -148,10 +223,118 @@ def convert_lcg_contrib_file(lcg_spec, basepath, compiler_dict, verbosity):
             compiler_spec["spec"] = compiler + "@" + version
             compiler_spec["environment"] = {"set": {"LD_LIBRARY_PATH": os.path.join(full_path, "lib64")}}
             if compiler_spec["spec"] in compiler_list:
-                print "warning: ", compiler_speck["spec"], "found twice, ignoring second"
+                messages.append("warning:  %s found twice, ignoring second" % compiler_spec["spec"])
                 continue
             compiler_list.append(compiler_spec["spec"])
-            compiler_dict["compilers"].append({"compiler": compiler_spec})
+            compilers.append({"compiler": compiler_spec})
+    return compilers, messages
+
+
+class SpecCache(object):
+    ''' keeps what parse_lcg_spec_file and parse_lcg_contrib_file return for each file, so that
+    converting the same (immutable) release files again does not parse them again.
+    entries are keyed on the path, size and mtime of the file, and on the settings the
+    result depends on (blacklist, limited packages, verbosity, ...): changing any of them misses.
+    the least recently used entries are removed when the cache grows over maxsize bytes.
+    '''
+
+    def __init__(self, directory, maxsize=64 << 20):
+        self.directory = directory
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def key(self, fname, settings):
+        st = os.stat(fname)
+        identity = (os.path.abspath(fname), st.st_size, repr(st.st_mtime), settings)
+        return hashlib.sha256(repr(identity)).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".pickle")
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'rb') as fobj:
+                result = cPickle.load(fobj)
+        except (IOError, EOFError, cPickle.UnpicklingError):
+            self.misses += 1
+            return None
+        # mark as recently used, unless another process evicted it meanwhile
+        try:
+            os.utime(self.path(key), None)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        self.hits += 1
+        return result
+
+    def put(self, key, result):
+        fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=self.directory)
+        with os.fdopen(fd, 'wb') as fobj:
+            cPickle.dump(result, fobj, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, self.path(key))
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".pickle"):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for mtime, size, name in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.maxsize:
+                break
+            try:
+                os.unlink(os.path.join(self.directory, name))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            total -= size
+
+
+def parse_files_cached(function, tasks, jobs, cache, settings):
+    ''' same as parse_files, taking what it can from cache; the file of each task is task[0]["fname"] '''
+    if cache is None:
+        return parse_files(function, tasks, jobs)
+    keys = [cache.key(task[0]["fname"], settings) for task in tasks]
+    results = [cache.get(key) for key in keys]
+    missing = [i for i, result in enumerate(results) if result is None]
+    parsed = parse_files(function, [tasks[i] for i in missing], jobs)
+    for i, result in zip(missing, parsed):
+        results[i] = result
+        cache.put(keys[i], result)
+    return results
+
+
+def _parse_spec_task(task):
+    return parse_lcg_spec_file(*task)
+
+
+def _parse_contrib_task(task):
+    return parse_lcg_contrib_file(*task)
+
+
+def parse_files(function, tasks, jobs):
+    ''' applies function to every task, in a pool of jobs processes if more than one;
+    results come back in the order of tasks, whatever order they complete in '''
+    if jobs <= 1 or len(tasks) <= 1:
+        return [function(task) for task in tasks]
+    pool = multiprocessing.Pool(min(jobs, len(tasks)))
+    try:
+        return pool.map(function, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
 
 
 def discover_lcg_spec_files(basepath):
@@ -190,6 +373,8 @@ def get_basepath(path):
 
 def get_version(filepath):
     """Read version from LCG spec file"""
+    if os.path.isdir(filepath):
+        filepath = os.path.join(filepath, "LCG_*.txt")
     fnames = glob.glob(filepath)
     r = re.compile(".*externals*")
     filepath = filter(r.match, fnames)[0]
@@ -205,16 +390,97 @@ def get_version(filepath):
 def update_blacklist(filename):
     """Blacklist all file defined in a YAML file"""
     with open(filename, 'r') as fobj:
-        data = yaml.load(fobj)
+        data = yamlio.load(fobj)
         blacklist.extend(data.keys())
 
 
+def get_platform(lcg_spec):
+    ''' returns the platform of a file found by discover_lcg_spec_files, e.g. x86_64-centos7-gcc8-opt '''
+    return "-".join([lcg_spec["arch"], lcg_spec["os"], lcg_spec["compiler"], lcg_spec["build_type"]])
+
+
+def parse_spec_files(spec_files, basepath, verbosity=0, limited=None, jobs=1, cache=None):
+    ''' parses spec_files in parallel, returns what parse_lcg_spec_file returns for each of them '''
+    tasks = [(spec, basepath, verbosity, limited, blacklist) for spec in spec_files]
+    settings = ("packages", basepath, verbosity, sorted(limited) if limited is not None else None,
+                sorted(set(blacklist)), sorted(virtual_packages), sorted(lcg_pkgs_variants.items()))
+    return parse_files_cached(_parse_spec_task, tasks, jobs, cache, settings)
+
+
+def parse_contrib_files(contrib_files, basepath, verbosity=0, jobs=1, cache=None):
+    ''' parses contrib_files in parallel, returns what parse_lcg_contrib_file returns for each of them '''
+    tasks = [(spec, basepath, verbosity) for spec in contrib_files]
+    settings = ("compilers", basepath, verbosity)
+    return parse_files_cached(_parse_contrib_task, tasks, jobs, cache, settings)
+
+
+def merge_packages_results(results):
+    ''' merges results of parse_spec_files into a packages dict, in order: later files win '''
+    packages_dict = {"packages": {}}
+    for selected, messages in results:
+        for message in messages:
+            print message
+        merge_lcg_packages(packages_dict, selected)
+    return packages_dict
+
+
+def merge_compilers_results(results):
+    ''' merges results of parse_contrib_files into a compilers dict '''
+    compilers_dict = {"compilers": []}
+    for compilers, messages in results:
+        for message in messages:
+            print message
+        compilers_dict["compilers"].extend(compilers)
+    return compilers_dict
+
+
+def create_packages_dict(spec_files, basepath, verbosity=0, limited=None, jobs=1, cache=None):
+    ''' parses spec_files (from discover_lcg_spec_files) and returns the packages dict '''
+    return merge_packages_results(parse_spec_files(spec_files, basepath, verbosity, limited, jobs, cache))
+
+
+def create_compilers_dict(contrib_files, basepath, verbosity=0, jobs=1, cache=None):
+    ''' parses contrib_files (from discover_lcg_spec_files) and returns the compilers dict '''
+    return merge_compilers_results(parse_contrib_files(contrib_files, basepath, verbosity, jobs, cache))
+
+
+def create_platform_dicts(spec_files, contrib_files, basepath, platforms, verbosity=0, limited=None, jobs=1, cache=None):
+    ''' parses the files of all the platforms at once, each of them once, and returns
+    {platform: (packages dict, compilers dict)}, the same dicts as create_packages_dict and
+    create_compilers_dict give for the files of each platform '''
+    spec_files = [spec for spec in spec_files if get_platform(spec) in platforms]
+    contrib_files = [spec for spec in contrib_files if get_platform(spec) in platforms]
+    spec_results = zip(spec_files, parse_spec_files(spec_files, basepath, verbosity, limited, jobs, cache))
+    contrib_results = zip(contrib_files, parse_contrib_files(contrib_files, basepath, verbosity, jobs, cache))
+    dicts = {}
+    for platform in platforms:
+        if verbosity > 0:
+            print "-- platform:", platform
+        packages_dict = merge_packages_results([result for spec, result in spec_results
+                                                if get_platform(spec) == platform])
+        compilers_dict = merge_compilers_results([result for spec, result in contrib_results
+                                                  if get_platform(spec) == platform])
+        dicts[platform] = (packages_dict, compilers_dict)
+    return dicts
+
+
+def write_dict(data, outname):
+    with open(outname, "w") as fobj:
+        print "creating", outname
+        yamlio.dump(data, fobj)
+
+
 def main():
     parser = argparse.ArgumentParser("LCG packages spec creator", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('release_path', type=str, help='LCG release path (searched for LCG_*.txt files)')
     parser.add_argument('--limited', type=str, dest='limited', nargs='*', help='List of packages to consider')
     parser.add_argument('--blacklist', type=str, dest='fpackages', default=None, help='Blacklist packages defined in a given YAML file')
     parser.add_argument('-v', dest='verbosity', action='count', default=0, help='verbosity, max = -vvv')
+    parser.add_argument('-j', '--jobs', type=int, dest='jobs', default=1, help='Number of files parsed in parallel (processes)')
+    parser.add_argument('--cache', type=str, dest='cache', default=None, help='Directory where parsed files are kept for later runs')
+    parser.add_argument('--cache-size', type=int, dest='cache_size', default=64, help='Maximum size of the cache in MB')
+    parser.add_argument('--check-paths', dest='check_paths', choices=pathcheck.CHECK_MODES, default=pathcheck.DEFAULT_MODE, help='Check that package prefixes exist, warn about or drop the missing ones')
+    parser.add_argument('--platforms', type=str, dest='platforms', nargs='+', default=None, help='Write the files of each of these platforms, <version>_<platform>_packages.yaml')
     args = parser.parse_args()
 
     filesystem = args.release_path.split(os.sep)[1]
@@ -232,21 +498,31 @@ def main():
     if blacklist:
         print "Blacklisted packages: %s " % ", ".join(blacklist)
 
-    packages_dict = {"packages": {}}
-    for spec in spec_files:
-        convert_lcg_spec_file(spec, basepath, packages_dict, args.verbosity, args.limited)
-    outname = version + "_packages.yaml"
-    with open(outname, "w") as fobj:
-        print "creating", outname
-        fobj.write(yaml.dump(packages_dict))
+    cache = None
+    if args.cache:
+        cache = SpecCache(args.cache, args.cache_size << 20)
+
+    if args.platforms:
+        dicts = create_platform_dicts(spec_files, contrib_files, basepath, args.platforms, args.verbosity,
+                                      args.limited, args.jobs, cache)
+        pathcheck_cache = pathcheck.PathCache()
+        for platform in args.platforms:
+            packages_dict, compilers_dict = dicts[platform]
+            result = pathcheck.check_packages(packages_dict, args.check_paths, pathcheck_cache)
+            pathcheck.print_check(result, args.check_paths)
+            write_dict(packages_dict, "%s_%s_packages.yaml" % (version, platform))
+            write_dict(compilers_dict, "%s_%s_compilers.yaml" % (version, platform))
+    else:
+        packages_dict = create_packages_dict(spec_files, basepath, args.verbosity, args.limited, args.jobs, cache)
+        pathcheck.print_check(pathcheck.check_packages(packages_dict, args.check_paths), args.check_paths)
+        write_dict(packages_dict, version + "_packages.yaml")
 
-    compilers_dict = {"compilers": []}
-    for spec in contrib_files:
-        convert_lcg_contrib_file(spec, basepath, compilers_dict, args.verbosity)
-    outname = version + "_compilers.yaml"
-    with open(outname, "w") as fobj:
-        print "creating", outname
-        fobj.write(yaml.dump(compilers_dict))
+        compilers_dict = create_compilers_dict(contrib_files, basepath, args.verbosity, args.jobs, cache)
+        write_dict(compilers_dict, version + "_compilers.yaml")
+
+    if cache is not None:
+        cache.evict()
+        print "parsed file cache: %d hits, %d misses" % (cache.hits, cache.misses)
 
 
 if __name__ == "__main__":
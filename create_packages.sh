@@ -20,36 +20,19 @@ fi
 echo "Using LCG externals from: $LCG_externals"
 echo "Modification date: `stat $LCG_externals | grep Modify | tr -s " " | cut -d" " -f2,3`"
 
-python $THIS/create_lcg_package_specs.py --blacklist $THIS/config/packages-${FCC_VERSION}.yaml "$LCG_externals"
-
-cp $THIS/config/packages-default.yaml $WORKSPACE/packages.yaml
-
-# apply some changes
-# Replace tbb name
-sed -i 's/tbb:/intel-tbb:/' $WORKSPACE/${LCG_VERSION}_packages.yaml
-sed -i 's/tbb@/intel-tbb@/' $WORKSPACE/${LCG_VERSION}_packages.yaml
-
-# Replace xerces-c name
-sed -i 's/xercesc:/xerces-c:/' $WORKSPACE/${LCG_VERSION}_packages.yaml
-sed -i 's/xercesc@/xerces-c@/' $WORKSPACE/${LCG_VERSION}_packages.yaml
-
-# Replace java name
-sed -i 's/java:/jdk:/' $WORKSPACE/${LCG_VERSION}_packages.yaml
-sed -i 's/java@/jdk@/' $WORKSPACE/${LCG_VERSION}_packages.yaml
-
-# append lcg specs to default packages.yaml
-cat $WORKSPACE/${LCG_VERSION}_packages.yaml | tail -n +2 >> $WORKSPACE/packages.yaml
-cat $THIS/config/packages-${FCC_VERSION}.yaml >> $WORKSPACE/packages.yaml
-
-# Custom packages
-
-# Gitpython python package
+# set LCG_SPEC_CACHE to keep the parsed LCG files in that directory between runs
+# missing package prefixes are reported (the default of the scripts too),
+# set CHECK_PATHS=drop to leave them out or CHECK_PATHS=no to skip the check
+python $THIS/create_packages_yaml.py --lcg-version $LCG_VERSION --fcc-version $FCC_VERSION --platform $PLATFORM \
+  --lcg-externals "$LCG_externals" --weekday $weekday ${LCG_SPEC_CACHE:+--cache "$LCG_SPEC_CACHE"} \
+  --check-paths ${CHECK_PATHS:-warn} -o $WORKSPACE/packages.yaml
+
+# Platform parts, also used by jk-setup-spack.sh which sources this script
 IFS=- read -ra PART <<< "$PLATFORM"
 OS="${PART[1]}"
 COMPILER="${PART[2]}"
 
-# Set up compiler
-python $THIS/get_compiler.py $LCG_externals
+# full version of the compiler, written by create_packages_yaml.py
 lcg_compiler=`cat lcg_compiler.txt`
 
 # Default values
@@ -68,9 +51,3 @@ if [ $COMPILER_TWO_DIGITS == "82" ]; then
 fi
 
 export compilerversion=${COMPILER}version
-
-cat << EOF >> $WORKSPACE/packages.yaml
-  py-gitpython:
-    buildable: false
-    paths: {py-gitpython@2.1.8-0%gcc@${!compilerversion} arch=x86_64-${OS}: /cvmfs/fcc.cern.ch/sw/0.8.3/gitpython/lib/python2.7/site-packages}
-EOF
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+# Create the packages.yaml of a platform in one pass: the default packages,
+# the LCG externals of the release (with some packages renamed to their name
+# in Spack), the FCC packages of config/packages-<FCC_VERSION>.yaml and a few
+# custom packages are merged in memory and written once.
+#
+# Later sources replace the packages of the earlier ones. Packages of the FCC
+# configuration are also left out of the LCG externals (blacklisted).
+#
+# Usage:
+#     create_packages_yaml.py --lcg-version LCG_96b --fcc-version 96b.0.0 --platform x86_64-centos7-gcc8-opt
+#
+# Also writes the full version of the LCG compiler in lcg_compiler.txt, like
+# get_compiler.py.
+#
+# With several platforms, the LCG files of all of them are parsed at once and
+# the files of each platform are written in its own directory:
+#     create_packages_yaml.py --lcg-version LCG_96b --fcc-version 96b.0.0 \
+#         --platform x86_64-centos7-gcc8-opt x86_64-centos7-gcc8-dbg x86_64-slc6-gcc8-opt
+#     -> $WORKSPACE/<platform>/packages.yaml and $WORKSPACE/<platform>/lcg_compiler.txt
+
+import os
+import copy
+import time
+import argparse
+
+import yamlio
+import pathcheck
+import create_lcg_package_specs as lcg
+from get_compiler import get_compiler
+
+THIS = os.path.dirname(os.path.abspath(__file__))
+
+# LCG name -> Spack name
+RENAMES = {
+    "tbb": "intel-tbb",
+    "xercesc": "xerces-c",
+    "java": "jdk",
+}
+
+# default version of each compiler of the platforms
+GCC_VERSIONS = {
+    "gcc49": "4.9.3",
+    "gcc62": "6.2.0",
+    "gcc73": "7.3.0",
+    "gcc8": "8.3.0",
+}
+
+# packages not in LCG, {compiler} and {os} are replaced
+CUSTOM_PACKAGES = {
+    "py-gitpython": {
+        "buildable": False,
+        "paths": {"py-gitpython@2.1.8-0%gcc@{compiler} arch=x86_64-{os}":
+                  "/cvmfs/fcc.cern.ch/sw/0.8.3/gitpython/lib/python2.7/site-packages"},
+    },
+}
+
+
+def get_lcg_externals(lcg_version, platform, weekday):
+    """Return the pattern of the LCG files of a release or of a nightly"""
+    if lcg_version.startswith("LCG_"):
+        return "/cvmfs/sft.cern.ch/lcg/releases/%s/LCG_*_%s.txt" % (lcg_version, platform)
+    return "/cvmfs/sft.cern.ch/lcg/nightlies/%s/%s/LCG_*_%s.txt" % (lcg_version, weekday, platform)
+
+
+def rename_packages(packages, renames=RENAMES):
+    """Rename the packages and their specs following renames"""
+    for old, new in renames.items():
+        if old not in packages:
+            continue
+        entry = packages.pop(old)
+        entry["paths"] = dict((new + spec[len(old):] if spec.startswith(old + "@") else spec, path)
+                              for spec, path in entry["paths"].items())
+        packages[new] = entry
+    return packages
+
+
+def get_compiler_version(platform, lcg_compiler):
+    compiler = platform.split("-")[2]
+    # gcc8 is an abstraction of the full version (8.2.0, 8.3.0, ...)
+    if compiler == "gcc8" and lcg_compiler.startswith("8.2"):
+        return "8.2.0"
+    return GCC_VERSIONS.get(compiler, lcg_compiler)
+
+
+def custom_packages(platform, compiler_version):
+    os_name = platform.split("-")[1]
+    packages = {}
+    for name, entry in CUSTOM_PACKAGES.items():
+        entry = dict(entry)
+        entry["paths"] = dict((spec.format(compiler=compiler_version, os=os_name), path)
+                              for spec, path in entry["paths"].items())
+        packages[name] = entry
+    return packages
+
+
+def create_packages_yaml(lcg_externals, fcc_version, platforms, output, verbosity=0, jobs=1, cache=None,
+                         check_paths=pathcheck.DEFAULT_MODE):
+    """Write the packages.yaml of each platform, output is formatted with the platform"""
+    default = yamlio.load_file(os.path.join(THIS, "config", "packages-default.yaml"))
+    fcc_packages = yamlio.load_file(os.path.join(THIS, "config", "packages-%s.yaml" % fcc_version)) or {}
+    lcg.blacklist.extend(fcc_packages.keys())
+
+    spec_files, contrib_files = lcg.discover_lcg_spec_files(lcg_externals)
+    print("found %d LCG files" % len(spec_files))
+    dicts = lcg.create_platform_dicts(spec_files, [], lcg.get_basepath(lcg_externals), platforms, verbosity,
+                                      jobs=jobs, cache=cache)
+    path_cache = pathcheck.PathCache()
+
+    for platform in platforms:
+        externals = [spec["fname"] for spec in spec_files
+                     if spec["type"] == "externals" and lcg.get_platform(spec) == platform]
+        if not externals:
+            print("No LCG externals file for %s, skipped" % platform)
+            continue
+        outname = output.format(platform=platform)
+        if os.path.dirname(outname) and not os.path.isdir(os.path.dirname(outname)):
+            os.makedirs(os.path.dirname(outname))
+        compiler_file = "lcg_compiler.txt"
+        if len(platforms) > 1:
+            compiler_file = os.path.join(os.path.dirname(outname), compiler_file)
+        lcg_compiler = get_compiler(externals[0], compiler_file)
+
+        config = copy.deepcopy(default)
+        packages = config["packages"]
+        packages.update(rename_packages(dicts[platform][0]["packages"]))
+        packages.update(copy.deepcopy(fcc_packages))
+        packages.update(custom_packages(platform, get_compiler_version(platform, lcg_compiler)))
+        pathcheck.print_check(pathcheck.check_packages(config, check_paths, path_cache), check_paths)
+
+        with open(outname, "w") as f:
+            yamlio.dump(config, f)
+        print("%s written with %d packages" % (outname, len(packages)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create the packages.yaml of a platform")
+    parser.add_argument("--lcg-version", required=True, help="LCG release (LCG_96b) or nightly (dev3)")
+    parser.add_argument("--fcc-version", required=True, help="Uses config/packages-<FCC_VERSION>.yaml")
+    parser.add_argument("--platform", required=True, nargs="+", help="e.g. x86_64-centos7-gcc8-opt, or several")
+    parser.add_argument("--weekday", default=time.strftime("%a"), help="Day of the nightly")
+    parser.add_argument("--lcg-externals", default=None, help="Pattern of the LCG files, instead of the ones in CVMFS")
+    parser.add_argument("-o", "--output", default=None,
+                        help="Output file, {platform} is replaced (default: $WORKSPACE/packages.yaml, "
+                             "$WORKSPACE/{platform}/packages.yaml with several platforms)")
+    parser.add_argument("-v", dest="verbosity", action="count", default=0)
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of files parsed in parallel (processes)")
+    parser.add_argument("--cache", default=None, help="Directory where parsed LCG files are kept for later runs")
+    parser.add_argument("--check-paths", choices=pathcheck.CHECK_MODES, default=pathcheck.DEFAULT_MODE,
+                        help="Check that package prefixes exist, warn about or drop the missing ones")
+    args = parser.parse_args()
+
+    platform_pattern = args.platform[0] if len(args.platform) == 1 else "*"
+    lcg_externals = args.lcg_externals or get_lcg_externals(args.lcg_version, platform_pattern, args.weekday)
+    output = args.output
+    if output is None:
+        workspace = os.environ.get("WORKSPACE", ".")
+        output = os.path.join(workspace, "{platform}" if len(args.platform) > 1 else "", "packages.yaml")
+    if len(args.platform) > 1 and "{platform}" not in output:
+        parser.error("--output must contain {platform} with several platforms")
+    print("Using LCG externals from: %s" % lcg_externals)
+    cache = lcg.SpecCache(args.cache) if args.cache else None
+    create_packages_yaml(lcg_externals, args.fcc_version, args.platform, output, args.verbosity, args.jobs, cache,
+                         args.check_paths)
+    if cache is not None:
+        cache.evict()
@@ -2,16 +2,17 @@
 
 import sys
 
-def get_compiler(filename):
+def get_compiler(filename, output='lcg_compiler.txt'):
     with open(filename) as fname:
         compiler_line = fname.readlines()[2]
         compiler = compiler_line.split()[-1]
         name, version = compiler.split(';')
 	print("Compiler: %s@%s" % (name, version))
         
-    with open('lcg_compiler.txt', 'w') as f:
+    with open(output, 'w') as f:
         f.write(version)
-        print("Compiler version saved in: lcg_compiler.txt")
+        print("Compiler version saved in: %s" % output)
+    return version
 
 if __name__ == "__main__":
     for arg in sys.argv:
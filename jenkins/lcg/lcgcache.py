@@ -0,0 +1,168 @@
+"""On-disk tarball and metadata caches shared between runs of lcginstall.py."""
+
+import os
+import json
+import stat
+import time
+import fcntl
+import errno
+import hashlib
+import tempfile
+
+
+def _remove(path):
+  try:
+    os.unlink(path)
+  except OSError as e:
+    if e.errno != errno.ENOENT:
+      raise
+
+
+class TarballCache(object):
+  # temporary files older than this are left over by crashed installers
+  STALE = 24 * 3600
+
+  def __init__(self, directory, maxsize=None):
+    self.directory = os.path.abspath(directory)
+    self.maxsize = maxsize
+    if not os.path.isdir(self.directory):
+      try:
+        os.makedirs(self.directory)
+      except OSError as e:
+        if e.errno != errno.EEXIST:
+          raise
+
+  def path(self, key):
+    return os.path.join(self.directory, key)
+
+  def lookup(self, key):
+    """Return the path of the cached file for key, or None"""
+    path = self.path(key)
+    try:
+      # mtime records the last use, for the LRU eviction
+      os.utime(path, None)
+    except OSError:
+      return None
+    return path
+
+  def contains(self, key):
+    return os.path.exists(self.path(key))
+
+  def checksum(self, key):
+    """Return the SHA-256 recorded when key was stored, or None"""
+    try:
+      with open(self.path(key) + '.sha256') as f:
+        return f.read().strip() or None
+    except IOError:
+      return None
+
+  def create(self):
+    """Return a new temporary file to be filled and then passed to commit()"""
+    fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=self.directory)
+    os.close(fd)
+    return open(tmp, 'wb')
+
+  def commit(self, key, tmpfile, sha256=None):
+    tmpfile.flush()
+    os.fsync(tmpfile.fileno())
+    tmpfile.close()
+    # mkstemp creates private files, the cache is shared
+    os.chmod(tmpfile.name, 0o644)
+    if sha256 is not None:
+      fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=self.directory)
+      with os.fdopen(fd, 'w') as f:
+        f.write(sha256 + '\n')
+      os.chmod(tmp, 0o644)
+      os.rename(tmp, self.path(key) + '.sha256')
+    os.rename(tmpfile.name, self.path(key))
+    self.evict()
+
+  def discard(self, tmpfile):
+    tmpfile.close()
+    _remove(tmpfile.name)
+
+  def remove(self, key):
+    _remove(self.path(key))
+    _remove(self.path(key) + '.sha256')
+
+  def size(self):
+    return sum([size for mtime, size, key in self.entries()])
+
+  def entries(self):
+    """Return (mtime, size, key) for all cached files, oldest first"""
+    entries = []
+    now = time.time()
+    for name in os.listdir(self.directory):
+      path = os.path.join(self.directory, name)
+      try:
+        st = os.stat(path)
+      except OSError:
+        continue
+      if name.startswith('.tmp-'):
+        if now - st.st_mtime > self.STALE:
+          _remove(path)
+        continue
+      if name.startswith('.') or name.endswith('.sha256') or not stat.S_ISREG(st.st_mode):
+        continue
+      entries.append((st.st_mtime, st.st_size, name))
+    entries.sort()
+    return entries
+
+  def evict(self, maxsize=None):
+    """Remove the least recently used entries until the cache fits in maxsize bytes"""
+    if maxsize is None:
+      maxsize = self.maxsize
+    if maxsize is None:
+      return []
+    with open(os.path.join(self.directory, '.lock'), 'a') as lock:
+      fcntl.flock(lock, fcntl.LOCK_EX)
+      entries = self.entries()
+      total = sum([size for mtime, size, key in entries])
+      removed = []
+      for mtime, size, key in entries:
+        if total <= maxsize:
+          break
+        self.remove(key)
+        total -= size
+        removed.append(key)
+      return removed
+
+
+class MetadataCache(object):
+
+  def __init__(self, directory):
+    self.directory = os.path.abspath(directory)
+    if not os.path.isdir(self.directory):
+      try:
+        os.makedirs(self.directory)
+      except OSError as e:
+        if e.errno != errno.EEXIST:
+          raise
+
+  def _path(self, url):
+    return os.path.join(self.directory, hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+  def get(self, url):
+    """Return the (validators, content) stored for url, or (None, None)"""
+    path = self._path(url)
+    try:
+      with open(path + '.json') as f:
+        info = json.load(f)
+      with open(path + '.data', 'rb') as f:
+        content = f.read()
+    except (IOError, ValueError):
+      return None, None
+    if info.get('url') != url or info.get('size') != len(content):
+      return None, None
+    return info.get('validators'), content
+
+  def put(self, url, validators, content):
+    path = self._path(url)
+    # content first: an entry is only used once its .json refers to it
+    for ext, data, mode in (('.data', content, 'wb'),
+                            ('.json', json.dumps({'url': url, 'size': len(content), 'validators': validators}), 'w')):
+      fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=self.directory)
+      with os.fdopen(fd, mode) as f:
+        f.write(data)
+      os.chmod(tmp, 0o644)
+      os.rename(tmp, path + ext)
@@ -0,0 +1,170 @@
+"""Deduplication of identical files across installed packages."""
+
+import os
+import stat
+import errno
+import sqlite3
+import hashlib
+import threading
+from multiprocessing.pool import ThreadPool
+
+from lcgfetch import POOLSIZE, CHUNKSIZE, listDirectory
+
+
+def hashFile(path):
+  sha256 = hashlib.sha256()
+  with open(path, 'rb') as f:
+    while True:
+      data = f.read(CHUNKSIZE)
+      if not data:
+        break
+      sha256.update(data)
+  return sha256.hexdigest()
+
+
+class DedupResult(object):
+  def __init__(self):
+    self.files = 0
+    self.hashed = 0
+    self.linked = 0
+    self.saved = 0
+
+
+class DedupStore(object):
+  """Replaces files by hard links to one copy per content: run it after the
+  post-install step, on the file system of the prefix"""
+
+  # files smaller than this are not worth an inode lookup
+  MINSIZE = 1024
+
+  def __init__(self, directory, jobs=POOLSIZE):
+    self.directory = os.path.abspath(directory)
+    self.objects = os.path.join(self.directory, 'objects')
+    self.jobs = jobs
+    self.lock = threading.Lock()
+    if not os.path.isdir(self.objects):
+      try:
+        os.makedirs(self.objects)
+      except OSError as e:
+        if e.errno != errno.EEXIST:
+          raise
+    self.db = sqlite3.connect(os.path.join(self.directory, 'index.sqlite'), timeout=600, check_same_thread=False)
+    self.db.execute('CREATE TABLE IF NOT EXISTS inodes (dev INTEGER, ino INTEGER, size INTEGER, mtime REAL, '
+                    'object TEXT, PRIMARY KEY (dev, ino))')
+    self.db.commit()
+
+  def close(self):
+    with self.lock:
+      self.db.close()
+
+  def path(self, name):
+    return os.path.join(self.objects, name[:2], name)
+
+  def _lookup(self, st):
+    with self.lock:
+      row = self.db.execute('SELECT size, mtime, object FROM inodes WHERE dev=? AND ino=?',
+                            (st.st_dev, st.st_ino)).fetchone()
+    if row is not None and row[0] == st.st_size and row[1] == st.st_mtime:
+      return row[2]
+    return None
+
+  def _remember(self, rows):
+    with self.lock:
+      self.db.executemany('INSERT OR REPLACE INTO inodes VALUES (?, ?, ?, ?, ?)', rows)
+      self.db.commit()
+
+  def _files(self, top):
+    stack = [top]
+    while stack:
+      d = stack.pop()
+      for name, isdir, isfile in listDirectory(d):
+        path = os.path.join(d, name)
+        if isdir:
+          stack.append(path)
+        elif isfile:
+          yield path
+
+  def _hash(self, item):
+    path, st = item
+    return path, st, '{0}-{1:o}'.format(hashFile(path), stat.S_IMODE(st.st_mode))
+
+  def dedup(self, top):
+    """Replace the files below top by links to identical stored copies,
+    adding the others to the store"""
+    result = DedupResult()
+    known, tohash = [], []
+    for path in self._files(top):
+      st = os.lstat(path)
+      if st.st_size < self.MINSIZE:
+        continue
+      result.files += 1
+      name = self._lookup(st)
+      if name is not None:
+        known.append((path, st, name))
+      else:
+        tohash.append((path, st))
+    hashed = []
+    if tohash:
+      pool = ThreadPool(max(1, min(self.jobs, len(tohash))))
+      try:
+        hashed = pool.map(self._hash, tohash)
+      finally:
+        pool.close()
+        pool.join()
+    result.hashed = len(hashed)
+    rows = []
+    for path, st, name in known + hashed:
+      target = self.path(name)
+      try:
+        ost = os.lstat(target)
+      except OSError as e:
+        if e.errno != errno.ENOENT:
+          raise
+        ost = self._store(path, target)
+      if (ost.st_dev, ost.st_ino) != (st.st_dev, st.st_ino):
+        self._link(target, path)
+        result.linked += 1
+        result.saved += st.st_size
+      rows.append((ost.st_dev, ost.st_ino, ost.st_size, ost.st_mtime, name))
+    self._remember(rows)
+    return result
+
+  def _store(self, path, target):
+    """Make path the stored copy of its content, unless another installer
+    stored one meanwhile"""
+    try:
+      os.mkdir(os.path.dirname(target))
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+    try:
+      os.link(path, target)
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+    return os.lstat(target)
+
+  def _link(self, target, path):
+    tmp = os.path.join(os.path.dirname(path), '.{0}.dedup'.format(os.path.basename(path)))
+    if os.path.lexists(tmp):
+      os.unlink(tmp)
+    os.link(target, tmp)
+    os.rename(tmp, path)
+
+  def prune(self):
+    """Remove the stored copies no installed file links to anymore,
+    returning how many bytes were freed"""
+    freed = 0
+    gone = []
+    for d in os.listdir(self.objects):
+      for name, isdir, isfile in listDirectory(os.path.join(self.objects, d)):
+        path = os.path.join(self.objects, d, name)
+        st = os.lstat(path)
+        if isfile and st.st_nlink == 1:
+          os.unlink(path)
+          freed += st.st_size
+          gone.append((st.st_dev, st.st_ino))
+    with self.lock:
+      self.db.executemany('DELETE FROM inodes WHERE dev=? AND ino=?', gone)
+      self.db.commit()
+    return freed
@@ -0,0 +1,65 @@
+"""Differences between two release descriptions, for delta installs."""
+
+import os
+import errno
+
+from lcgmanifest import packageKey
+
+
+class Delta(object):
+
+  def __init__(self, previous, current):
+    """previous and current are lists of lcginstall.Package"""
+    old = dict((p.name, p) for p in previous)
+    new = dict((p.name, p) for p in current)
+    self.unchanged = []
+    self.rebuilt = []
+    self.added = []
+    self.removed = [old[name] for name in sorted(old) if name not in new]
+    for p in current:
+      before = old.get(p.name)
+      if before is None:
+        self.added.append(p)
+      elif packageKey(before) == packageKey(p):
+        self.unchanged.append(p)
+      else:
+        # (old package, new package)
+        self.rebuilt.append((before, p))
+    self.carried = set([packageKey(p) for p in self.unchanged])
+
+  def isCarried(self, package):
+    return packageKey(package) in self.carried
+
+  def forget(self, package):
+    """Do not carry package over, e.g. because it is not there anymore"""
+    self.carried.discard(packageKey(package))
+    self.unchanged.remove(package)
+    self.added.append(package)
+
+  def outdated(self):
+    return [old for old, new in self.rebuilt] + self.removed
+
+  def summary(self):
+    return "{0} unchanged, {1} rebuilt, {2} added, {3} removed".format(len(self.unchanged), len(self.rebuilt),
+      len(self.added), len(self.removed))
+
+
+def readPrevious(path):
+  """Return the previous description saved at path, or None"""
+  try:
+    with open(path) as f:
+      return f.read()
+  except IOError as e:
+    if e.errno != errno.ENOENT:
+      raise
+    return None
+
+
+def savePrevious(path, text):
+  directory = os.path.dirname(path)
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+  tmp = path + '.tmp'
+  with open(tmp, 'w') as f:
+    f.write(text)
+  os.rename(tmp, path)
@@ -0,0 +1,304 @@
+"""Access to the release area (http:// or file://) used by lcginstall.py."""
+
+import os
+import stat
+import time
+import fnmatch
+import hashlib
+import tarfile
+import threading
+from multiprocessing.pool import ThreadPool
+
+import requests
+
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir
+  except ImportError:
+    scandir = None
+
+# Number of concurrent requests (and pooled connections per host)
+POOLSIZE = 16
+# Size of the blocks read from the release area
+CHUNKSIZE = 1 << 20
+
+_session = None
+_sessionlock = threading.Lock()
+
+
+def getSession():
+  global _session
+  with _sessionlock:
+    if _session is None:
+      _session = requests.Session()
+      adapter = requests.adapters.HTTPAdapter(pool_connections=POOLSIZE, pool_maxsize=POOLSIZE, max_retries=2)
+      _session.mount('http://', adapter)
+      _session.mount('https://', adapter)
+    return _session
+
+
+def isLocal(url):
+  return "file://" in url
+
+
+def localPath(url):
+  return url.replace('file://', '')
+
+
+def _stat(url):
+  """Return (url, size, reason): size in bytes (None if not advertised)
+  when url exists, or the reason why it could not be found"""
+  if isLocal(url):
+    try:
+      return url, os.stat(localPath(url)).st_size, None
+    except OSError as e:
+      return url, None, e.strerror
+  try:
+    ret = getSession().head(url)
+  except requests.RequestException as e:
+    return url, None, str(e)
+  if ret.status_code == 200:
+    size = ret.headers.get('Content-Length')
+    return url, int(size) if size is not None else None, None
+  return url, None, "HTTP {0}".format(ret.status_code)
+
+
+def checkURL(url):
+  return _stat(url)[2] is None
+
+
+def listDirectory(path):
+  """Yield (name, isdir, isfile) for the entries of path, without following
+  symbolic links, using a single scandir() pass where available"""
+  if scandir is not None:
+    for entry in scandir(path):
+      yield entry.name, entry.is_dir(follow_symlinks=False), entry.is_file(follow_symlinks=False)
+  else:
+    for name in os.listdir(path):
+      st = os.lstat(os.path.join(path, name))
+      yield name, stat.S_ISDIR(st.st_mode), stat.S_ISREG(st.st_mode)
+
+
+def fetchURL(url, cache=None):
+  """Return the content of url.
+
+  With a MetadataCache, a local file is only read again when its size or
+  modification time changed, and an HTTP document is revalidated with
+  If-None-Match/If-Modified-Since and not downloaded again when unchanged."""
+  validators, content = cache.get(url) if cache is not None else (None, None)
+  if isLocal(url):
+    try:
+      st = os.stat(localPath(url))
+    except OSError:
+      raise IOError("URL {0} not found.".format(url))
+    current = {'mtime': st.st_mtime, 'size': st.st_size}
+    if content is not None and validators == current:
+      return content
+    with open(localPath(url), 'rb') as f:
+      content = f.read()
+    if cache is not None:
+      cache.put(url, current, content)
+    return content
+  headers = {}
+  if content is not None and validators:
+    if validators.get('etag'):
+      headers['If-None-Match'] = validators['etag']
+    if validators.get('last-modified'):
+      headers['If-Modified-Since'] = validators['last-modified']
+  ret = getSession().get(url, headers=headers)
+  if ret.status_code == 304 and content is not None:
+    return content
+  if ret.status_code != 200:
+    raise IOError("Cannot get {0}: HTTP {1}".format(url, ret.status_code))
+  current = {'etag': ret.headers.get('ETag'), 'last-modified': ret.headers.get('Last-Modified')}
+  if cache is not None and (current['etag'] or current['last-modified']):
+    cache.put(url, current, ret.content)
+  return ret.content
+
+
+def findFiles(top, pattern, cache=None):
+  """Return the sorted paths of the regular files below top whose name
+  matches pattern, like 'find top -type f -name pattern'.
+
+  With a MetadataCache, the previous result is reused as long as none of
+  the directories it was built from has been modified."""
+  key = 'find://{0}?name={1}'.format(top, pattern)
+  if cache is not None:
+    validators, content = cache.get(key)
+    if content is not None and validators:
+      try:
+        if all([os.stat(d).st_mtime == mtime for d, mtime in validators.items()]):
+          return content.decode('utf-8').split('\n') if content else []
+      except OSError:
+        pass
+  dirs = {}
+  found = []
+  stack = [top]
+  while stack:
+    d = stack.pop()
+    # taken before listing, so that a concurrent change invalidates the entry
+    dirs[d] = os.stat(d).st_mtime
+    for name, isdir, isfile in listDirectory(d):
+      if isdir:
+        stack.append(os.path.join(d, name))
+      elif isfile and fnmatch.fnmatchcase(name, pattern):
+        found.append(os.path.join(d, name))
+  found.sort()
+  if cache is not None:
+    cache.put(key, dirs, '\n'.join(found).encode('utf-8'))
+  return found
+
+
+def statURLs(urls, jobs=POOLSIZE):
+  """Look up all the given URLs concurrently.
+
+  Returns a list of (url, size, reason) in the order in which they were
+  given, where reason is None for the URLs that exist."""
+  urls = list(urls)
+  if not urls:
+    return []
+  pool = ThreadPool(max(1, min(jobs, len(urls))))
+  try:
+    return pool.map(_stat, urls)
+  finally:
+    pool.close()
+    pool.join()
+
+
+def checkURLs(urls, jobs=POOLSIZE):
+  """Check all the given URLs concurrently.
+
+  Returns a list of (url, reason) for every URL that could not be found,
+  in the order in which they were given."""
+  return [(url, reason) for url, size, reason in statURLs(urls, jobs) if reason is not None]
+
+
+class HashingReader(object):
+  """Read-only file wrapper computing the SHA-256 and size of what is read,
+  optionally copying the data to a second file"""
+
+  def __init__(self, fileobj, sink=None, throttle=None):
+    self.fileobj = fileobj
+    self.sink = sink
+    self.throttle = throttle
+    self.sha256 = hashlib.sha256()
+    self.bytes = 0
+
+  def read(self, size=-1):
+    data = self.fileobj.read(size)
+    self.sha256.update(data)
+    self.bytes += len(data)
+    if self.sink is not None:
+      self.sink.write(data)
+    if self.throttle is not None:
+      self.throttle.downloaded(len(data))
+    return data
+
+  def drain(self):
+    while self.read(CHUNKSIZE):
+      pass
+
+  def close(self):
+    self.fileobj.close()
+
+
+def openURL(url):
+  """Return a file object streaming the raw content of url"""
+  if isLocal(url):
+    return open(localPath(url), 'rb', CHUNKSIZE)
+  ret = getSession().get(url, stream=True)
+  if ret.status_code != 200:
+    ret.close()
+    raise IOError("Cannot get {0}: HTTP {1}".format(url, ret.status_code))
+  return ret.raw
+
+
+class Extraction(object):
+  """Summary of an extracted tarball"""
+
+  def __init__(self, url):
+    self.url = url
+    self.files = 0
+    self.bytes = 0
+    self.downloaded = 0
+    self.sha256 = None
+    self.first = None
+    self.cached = False
+    self.seconds = 0.
+
+  def throughput(self):
+    if self.seconds <= 0:
+      return 0.
+    return self.downloaded / self.seconds
+
+
+def _members(tar, extraction, transform, listing, throttle):
+  for member in tar:
+    if transform is not None:
+      old, new = transform
+      member.name = member.name.replace(old, new)
+      if member.islnk() or member.issym():
+        member.linkname = member.linkname.replace(old, new)
+    extraction.files += 1
+    if member.isfile():
+      extraction.bytes += member.size
+      if throttle is not None:
+        throttle.written(member.size)
+    if extraction.first is None or member.name < extraction.first:
+      extraction.first = member.name
+    if listing is not None:
+      listing.write(member.name + '\n')
+    yield member
+
+
+def extractURL(url, destination, transform=None, cache=None, listing=None, throttle=None):
+  """Stream the gzipped tarball at url and unpack it into destination.
+
+  transform is an optional (old, new) pair of strings replaced in every
+  member path, the in-process equivalent of 'tar --transform'. With a
+  TarballCache, the tarball is read from the cache when present and stored
+  in it while downloading otherwise. The path of every member is written
+  to the listing file object, if given, before it is extracted. A
+  lcgthrottle.Throttle limits the download bandwidth and write rate. Returns
+  an Extraction with the file count, unpacked and read bytes and the
+  SHA-256 of the tarball. If extraction fails, the partially filled
+  Extraction is attached to the exception as its 'extraction' attribute."""
+  extraction = Extraction(url)
+  key = os.path.basename(url)
+  start = time.time()
+  cached = cache.lookup(key) if cache is not None else None
+  sink = None
+  if cached is not None:
+    extraction.cached = True
+    reader = HashingReader(open(cached, 'rb', CHUNKSIZE))
+  else:
+    reader = HashingReader(openURL(url), throttle=throttle)
+    if cache is not None:
+      sink = reader.sink = cache.create()
+  try:
+    tar = tarfile.open(fileobj=reader, mode='r|gz')
+    try:
+      tar.extractall(destination, members=_members(tar, extraction, transform, listing, throttle))
+    finally:
+      tar.close()
+    # checksum covers the whole file, including the padding after the archive
+    reader.drain()
+    sha256 = reader.sha256.hexdigest()
+    if cached is not None and cache.checksum(key) not in (None, sha256):
+      cache.remove(key)
+      raise IOError("Corrupted cache entry {0} removed".format(cached))
+  except Exception as e:
+    if sink is not None:
+      cache.discard(sink)
+    e.extraction = extraction
+    raise
+  finally:
+    reader.close()
+  if sink is not None:
+    cache.commit(key, sink, sha256)
+  extraction.downloaded = reader.bytes
+  extraction.sha256 = sha256
+  extraction.seconds = time.time() - start
+  return extraction
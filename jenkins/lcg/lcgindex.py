@@ -0,0 +1,149 @@
+"""Index of what is already installed in a prefix."""
+
+import os
+import json
+import errno
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
+
+from lcgfetch import POOLSIZE, listDirectory
+
+
+def _read(path):
+  """Return (path, mtime, {name: kind}) for directory path, with mtime and
+  entries None if it does not exist"""
+  try:
+    # taken before listing, so that a concurrent change invalidates the entry
+    mtime = os.stat(path).st_mtime
+    entries = {}
+    for name, isdir, isfile in listDirectory(path):
+      entries[name] = 'dir' if isdir else 'file' if isfile else 'link'
+  except OSError as e:
+    if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+      raise
+    return path, None, None
+  return path, mtime, entries
+
+
+def _mtime(path):
+  try:
+    return path, os.stat(path).st_mtime
+  except OSError as e:
+    if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+      raise
+    return path, None
+
+
+class PathIndex(object):
+
+  def __init__(self, filename=None, jobs=POOLSIZE):
+    self.filename = filename
+    self.jobs = jobs
+    self.lock = threading.Lock()
+    # directory -> (mtime, {name: kind}), (None, None) when missing
+    self.dirs = {}
+    self.reads = 0
+    self.cached = {}
+    if filename is not None and os.path.exists(filename):
+      try:
+        with open(filename) as f:
+          self.cached = dict((d, tuple(v)) for d, v in json.load(f)['dirs'].items())
+      except (ValueError, KeyError, TypeError):
+        self.cached = {}
+
+  def _map(self, function, items):
+    if not items:
+      return []
+    pool = ThreadPool(max(1, min(self.jobs, len(items))))
+    try:
+      return pool.map(function, items)
+    finally:
+      pool.close()
+      pool.join()
+
+  def load(self, paths):
+    """Read at once the directories holding the given paths"""
+    parents = set([os.path.dirname(os.path.abspath(p).rstrip('/')) for p in paths])
+    with self.lock:
+      parents = sorted(parents.difference(self.dirs))
+    if not parents:
+      return
+    known = [d for d in parents if d in self.cached]
+    valid = set([d for d, mtime in self._map(_mtime, known) if mtime == self.cached[d][0]])
+    results = self._map(_read, [d for d in parents if d not in valid])
+    with self.lock:
+      for d in valid:
+        self.dirs.setdefault(d, self.cached[d])
+      for d, mtime, entries in results:
+        self.dirs.setdefault(d, (mtime, entries))
+      self.reads += len(results)
+
+  def kind(self, path):
+    """Return 'dir', 'file' or 'link' for path, or None if it does not exist"""
+    path = os.path.abspath(path).rstrip('/')
+    parent, name = os.path.split(path)
+    if not name:
+      return 'dir'
+    with self.lock:
+      known = parent in self.dirs
+    if not known:
+      self.load([path])
+    with self.lock:
+      entries = self.dirs[parent][1]
+      return entries.get(name) if entries is not None else None
+
+  def exists(self, path):
+    # like os.path.exists(), links are followed: their target is not indexed
+    kind = self.kind(path)
+    return os.path.exists(path) if kind == 'link' else kind is not None
+
+  def isdir(self, path):
+    kind = self.kind(path)
+    return os.path.isdir(path) if kind == 'link' else kind == 'dir'
+
+  def add(self, path, kind='dir'):
+    """Record that path was just created, as well as its missing parents"""
+    path = os.path.abspath(path).rstrip('/')
+    parent, name = os.path.split(path)
+    if not name:
+      return
+    with self.lock:
+      if parent not in self.dirs:
+        return
+      mtime, entries = self.dirs[parent]
+      missing = entries is None
+      if missing:
+        entries = {}
+      entries[name] = kind
+      # the directory changed: never trust its entry in a saved index
+      self.dirs[parent] = (None, entries)
+    if missing:
+      self.add(parent, 'dir')
+
+  def remove(self, path):
+    path = os.path.abspath(path).rstrip('/')
+    parent, name = os.path.split(path)
+    with self.lock:
+      if self.dirs.get(parent, (None, None))[1] is not None:
+        self.dirs[parent] = (None, self.dirs[parent][1])
+        self.dirs[parent][1].pop(name, None)
+      for d in [d for d in self.dirs if d == path or d.startswith(path + '/')]:
+        self.dirs[d] = (None, None)
+
+  def save(self):
+    if self.filename is None:
+      return
+    with self.lock:
+      dirs = dict(self.cached)
+      dirs.update(self.dirs)
+    directory = os.path.dirname(os.path.abspath(self.filename))
+    fd, tmp = tempfile.mkstemp(prefix='.index-', dir=directory)
+    try:
+      with os.fdopen(fd, 'w') as f:
+        json.dump({'dirs': dirs}, f)
+      os.chmod(tmp, 0o644)
+      os.rename(tmp, self.filename)
+    except:
+      os.unlink(tmp)
+      raise
@@ -3,11 +3,25 @@
 import os
 import sys
 import re
+import errno
 import argparse
 import subprocess
 import shutil
-import requests
+import threading
 import buildinfo2json
+from lcgfetch import checkURLs, extractURL, fetchURL, findFiles
+from lcgcache import TarballCache, MetadataCache
+from lcgmanifest import InstallManifest, packageKey
+from lcgplan import makePlan, writePlan
+from lcglinks import LinkFarm
+from lcgreport import RunReport
+from lcgthrottle import Throttle, DEFAULT_DIRECTORY as THROTTLE_DIRECTORY
+from lcgstaging import StagingArea
+from lcgindex import PathIndex
+from lcgdedup import DedupStore
+from lcgdelta import Delta, readPrevious, savePrevious
+from lcgverify import verifyRelease, writeVerification
+from lcgqueue import WorkQueue, extractionFromResult, runWorker
 
 # gcc path
 
@@ -35,13 +49,6 @@ def getCompilerPath(version, platform, fstype=None):
     raise RuntimeError("Cannot find compiler in {0}".format(os.path.join(path, platform)))
 
 
-def checkURL(url):
-  if "file://" in url:
-    return True if os.system('stat {0} 1>/dev/null 2>/dev/null'.format(url.replace('file://', ''))) == 0 else False
-  ret = requests.head(url)
-  return ret.status_code == 200
-
-
 class Package:
   cache = {}
 
@@ -66,11 +73,48 @@ class Package:
   def getInstallPath(self):
     return os.path.join(self.directory, self.version, self.platform)
 
+class InstallOptions(object):
+  """What an installation shares with the rest of the run, all optional:
+  caches, manifest, throttle, staging area, path index, deduplication
+  store, work queue, the previous description (for a delta) and whether to
+  build a link farm"""
+
+  def __init__(self, cache=None, manifest=None, metadata=None, linkfarm=False, report=None, throttle=None, staging=None, index=None, dedup=None, previous=None, queue=None):
+    self.cache = cache
+    self.manifest = manifest
+    self.metadata = metadata
+    self.linkfarm = linkfarm
+    self.report = report
+    self.throttle = throttle
+    self.staging = staging
+    self.index = index
+    self.dedup = dedup
+    self.previous = previous
+    self.queue = queue
+
+
 class InstallProcess:
-  def __init__(self, releaseurl, description, prefix='.', lcgversion='auto',  updatelinks=False, nocheck=False, nightly=False, limited=False, endsystem='cvmfs'):
+  def __init__(self, releaseurl, description, prefix='.', lcgversion='auto',  updatelinks=False, nocheck=False, nightly=False, limited=False, endsystem='cvmfs', options=None):
+    if options is None:
+      options = InstallOptions()
     self.packages = []
+    self.packageindex = {}
     self.releaseurl = releaseurl
     self.prefix = prefix
+    self.cache = options.cache
+    self.metadata = options.metadata
+    self.linkfarm = options.linkfarm
+    self.report = options.report if options.report is not None else RunReport()
+    self.throttle = options.throttle
+    self.staging = options.staging
+    self.index = options.index if options.index is not None else PathIndex()
+    self.indexed = False
+    self.indexlock = threading.Lock()
+    self.dedup = options.dedup
+    self.delta = None
+    self.queue = options.queue
+    self.queued = set()
+    self.manifest = options.manifest
     #self.endsystem = endsystem
     if "afs" in endsystem:
       self.basepath = RELEASEPATHS['AFS']
@@ -81,24 +125,37 @@ class InstallProcess:
 
     if lcgversion != "auto":
       self.lcgversion = lcgversion
-    else:
+    elif description != "":
       lcgversion = description.split("_")[1]
     self.description = description
-    self.platform = self.getPlatform(description)
-    self.nakedplatform = self.getNakedPlatform(self.platform)
+    # no description when just listing the available releases
+    if description != "":
+      self.platform = self.getPlatform(description)
+      self.nakedplatform = self.getNakedPlatform(self.platform)
     self.nightly = nightly
     self.updatelinks = updatelinks
     self.limited = limited
+    self.missing = []
+    # packages whose installation did not succeed
+    self.failed = []
     print "Starting " + self.getType()
     if description != "":
-      self.fillPackages(description)
+      with self.report.phase('description'):
+        self.fillPackages(description)
+      if options.previous is not None:
+        with self.report.phase('delta'):
+          self.computeDelta(options.previous)
       if not nocheck:
         print "Checking all tgz files ..."
-        self.checkAll()
+        with self.report.phase('check'):
+          self.checkAll()
 
   #Hook methods. Concrete details may differ in each subclass
   def getLinkpath(self):
       raise NotImplementedError()
+  def getLinkroot(self):
+      # (root of all links, whether it can be swapped atomically)
+      raise NotImplementedError()
   def getDatapath(self):
       raise NotImplementedError()
   def getPostinstallFile(self):
@@ -116,12 +173,59 @@ class InstallProcess:
     return '-'.join([arch.split('+')[0], osvers, compvers, buildtype])
 
   def fillPackages(self, description):
-    text = self.getDescContent(os.path.join(self.releaseurl, self.description))
-    lines = text.split('\n')
+    text = self.getDescContent(os.path.join(self.releaseurl, self.description), self.metadata)
+    self.descriptiontext = text
     # limited contains a line with PKGS_OK
-    self.limited = 'PKGS_OK' in lines[0]
+    self.limited = 'PKGS_OK' in text.split('\n')[0]
+    self.packages = self.parsePackages(text)
+    # built here, before worker threads look dependencies up in it
+    self.packageindex = {}
+    for p in self.packages:
+      self.packageindex.setdefault(p.name, p)
+      self.packageindex["{0}-{1}".format(p.name, p.hashstr)] = p
+
+  def computeDelta(self, previous):
+    self.delta = Delta(self.parsePackages(previous), self.packages)
+    for package in list(self.delta.unchanged):
+      # only what is still there can be carried over
+      if self.nightly :
+        paths = [self.getLinkpath(package)]
+      else :
+        paths = [self.getDatapath(package), self.getLinkpath(package)]
+      if not all([self.exists(x) for x in paths]):
+        self.delta.forget(package)
+    print "Delta with the previous description:", self.delta.summary()
+
+  def removeOutdated(self):
+    # Old builds of rebuilt or removed packages, once the new ones are
+    # installed. Release areas are shared by all the releases, so only
+    # nightly prefixes are cleaned up.
+    if not self.nightly :
+      return
+    current = set([self.getLinkpath(p) for p in self.packages])
+    for package in self.delta.outdated():
+      path = self.getLinkpath(package)
+      key = packageKey(package)
+      if path in current:
+        # the new build of the same version was installed in its place
+        if self.manifest is not None and self.manifest.phase(key) is not None:
+          self.manifest.forget(key)
+        continue
+      print "Remove outdated", package.getName(), "build", package.hashstr, "from", path
+      if self.manifest is not None and self.manifest.phase(key) is not None:
+        self.manifest.rollback(key, path)
+      elif os.path.islink(path) or os.path.isfile(path):
+        os.unlink(path)
+      elif os.path.isdir(path):
+        shutil.rmtree(path)
+      self.index.remove(path)
 
-    if self.limited:
+  def parsePackages(self, text):
+    packages = []
+    lines = text.split('\n')
+    limited = 'PKGS_OK' in lines[0]
+
+    if limited:
       selectedpackages = lines[0].split('PKGS_OK ')[1].split(' ')
 
     for line in lines:
@@ -133,7 +237,7 @@ class InstallProcess:
       else :               platform = self.platform
 
 #      if "rootext" in self.lcgversion:
-      if self.limited:
+      if limited:
         for i in selectedpackages:
           if i != d['NAME']:
             continue
@@ -142,54 +246,44 @@ class InstallProcess:
               print "# Skip package", d['NAME'], 'as it should be packaged in', d['DESTINATION']
               continue
             p = Package(d['NAME'], d['VERSION'], d['HASH'], d['DIRECTORY'], d['DEPENDS'], platform, d['COMPILER'])
-            self.packages.append(p)
+            packages.append(p)
       else:
         if d['NAME'] != d['DESTINATION']:
         # bundled package
           print "# Skip package", d['NAME'], 'as it should be packaged in', d['DESTINATION']
           continue
         p = Package(d['NAME'], d['VERSION'], d['HASH'], d['DIRECTORY'], d['DEPENDS'], platform, d['COMPILER'])
-        self.packages.append(p)
+        packages.append(p)
+    return packages
 
   @staticmethod
-  def getDescContent(url):
+  def getDescContent(url, cache=None):
     url = str(url)
-    if not checkURL(url):
-      raise RuntimeError("URL {0} not found.".format(url))
-    p = subprocess.Popen(['curl', '-s', url], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = p.communicate()
-    if p.returncode == 0:
-      return stdout.strip()
-    else:
+    try:
+      return fetchURL(url, cache).strip()
+    except IOError as e:
       print "ERROR:"
-      print stderr.strip()
+      print str(e)
       raise RuntimeError("Cannot get info from " + url)
 
   def getListOfReleases(self):
     url = self.releaseurl
-    if not checkURL(url):
-      raise RuntimeError("URL {0} not found.".format(url))
     if 'file://' in url:
-      p = subprocess.Popen(['find', url.replace('file://', ''), '-type', 'f', '-name', 'LCG_*.txt'],
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+      top = url.replace('file://', '')
+      if not os.path.isdir(top):
+        raise RuntimeError("URL {0} not found.".format(url))
+      a = findFiles(top, 'LCG_*.txt', self.metadata)
     else:
-      p = subprocess.Popen(['curl', '-s', url], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = p.communicate()
-    if p.returncode == 0:
-      if "file://" in url:
-        a = stdout.strip().split('\n')
-      else:
-        a = re.findall('.*href="?(.+.txt)"?>.*', stdout)
-      return [os.path.basename(x) for x in a]
-    else:
-      print "ERROR:"
-      print stderr.strip()
-      raise RuntimeError("Cannot get info from " + url)
+      a = re.findall('.*href="?(.+.txt)"?>.*', self.getDescContent(url, self.metadata))
+    return [os.path.basename(x) for x in a]
 
-  def postinstall(self, postfile):
-    p = subprocess.Popen(['env', 'INSTALLDIR={0}'.format(self.prefix), 'bash', postfile], stdout=subprocess.PIPE,
-      stderr=subprocess.PIPE)
-    stdout, stderr = p.communicate()
+  def postinstall(self, postfile, key=None):
+    with self.report.phase('postinstall', key):
+      p = subprocess.Popen(['env', 'INSTALLDIR={0}'.format(self.prefix), 'bash', postfile], stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE)
+      stdout, stderr = p.communicate()
+    if key is not None:
+      self.report.update(key, postinstall_rc=p.returncode)
     if p.returncode == 0:
       print "  OK."
       return True
@@ -198,13 +292,31 @@ class InstallProcess:
       print stderr.strip()
       raise RuntimeError("Error in post-install step")
 
-  @staticmethod
-  def createLinks(frompath, topath, relative=True, updatelinks=False):
+  def exists(self, path):
+    # answered from the index of the prefix, read at the first call
+    with self.indexlock:
+      if not self.indexed:
+        with self.report.phase('index'):
+          self.index.load(self.getIndexPaths())
+        print "  Index of the prefix: {0} directories, {1} read".format(len(self.index.dirs), self.index.reads)
+        self.indexed = True
+    return self.index.exists(path)
+
+  def getIndexPaths(self):
+    paths = []
+    for package in self.packages:
+      linkpath = self.getLinkpath(package)
+      paths += [self.getInstalledPath(package), self.getExtractpath(package), self.getDatapath(package), linkpath,
+                os.path.dirname(linkpath)]
+    return paths
+
+  def createLinks(self, frompath, topath, relative=True, updatelinks=False):
     # Destroy current link to create a new one to the new installed package
     # Maintain old pointed package
-    if updatelinks and os.path.exists(topath):
+    if updatelinks and self.exists(topath):
         print "  Removing existing link {0}->{1}".format(topath, os.path.realpath(topath))
         os.unlink(topath)
+        self.index.remove(topath)
 
     if frompath[-1] == '/':
       frompath = frompath[:-1]
@@ -212,45 +324,137 @@ class InstallProcess:
       topath = topath[:-1]
     try:
       print "  Checking that symbolic link {0} exists".format(topath)
-      if not os.path.exists(topath):
-        if not os.path.exists(os.path.dirname(topath)):
-          os.makedirs(os.path.dirname(topath))
+      if not self.exists(topath):
+        if not self.exists(os.path.dirname(topath)):
+          try:
+            os.makedirs(os.path.dirname(topath))
+          except OSError as e:
+            # another installer thread may have created it meanwhile
+            if e.errno != errno.EEXIST:
+              raise
+          self.index.add(os.path.dirname(topath))
         if relative:
           frompath = os.path.relpath(frompath, topath)
           frompath = '/'.join(frompath.split('/')[1:])
         print "  Create symbolic link {0}->{1}".format(topath, frompath)
         os.symlink(frompath, topath)
+        self.index.add(topath, 'link')
       else:
         print "  Existing link: {0}->{1}".format(topath, os.path.realpath(topath))
       return True
     except Exception as e:
       raise RuntimeError("Error during managing symlinks: " + str(e))
 
+  def deduplicate(self, package):
+    key = packageKey(package)
+    with self.report.phase('dedup', key):
+      result = self.dedup.dedup(self.getExtractpath(package))
+    print "  Deduplicated: {0} of {1} files linked to {2} ({3} bytes saved, {4} files hashed)".format(result.linked,
+      result.files, self.dedup.directory, result.saved, result.hashed)
+    self.report.update(key, dedup_linked=result.linked, dedup_saved=result.saved)
+
+  def createLinkFarm(self):
+    root, atomic = self.getLinkroot()
+    farm = LinkFarm(root, updatelinks=self.updatelinks)
+    for package in self.packages:
+      datapath = self.getDatapath(package)
+      if not self.exists(datapath):
+        # nightlies: packages not in the release area were extracted in place
+        if self.nightly or self.limited:
+          continue
+        raise RuntimeError("Path not exists: " + datapath)
+      farm.add(datapath, self.getLinkpath(package))
+    print "Building links in", root
+    with self.report.phase('links'):
+      create, update, unchanged, conflicts = farm.build(atomic)
+    for rel in create:
+      print "  Created symbolic link {0}->{1}".format(os.path.join(root, rel), farm.links[rel])
+    for rel in update:
+      print "  Updated symbolic link {0}->{1}".format(os.path.join(root, rel), farm.links[rel])
+    for rel in conflicts:
+      print "  WARNING: {0} exists and is not a symbolic link, not touched".format(os.path.join(root, rel))
+    print "  {0} created, {1} updated, {2} unchanged, {3} conflicts".format(len(create), len(update), len(unchanged),
+      len(conflicts))
+    return True
+
+  def install(self, package, force=False):
+    key = packageKey(package)
+    with self.report.phase('install', key):
+      try:
+        rc = self.installPackage(package, force)
+      except Exception as e:
+        self.report.update(key, rc=1, error=str(e))
+        self.failed.append(package)
+        raise
+    self.report.update(key, rc=0 if rc else 1)
+    if not rc:
+      self.failed.append(package)
+    return rc
+
   # Template method
-  def install(self, package, opts='-xpz', force=False):
+  def installPackage(self, package, force=False):
 
     # Get source and destination paths for links
     linkpath = self.getLinkpath(package)
     datapath = self.getDatapath(package)
 
+    key = packageKey(package)
+    if self.delta is not None and self.delta.isCarried(package):
+      print "  Unchanged since the previous description, carried over"
+      return True
+    phase = self.manifest.phase(key) if self.manifest is not None else None
+    if phase == 'installed' and not force:
+      if self.isRecorded(package):
+        # the links may belong to another release installed in the same prefix
+        print "  Already installed according to", self.manifest.directory
+      else:
+        print "  Installed according to {0} but {1} is gone, installing it again".format(self.manifest.directory,
+          self.getExtractpath(package))
+        self.manifest.forget(key)
+        phase = None
+    if phase == 'extracting':
+      print "  Roll back interrupted extraction of", package.getPackageFilename()
+      self.manifest.rollback(key, self.getExtractpath(package))
+      self.index.remove(self.getExtractpath(package))
+      phase = None
+
     unTARdone = False
     # Manage copy of file or creation of links
-    if not self.isInstalled(package) or force :
+    if phase in ('extracted', 'postinstalled') and not force:
+      print "  Resume interrupted installation after", phase, "step"
+      unTARdone = True
+      rc = True
+      postinstallfile = self.getPostinstallFile(package)
+      if phase == 'extracted' and os.path.exists(postinstallfile):
+        print "  Launch .post-install.sh"
+        rc = self.postinstall(postinstallfile, key)
+      if self.manifest is not None and phase == 'extracted':
+        self.manifest.postinstalled(key)
+    elif not self.isInstalled(package) or force :
       print "  Extract archive from", os.path.join(self.releaseurl, package.getPackageFilename())
-      rc = self.unTAR(package, opts)
+      rc = self.unTAR(package)
       unTARdone = True
       postinstallfile = self.getPostinstallFile(package)
 
       if os.path.exists(postinstallfile):
         print "  Launch .post-install.sh"
-        rc = rc and self.postinstall(postinstallfile)
+        rc = rc and self.postinstall(postinstallfile, key)
+      if self.manifest is not None and rc:
+        self.manifest.postinstalled(key)
     else:
         rc = True
 
+    if unTARdone and rc and self.dedup is not None:
+      self.deduplicate(package)
+
     # Release installation always creates link from .../release/LCG/pkg -> .../release/pkg
-    if (self.nightly and not unTARdone) or (not self.nightly):
-        if(os.path.exists(datapath)):
-           rc = rc and self.createLinks(datapath, linkpath, updatelinks=self.updatelinks)
+    if self.linkfarm:
+        # links of the whole release are created at once by createLinkFarm()
+        pass
+    elif (self.nightly and not unTARdone) or (not self.nightly):
+        if(self.exists(datapath)):
+           with self.report.phase('links', key):
+             rc = rc and self.createLinks(datapath, linkpath, updatelinks=self.updatelinks)
         else:
            if self.limited :
               # Ignoring the prackage....
@@ -266,31 +470,44 @@ class InstallProcess:
     #       raise RuntimeError("Path not exists: " + datapath)
     ## TODO Check this part -> Otherwise there is no link from /release/LCG-Version/pkg to /release/pkg-hash
     ## when a package is not previously install or force is eneabled
+    if self.manifest is not None and rc:
+      self.manifest.installed(key)
     return rc
 
   def checkAll(self):
-    for package in self.packages:
-      filename = os.path.join(self.releaseurl, package.getPackageFilename())
-      if not checkURL(filename):
+    packages = self.packages
+    if self.delta is not None:
+      packages = [x for x in packages if not self.delta.isCarried(x)]
+    if self.manifest is not None:
+      packages = [x for x in packages if not self.isRecorded(x)]
+      if len(packages) != len(self.packages):
+        print "  {0} packages already installed according to {1}".format(len(self.packages) - len(packages), self.manifest.directory)
+    filenames = [os.path.join(self.releaseurl, package.getPackageFilename()) for package in packages]
+    if self.cache is not None:
+      remote = [x for x in filenames if not self.cache.contains(os.path.basename(x))]
+      print "  {0} of {1} tarballs found in cache {2}".format(len(filenames) - len(remote), len(filenames), self.cache.directory)
+    else:
+      remote = filenames
+    self.missing = checkURLs(remote)
+    for filename, reason in self.missing:
+      print "  Not found: {0} ({1})".format(filename, reason)
+    if self.missing:
 #        if self.nightly  or "rootext" in self.lcgversion:
-        if self.nightly  or self.limited:
-          print "This package does not exist in this configuration, however we continue: ", filename
-        else :
-          raise RuntimeError("URL not found: " + filename)
+      if self.nightly or self.limited:
+        print "{0} packages do not exist in this configuration, however we continue".format(len(self.missing))
+      else:
+        raise RuntimeError("{0} of {1} tarballs not found in {2}".format(len(self.missing), len(filenames), self.releaseurl))
     return True
 
-  def unTAR(self, package, opts='-xpz'):
+  def getTransform(self, package):
     if self.nightly :
-      opts += " -v "
-    else :
-      opts += " -v --show-transformed-names --transform 's,/{0}/{2},/{0}-{1}/{2},g'".format(package.version, package.hashstr, package.platform)  # verbose (to keep list of untared files)
-    filename = os.path.join(self.releaseurl, package.getPackageFilename())
-    p = subprocess.Popen('curl -s {0} | tar {1} -C {2} -f -'.format(filename, opts, self.prefix),
-      stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-    stdout, stderr = p.communicate()
+      return None
+    return ('/{0}/{1}'.format(package.version, package.platform),
+            '/{0}-{1}/{2}'.format(package.version, package.hashstr, package.platform))
 
+  def removeUnmatched(self, root, package):
     # Remove only case not matched by the previous regex expresion (packageName/version-withoutHash)
-    unmatched = os.path.join(self.prefix, package.directory, package.version)
+    unmatched = os.path.join(root, package.directory, package.version)
     if os.path.exists(unmatched):
         # Check whether it is empty
         otherdirs = os.listdir(unmatched)
@@ -299,46 +516,212 @@ class InstallProcess:
         elif otherdirs == ["share"]:
             shutil.rmtree(unmatched)
 
-    if p.returncode == 0:
-      print "  File:", filename, "Extracted:", len(stdout.strip().split('\n')), 'files'
+  def printExtraction(self, filename, extraction):
+    print "  File:", filename, "Extracted:", extraction.files, 'files,', extraction.bytes, 'bytes',
+    print "({0} bytes {1} in {2:.1f}s, {3:.1f} MB/s)".format(extraction.downloaded,
+      'read from cache' if extraction.cached else 'downloaded', extraction.seconds, extraction.throughput() / 1e6)
+    print "  SHA-256:", extraction.sha256
+
+  def unTAR(self, package):
+    transform = self.getTransform(package)
+    filename = os.path.join(self.releaseurl, package.getPackageFilename())
+    key = packageKey(package)
+    if key in self.queued:
+      return self.unTARFromQueue(package)
+    listing = self.manifest.begin(key) if self.manifest is not None else None
+    # with a staging area, the tarball is unpacked aside and moved in place once complete
+    root = self.prefix
+    staging = None
+    if self.staging is not None:
+      staging = root = self.staging.create(key)
+    try:
+      slot = None
+      if self.throttle is not None:
+        with self.report.phase('throttle', key):
+          slot = self.throttle.acquire()
+      try:
+        with self.report.phase('extract', key):
+          extraction = extractURL(filename, root, transform, self.cache, listing, self.throttle)
+      finally:
+        if self.throttle is not None:
+          self.throttle.release(slot)
+      error = None
+    except Exception as e:
+      extraction = getattr(e, 'extraction', None)
+      error = e
+    if extraction is not None:
+      self.report.update(key, files=extraction.files, bytes=extraction.bytes, downloaded=extraction.downloaded,
+        cached=extraction.cached)
+
+    self.removeUnmatched(root, package)
+
+    if error is None:
+      self.printExtraction(filename, extraction)
+      if staging is not None:
+        with self.report.phase('commit', key):
+          self.staging.commit(staging, os.path.relpath(self.getExtractpath(package), self.prefix))
+      if self.manifest is not None:
+        self.manifest.extracted(key, package, extraction)
+      self.index.add(self.getExtractpath(package))
       return True
     else:
-      print "  ERROR: cannot properly run the following command:"
-      print '  curl -s', filename, ' | tar', opts, '-C', self.prefix, '-f', '-'
-      print stderr
-      if len(stdout.strip()) != 0:
-        tarprefix = sorted(stdout.strip().split('\n'))[0]
-        tarprefix = os.path.join(self.prefix, tarprefix)
+      print "  ERROR: cannot extract", filename, "into", root
+      print " ", error
+      if staging is not None:
+        self.staging.discard(staging)
+        if self.manifest is not None:
+          # nothing reached the prefix, only the partial file list is dropped
+          self.manifest.forget(key)
+        if extraction is None or extraction.first is None:
+          if self.nightly or self.limited:
+            print "Nothing has been extracted. Probably file not found. anyway let's move on"
+            return False
+        print "  FAILED. The installation directory has not been modified."
+        raise RuntimeError(str(error))
+      if self.manifest is not None:
+        print "  Revert changes using the file list in", self.manifest.directory
+        self.manifest.rollback(key, self.getExtractpath(package))
+        self.index.remove(self.getExtractpath(package))
+        if extraction is None or extraction.first is None:
+          if self.nightly or self.limited:
+            print "Nothing has been extracted. Probably file not found. anyway let's move on"
+            return False
+        raise RuntimeError(str(error))
+      if extraction is not None and extraction.first is not None:
+        tarprefix = os.path.join(self.prefix, extraction.first)
         print "  Try to revert changes: rm -rf {0}".format(tarprefix)
         try:
-          if tarprefix != "":
+          if os.path.isdir(tarprefix) and not os.path.islink(tarprefix):
             shutil.rmtree(tarprefix)
+          elif os.path.lexists(tarprefix):
+            os.unlink(tarprefix)
+          self.index.remove(tarprefix)
           print "  FAILED. But installation directory should be clean."
         except:
           print "  ERROR: cannot remove " + tarprefix
-        raise RuntimeError(stderr)
+        raise RuntimeError(str(error))
       else:
 #        if self.nightly  or "rootext" in self.lcgversion:
         if self.nightly or self.limited:
           print "Nothing has been extracted. Probably file not found. anyway let's move on"
+          return False
         else :
           raise RuntimeError("Error during extraction.")
 
-  def isInstalled(self, package):
+  def unTARFromQueue(self, package):
+    # extracted by a worker of the shared queue (or here while waiting for it)
+    filename = os.path.join(self.releaseurl, package.getPackageFilename())
+    key = packageKey(package)
+    with self.report.phase('queue', key):
+      state, result = self.queue.wait(key, self.cache, self.throttle)
+    if state == 'failed':
+      print "  ERROR: cannot extract", filename
+      print " ", result
+      self.queue.forget(key)
+      if self.nightly or self.limited:
+        print "Nothing has been installed. anyway let's move on"
+        return False
+      raise RuntimeError(result)
+    extraction = extractionFromResult(result)
+    self.report.update(key, files=extraction.files, bytes=extraction.bytes, downloaded=extraction.downloaded,
+      cached=extraction.cached)
+    print "  Extracted on", result['host']
+    self.printExtraction(filename, extraction)
+    staged = self.queue.path('done', key)
+    self.removeUnmatched(staged, package)
+    if self.manifest is not None:
+      listing = self.manifest.begin(key)
+      with open(self.queue.path('done', key + '.files')) as f:
+        shutil.copyfileobj(f, listing)
+    with self.report.phase('commit', key):
+      self.staging.commit(staged, os.path.relpath(self.getExtractpath(package), self.prefix))
+    if self.manifest is not None:
+      self.manifest.extracted(key, package, extraction)
+    self.queue.forget(key)
+    self.index.add(self.getExtractpath(package))
+    return True
+
+  def enqueue(self, force=()):
+    # queue the packages to extract, with the same decisions as installPackage()
+    for package in self.getInstallOrder():
+      key = packageKey(package)
+      forced = package.getName() in force
+      if self.delta is not None and self.delta.isCarried(package):
+        continue
+      phase = self.manifest.phase(key) if self.manifest is not None else None
+      if phase in ('extracted', 'postinstalled') and not forced:
+        continue
+      if not forced and self.isInstalled(package):
+        continue
+      self.queue.put(key, {'url': os.path.join(self.releaseurl, package.getPackageFilename()),
+                           'transform': self.getTransform(package)})
+      self.queued.add(key)
+    print "Queued {0} of {1} packages in {2}".format(len(self.queued), len(self.packages), self.queue.directory)
+
+  def getExtractpath(self, package):
+    # where unTAR() puts the package: nightly tarballs are not transformed
     if self.nightly :
-      installpath = os.path.join(self.basepath, package.getModifiedInstallPath())
-    else :
-      installpath = os.path.join(self.prefix, package.getModifiedInstallPath())
+      return os.path.join(self.prefix, package.getInstallPath())
+    return os.path.join(self.prefix, package.getModifiedInstallPath())
+
+  def isRecorded(self, package):
+    # installed according to the manifest, and still in the prefix
+    if self.manifest is None or not self.manifest.isInstalled(packageKey(package)):
+      return False
+    return self.exists(self.getExtractpath(package)) or self.exists(self.getInstalledPath(package))
+
+  def isInstalled(self, package):
+    if self.manifest is not None:
+      key = packageKey(package)
+      if self.isRecorded(package):
+        return True
+      if self.manifest.isIncomplete(key):
+        return False
+    installpath = self.getInstalledPath(package)
     print "  Checking that {0} exists".format(installpath)
-    return os.path.exists(installpath)
+    return self.exists(installpath)
+
+  def getInstalledPath(self, package):
+    # where isInstalled() looks for the package
+    if self.nightly :
+      return os.path.join(self.basepath, package.getModifiedInstallPath())
+    return os.path.join(self.prefix, package.getModifiedInstallPath())
 
   def getPackages(self):
     return self.packages
 
+  def getDependencies(self, package):
+    # DEPENDS entries are 'name-hash'; fall back to the bare name
+    deps = []
+    for dep in package.dependencies:
+      dep = dep.strip()
+      p = self.packageindex.get(dep) or self.packageindex.get(dep.rsplit('-', 1)[0])
+      if p is not None and p is not package and p not in deps:
+        deps.append(p)
+    return deps
+
+  def getInstallOrder(self):
+    # packages after their dependencies, otherwise in description order
+    order = []
+    done = set()
+    remaining = list(self.packages)
+    while remaining:
+      ready = [p for p in remaining if all([d in done for d in self.getDependencies(p)])]
+      if not ready:
+        raise RuntimeError("Circular dependencies between: " + ", ".join([p.getName() for p in remaining]))
+      for p in ready:
+        order.append(p)
+        done.add(p)
+      remaining = [p for p in remaining if p not in done]
+    return order
+
 # Specific installation details for Nighties
 class InstallNightlyProcess(InstallProcess):
   def getLinkpath(self,package):
       return self.prefix + "/" + package.getInstallPath()
+  def getLinkroot(self):
+      # links live next to the packages extracted in the prefix
+      return self.prefix, False
   def getDatapath(self,package):
       return os.path.join(self.basepath, package.getModifiedInstallPath())
   def getPostinstallFile(self,package):
@@ -351,6 +734,8 @@ class InstallNightlyProcess(InstallProcess):
 class InstallReleaseProcess(InstallProcess):
   def getLinkpath(self,package):
       return os.path.join(self.prefix, str(self.lcgversion), package.getInstallPath())
+  def getLinkroot(self):
+      return os.path.join(self.prefix, str(self.lcgversion)), True
   def getDatapath(self,package):
       return os.path.join(self.prefix, package.getModifiedInstallPath())
   def getPostinstallFile(self,package):
@@ -363,6 +748,145 @@ class InstallLimitedProcess(InstallReleaseProcess):
   def getType(self):
       return "Limited Installation"
 
+class ThreadOutput(object):
+  """Replacement for sys.stdout that holds back what a worker thread prints
+  until its package is done, so that the logs of packages installed in
+  parallel do not interleave."""
+
+  def __init__(self, stream):
+    self.stream = stream
+    self.lock = threading.Lock()
+    self.local = threading.local()
+
+  def begin(self):
+    self.local.buffer = []
+
+  def end(self):
+    buf = getattr(self.local, 'buffer', None)
+    self.local.buffer = None
+    if buf:
+      with self.lock:
+        self.stream.write(''.join(buf))
+        self.stream.flush()
+
+  def write(self, data):
+    buf = getattr(self.local, 'buffer', None)
+    if buf is not None:
+      buf.append(data)
+    else:
+      with self.lock:
+        self.stream.write(data)
+
+  def flush(self):
+    with self.lock:
+      self.stream.flush()
+
+  def __getattr__(self, name):
+    return getattr(self.stream, name)
+
+
+class InstallScheduler(object):
+  """Install the packages of a release on a pool of worker threads.
+
+  A package is only started once every package it depends on is installed
+  and linked, so its .post-install.sh always finds its dependencies."""
+
+  def __init__(self, installation, jobs, force=()):
+    self.installation = installation
+    self.jobs = max(1, jobs)
+    self.force = force
+    self.packages = installation.getPackages()
+    self.waiting = {}
+    self.dependents = dict((p, []) for p in self.packages)
+    for p in self.packages:
+      deps = installation.getDependencies(p)
+      self.waiting[p] = len(deps)
+      for dep in deps:
+        self.dependents[dep].append(p)
+    self.ready = [p for p in self.packages if self.waiting[p] == 0]
+    self.started = 0
+    self.running = 0
+    self.finished = 0
+    self.failed = []
+    self.stopped = False
+    self.cond = threading.Condition()
+    self.output = None
+
+  def nextPackage(self):
+    with self.cond:
+      while True:
+        if self.failed or self.stopped:
+          return None, 0
+        if self.ready:
+          self.running += 1
+          self.started += 1
+          return self.ready.pop(0), self.started
+        if self.running == 0:
+          return None, 0
+        self.cond.wait()
+
+  def finishPackage(self, package, ok):
+    with self.cond:
+      self.running -= 1
+      if ok:
+        self.finished += 1
+        for p in self.dependents[package]:
+          self.waiting[p] -= 1
+          if self.waiting[p] == 0:
+            self.ready.append(p)
+      else:
+        self.failed.append(package)
+      self.cond.notify_all()
+
+  def worker(self):
+    while True:
+      package, idx = self.nextPackage()
+      if package is None:
+        return
+      self.output.begin()
+      ok = False
+      try:
+        print "[{0:03d} / {1:03d}] Start installation process for ".format(idx, len(self.packages)), package.getName()
+        force = package.getName() in self.force
+        if force:
+          print "  Force reinstalling has been requested"
+        self.installation.install(package, force=force)
+        print "Finished."
+        ok = True
+      except Exception as e:
+        print "  ERROR: installation of {0} failed: {1}".format(package.getName(), e)
+      finally:
+        try:
+          self.output.end()
+        finally:
+          self.finishPackage(package, ok)
+
+  def run(self):
+    stdout = sys.stdout
+    self.output = sys.stdout = ThreadOutput(stdout)
+    try:
+      threads = [threading.Thread(target=self.worker) for i in range(self.jobs)]
+      for t in threads:
+        t.daemon = True
+        t.start()
+      for t in threads:
+        while t.is_alive():
+          t.join(1)
+    finally:
+      # also when interrupted: the workers finish their package and stop,
+      # printing to the original stdout
+      with self.cond:
+        self.stopped = True
+        self.cond.notify_all()
+      sys.stdout = stdout
+    if self.failed:
+      raise RuntimeError("Installation failed for: " + ", ".join([p.getName() for p in self.failed]))
+    if self.finished != len(self.packages):
+      blocked = [p.getName() for p in self.packages if self.waiting[p] > 0]
+      raise RuntimeError("Circular dependencies between: " + ", ".join(blocked))
+    return True
+
+
 def main():
   parser = argparse.ArgumentParser()
   parser.add_argument('-d', '--description', help="Description name", default='', dest='description')
@@ -375,17 +899,113 @@ def main():
   parser.add_argument('-n', '--dry-run', help="Be pacific, don't do anything", default=False, action='store_true',
     dest='dryrun')
   parser.add_argument('-l', '--list', help="Just list packages", default=False, action='store_true', dest='justlist')
+  parser.add_argument('--plan', help="Write the installation plan as JSON to the given file and exit (implies --dry-run)", default=None, dest='plan')
+  parser.add_argument('--verify', help="Check the installed packages against their tarballs and exit", default=False, action='store_true', dest='verify')
+  parser.add_argument('--verify-report', help="Write the result of --verify as JSON to the given file", default=None, dest='verifyreport')
   parser.add_argument('-y', '--nightly', help="Install as nightly", default=False, action='store_true', dest='nightly')
   parser.add_argument('-e', '--endsystem', help="installation in CVMFS, EOS or AFS", default='CVMFS', dest='endsystem')
   parser.add_argument('--update', help="Force to update existing links", default=False, action='store_true', dest='updatelinks')
+  parser.add_argument('--link-farm', help="Create the links of all packages at once after installing, swapping the links of each package atomically", default=False, action='store_true', dest='linkfarm')
+  parser.add_argument('--in-place', help="Extract directly into the prefix instead of a staging directory moved in place once complete", default=False, action='store_true', dest='inplace')
+  parser.add_argument('--dedup', help="Replace files identical to ones of other installed packages by hard links to a store in the given directory (same file system as the prefix)", default=None, dest='dedup')
+  parser.add_argument('--dedup-prune', help="Remove the files of the dedup store no package links to anymore", default=False, action='store_true', dest='dedupprune')
+  parser.add_argument('--delta', help="Only install what changed since the description installed last time in the prefix", default=False, action='store_true', dest='delta')
+  parser.add_argument('--previous', help="Previous description to compute the delta from (implies --delta)", default=None, dest='previous')
+  parser.add_argument('--queue', help="Share the extractions with the workers (--worker) of the given queue directory, on shared storage", default=None, dest='queue')
+  parser.add_argument('--worker', help="Extract the packages queued in the given queue directory until the installation is over", default=None, dest='worker')
   parser.add_argument('-o', '--other', help="Installation of limited amount of packages, to be used by rootext or geantv", default=False, action='store_true', dest='limited')
+  parser.add_argument('-j', '--jobs', help="Number of packages installed in parallel", default=1, type=int, dest='jobs')
+  parser.add_argument('--cache', help="Directory of the local cache of tarballs and release descriptions (disabled by default)", default=None, dest='cache')
+  parser.add_argument('--cache-size', help="Maximum size of the tarball cache in GB", default=None, type=float, dest='cachesize')
+  parser.add_argument('--manifest-dir', help="Directory of the install manifest and journal (default: PREFIX/.lcginstall)", default=None, dest='manifestdir')
+  parser.add_argument('--no-manifest', help="Do not record installed packages in a manifest", default=False, action='store_true', dest='nomanifest')
+  parser.add_argument('--index', help="File keeping the index of the installed directories between runs", default=None, dest='index')
+  parser.add_argument('--report', help="Write timings of each phase and package as JSON to the given file", default=None, dest='report')
+  parser.add_argument('--max-extractions', help="Maximum number of extractions running at once on this host, over all installer processes", default=None, type=int, dest='maxextractions')
+  parser.add_argument('--max-bandwidth', help="Maximum download bandwidth in MB/s, over all installer processes on this host", default=None, type=float, dest='maxbandwidth')
+  parser.add_argument('--max-write-rate', help="Maximum rate of extracted data in MB/s, over all installer processes on this host", default=None, type=float, dest='maxwriterate')
+  parser.add_argument('--throttle-dir', help="Directory shared by the installer processes to enforce the limits", default=THROTTLE_DIRECTORY, dest='throttledir')
 
   args = parser.parse_args()
 
   args.prefix = os.path.abspath(args.prefix)
+  if args.plan or args.verify:
+    args.dryrun = True
   # def __init__(self, releaseurl = 'http://lcgpackages.cern.ch/tarFiles/releases', description, prefix = '.', lcgversion = 'test'):
 
+  report = RunReport()
+  try:
+    runInstallation(args, report)
+    report.finish()
+  except SystemExit:
+    report.finish()
+    raise
+  except Exception as e:
+    report.finish(str(e))
+    raise
+  finally:
+    if args.report:
+      report.write(args.report)
+      print "Run report written to", args.report
+
+
+def runInstallation(args, report):
   # Check the installation type to execute
+  cache = None
+  metadata = None
+  if args.cache:
+    maxsize = int(args.cachesize * 1024 ** 3) if args.cachesize else None
+    cache = TarballCache(args.cache, maxsize)
+    metadata = MetadataCache(os.path.join(args.cache, '.metadata'))
+
+  throttle = None
+  if args.maxextractions or args.maxbandwidth or args.maxwriterate:
+    throttle = Throttle(args.throttledir,
+                        extractions=args.maxextractions,
+                        bandwidth=args.maxbandwidth * 1e6 if args.maxbandwidth else None,
+                        writerate=args.maxwriterate * 1e6 if args.maxwriterate else None)
+
+  if args.worker:
+    runWorker(WorkQueue(args.worker), cache, throttle)
+    sys.exit(0)
+
+  staging = None
+  if not args.inplace and not args.dryrun and not args.justlist and args.description != '':
+    staging = StagingArea(args.prefix)
+
+  queue = None
+  if args.queue and not args.dryrun and not args.justlist and args.description != '':
+    if staging is None:
+      raise RuntimeError("Installing from a shared queue needs a staging area, it cannot be done --in-place")
+    queue = WorkQueue(args.queue)
+    queue.reopen()
+
+  index = PathIndex(args.index)
+
+  dedup = None
+  if args.dedup and not args.dryrun:
+    dedup = DedupStore(args.dedup)
+
+  manifest = None
+  if not args.nomanifest and not args.justlist and args.description != '':
+    manifestdir = args.manifestdir or os.path.join(args.prefix, '.lcginstall')
+    # a dry run only reads an existing manifest
+    if not args.dryrun or os.path.isdir(manifestdir):
+      manifest = InstallManifest(args.prefix, args.manifestdir)
+
+  previous = None
+  previouspath = os.path.join(args.prefix, '.lcginstall-previous', args.description)
+  if args.previous and '://' in args.previous:
+    previous = InstallProcess.getDescContent(args.previous)
+  elif args.previous:
+    previous = readPrevious(args.previous)
+    if previous is None:
+      raise RuntimeError("Previous description {0} not found".format(args.previous))
+  elif args.delta and args.description != '':
+    previous = readPrevious(previouspath)
+    if previous is None:
+      print "No description installed before in", args.prefix, "- full installation"
+
   installType = None
 #  if "rootext" in args.releasever:
   if args.limited:
@@ -400,10 +1020,21 @@ def main():
                              args.prefix,
                              args.releasever,
                              updatelinks=args.updatelinks,
-                             nocheck=args.justlist,
+                             nocheck=args.justlist or args.plan or args.verify,
                              nightly=args.nightly,
                              limited=args.limited,
-                             endsystem=args.endsystem)
+                             endsystem=args.endsystem,
+                             options=InstallOptions(cache=cache,
+                                                    manifest=manifest,
+                                                    metadata=metadata,
+                                                    linkfarm=args.linkfarm,
+                                                    report=report,
+                                                    throttle=throttle,
+                                                    staging=staging,
+                                                    index=index,
+                                                    dedup=dedup,
+                                                    previous=previous,
+                                                    queue=queue))
 
   if args.description == '':
     print "List of available releases in {0}:".format(args.releaseurl)
@@ -415,19 +1046,88 @@ def main():
     print "\n".join([x.getName() for x in installation.getPackages()])
     sys.exit(0)
 
+  if args.plan:
+    plan = makePlan(installation)
+    writePlan(plan, args.plan)
+    totals = plan['totals']
+    print "Plan written to", args.plan
+    print "  {0} to install ({1} bytes to download), {2} to link, {3} to skip, {4} missing".format(totals['install'],
+      totals['download_bytes'], totals['link'], totals['skip'], totals['missing'])
+    if plan['estimated_seconds'] is not None:
+      print "  Estimated duration: {0:.0f}s at {1:.1f} MB/s".format(plan['estimated_seconds'], plan['throughput'] / 1e6)
+    if plan['nothing_to_do']:
+      print "  Nothing to do."
+    sys.exit(0)
+
+  if args.verify:
+    with report.phase('verify'):
+      results = verifyRelease(installation, args.jobs if args.jobs > 1 else None)
+    failed = 0
+    for result in results:
+      if result['error'] is not None:
+        print "{0}: ERROR {1}".format(result['package'], result['error'])
+      elif result['problems']:
+        problems = {}
+        for path, problem in result['problems']:
+          problems[problem] = problems.get(problem, 0) + 1
+        print "{0}: {1}".format(result['package'], ', '.join(['{0} {1}'.format(n, x) for x, n in sorted(problems.items())]))
+        for path, problem in result['problems'][:5]:
+          print "  {0:8} {1}".format(problem, path)
+        if len(result['problems']) > 5:
+          print "  ..."
+      else:
+        continue
+      failed += 1
+    print "Verified {0} packages, {1} files, {2} bytes: {3} with problems".format(len(results),
+      sum([r['files'] for r in results]), sum([r['bytes'] for r in results]), failed)
+    if args.verifyreport:
+      writeVerification(results, args.verifyreport)
+    sys.exit(1 if failed else 0)
+
+  packages = installation.getPackages()
+  if queue is not None:
+    installation.enqueue(args.force)
+    # extracted anywhere, finished here in dependency order
+    packages = installation.getInstallOrder()
+
   idx = 1
-  for package in installation.getPackages():
-    if not args.dryrun:
-      print "[{0:03d} / {1:03d}] Start installation process for ".format(idx,
-        len(installation.getPackages())), package.getName()
-      force = package.getName() in args.force
-      if force:
-        print "  Force reinstalling has been requested"
-      installation.install(package, force=force)
-      print "Finished."
+  try:
+    if args.jobs > 1 and not args.dryrun:
+      InstallScheduler(installation, args.jobs, args.force).run()
+    else:
+      for package in packages:
+        if not args.dryrun:
+          print "[{0:03d} / {1:03d}] Start installation process for ".format(idx,
+            len(installation.getPackages())), package.getName()
+          force = package.getName() in args.force
+          if force:
+            print "  Force reinstalling has been requested"
+          installation.install(package, force=force)
+          print "Finished."
+        else:
+          state = "installed" if installation.isInstalled(package) else "to install"
+          print "Installing", package.getName(), ": DRY RUN ({0})".format(state)
+        idx += 1
+  finally:
+    if queue is not None:
+      # lets the workers exit
+      queue.close()
+    if staging is not None:
+      staging.close()
+  if args.linkfarm and not args.dryrun:
+    installation.createLinkFarm()
+  if installation.delta is not None and not args.dryrun:
+    if installation.failed:
+      print "Outdated builds kept: {0} packages were not installed".format(len(installation.failed))
     else:
-      print "Installing", package.getName(), ": DRY RUN"
-    idx += 1
+      installation.removeOutdated()
+  index.save()
+  if (args.delta or args.previous) and not args.dryrun:
+    savePrevious(previouspath, installation.descriptiontext)
+  if dedup is not None:
+    if args.dedupprune:
+      print "Removed {0} bytes of unused files from {1}".format(dedup.prune(), dedup.directory)
+    dedup.close()
   # gcc installation
   compiler = set([x.compiler for x in installation.packages])
   if len(compiler) == 0:
@@ -450,9 +1150,9 @@ def main():
     fstype = None
   if "ubuntu" not in args.description and "clang" not in args.description:
     compilerpath = getCompilerPath(compilerversion, compilerplatform, fstype)
-    if not os.path.exists(os.path.join(args.prefix, 'gcc', compilerversion, compilerplatform)):
+    if not installation.exists(os.path.join(args.prefix, 'gcc', compilerversion, compilerplatform)):
       installation.createLinks(compilerpath, os.path.join(args.prefix, 'gcc', compilerversion, compilerplatform), False)
-      if not os.path.exists(os.path.join(args.prefix, 'LCG_' + str(args.releasever), 'gcc', compilerversion, compilerplatform)):
+      if not installation.exists(os.path.join(args.prefix, 'LCG_' + str(args.releasever), 'gcc', compilerversion, compilerplatform)):
         installation.createLinks(compilerpath,
                                  os.path.join(args.prefix, "LCG_" + str(args.releasever), 'gcc', compilerversion, compilerplatform), False)
 
@@ -0,0 +1,240 @@
+"""Bulk creation of the symbolic link trees of a release."""
+
+import os
+import sys
+import stat
+import errno
+import ctypes
+import shutil
+
+from lcgfetch import listDirectory
+
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+
+
+def _fsencode(path):
+  if isinstance(path, bytes):
+    return path
+  return path.encode(sys.getfilesystemencoding() or 'utf-8')
+
+
+def exchange(a, b):
+  """Atomically swap the paths a and b (Linux renameat2 with
+  RENAME_EXCHANGE). Returns False when not supported."""
+  try:
+    renameat2 = ctypes.CDLL(None, use_errno=True).renameat2
+  except AttributeError:
+    return False
+  if renameat2(AT_FDCWD, _fsencode(a), AT_FDCWD, _fsencode(b), RENAME_EXCHANGE) == 0:
+    return True
+  err = ctypes.get_errno()
+  if err in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.EXDEV):
+    return False
+  raise OSError(err, os.strerror(err), b)
+
+
+def scanTree(root, dirs=None):
+  """Return {relative path: (kind, link target)} for what is below root,
+  kind being 'dir', 'link' or 'file'. Symbolic links are not followed.
+  With dirs, only those directories (relative to root) are listed."""
+  tree = {}
+  if dirs is None:
+    stack = ['']
+  else:
+    stack = list(dirs)
+  while stack:
+    rel = stack.pop()
+    path = os.path.join(root, rel)
+    try:
+      entries = list(listDirectory(path))
+    except OSError as e:
+      if e.errno in (errno.ENOENT, errno.ENOTDIR):
+        continue
+      raise
+    for name, isdir, isfile in entries:
+      relname = os.path.join(rel, name)
+      if isdir:
+        tree[relname] = ('dir', None)
+        if dirs is None:
+          stack.append(relname)
+      elif isfile:
+        tree[relname] = ('file', None)
+      else:
+        fullname = os.path.join(root, relname)
+        if stat.S_ISLNK(os.lstat(fullname).st_mode):
+          tree[relname] = ('link', os.readlink(fullname))
+        else:
+          tree[relname] = ('file', None)
+  return tree
+
+
+class LinkFarm(object):
+
+  def __init__(self, root, updatelinks=False):
+    self.root = os.path.abspath(root)
+    self.updatelinks = updatelinks
+    self.links = {}
+
+  def add(self, datapath, linkpath, relative=True):
+    linkpath = os.path.abspath(linkpath).rstrip('/')
+    datapath = datapath.rstrip('/')
+    rel = os.path.relpath(linkpath, self.root)
+    if rel.startswith(os.pardir):
+      raise RuntimeError("Link {0} outside of {1}".format(linkpath, self.root))
+    if relative:
+      datapath = os.path.relpath(datapath, os.path.dirname(linkpath))
+    self.links[rel] = datapath
+
+  def diff(self, tree):
+    """Compare the wanted links with tree (as returned by scanTree).
+
+    Returns four sorted lists of relative paths: links to create, links to
+    point elsewhere, links already right, and paths taken by something
+    else than a link."""
+    create, update, unchanged, conflicts = [], [], [], []
+    for rel in sorted(self.links):
+      kind, target = tree.get(rel, (None, None))
+      parents = self._parents(rel)
+      if any([tree.get(p, ('dir', None))[0] != 'dir' for p in parents]):
+        conflicts.append(rel)
+      elif kind is None:
+        create.append(rel)
+      elif kind != 'link':
+        conflicts.append(rel)
+      elif target == self.links[rel]:
+        unchanged.append(rel)
+      elif self.updatelinks:
+        update.append(rel)
+      else:
+        unchanged.append(rel)
+    return create, update, unchanged, conflicts
+
+  @staticmethod
+  def _parents(rel):
+    parents = []
+    rel = os.path.dirname(rel)
+    while rel:
+      parents.append(rel)
+      rel = os.path.dirname(rel)
+    return parents
+
+  def build(self, atomic=True):
+    """Create and update the links, returning the diff that was applied.
+
+    atomic rebuilds the changed subtrees next to the current ones and
+    exchanges them, each package at once but not all the packages at once;
+    otherwise changes are made in place, each link replaced by a rename."""
+    if atomic:
+      tree = scanTree(self.root)
+    else:
+      dirs = set([''])
+      for rel in self.links:
+        dirs.update(self._parents(rel))
+      tree = scanTree(self.root, dirs)
+    create, update, unchanged, conflicts = result = self.diff(tree)
+    if not create and not update:
+      return result
+    if atomic:
+      self._rebuild(tree, create + update)
+    else:
+      self._inplace(tree, create, update)
+    return result
+
+  def _makedirs(self, base, tree, rels):
+    made = set()
+    for rel in rels:
+      for parent in reversed(self._parents(rel)):
+        if parent in made or tree.get(parent, (None, None))[0] == 'dir':
+          continue
+        os.mkdir(os.path.join(base, parent))
+        made.add(parent)
+
+  def _inplace(self, tree, create, update):
+    if not os.path.isdir(self.root):
+      os.makedirs(self.root)
+    self._makedirs(self.root, tree, create)
+    for rel in create:
+      os.symlink(self.links[rel], os.path.join(self.root, rel))
+    for rel in update:
+      path = os.path.join(self.root, rel)
+      tmp = os.path.join(os.path.dirname(path), '.{0}.new'.format(os.path.basename(path)))
+      if os.path.lexists(tmp):
+        os.unlink(tmp)
+      os.symlink(self.links[rel], tmp)
+      os.rename(tmp, path)
+
+  def _rebuild(self, tree, changed):
+    if not os.path.lexists(self.root):
+      parent, name = os.path.split(self.root)
+      staging = self._stage(os.path.join(parent, '.{0}.new'.format(name)), '', tree, set(changed))
+      os.rename(staging, self.root)
+      return
+    # links right below the root are replaced one by one, each with a rename
+    self._inplace(tree, [rel for rel in changed if os.sep not in rel and rel not in tree],
+                  [rel for rel in changed if os.sep not in rel and rel in tree])
+    subtrees = {}
+    for rel in changed:
+      if os.sep in rel:
+        subtrees.setdefault(rel.split(os.sep, 1)[0], set()).add(rel)
+    for top in sorted(subtrees):
+      staging = self._stage(os.path.join(self.root, '.{0}.new'.format(top)), top, tree, subtrees[top])
+      self._swap(staging, os.path.join(self.root, top), tree, subtrees[top])
+
+  def _stage(self, staging, top, tree, changed):
+    """Create at staging a copy of the subtree top of tree ('' for the
+    whole tree), with the changed links pointing to their new target"""
+    def local(rel):
+      return os.path.join(staging, rel[len(top) + 1:] if top else rel)
+    if os.path.lexists(staging):
+      shutil.rmtree(staging)
+    os.mkdir(staging)
+    current = os.path.join(self.root, top) if top else self.root
+    if os.path.isdir(current):
+      shutil.copymode(current, staging)
+    # replicate the current subtree, without following links: files are hard linked
+    for rel in sorted(tree):
+      if top and not rel.startswith(top + os.sep):
+        continue
+      kind, target = tree[rel]
+      path = local(rel)
+      if kind == 'dir':
+        os.mkdir(path)
+      elif kind == 'link':
+        os.symlink(self.links[rel] if rel in changed else target, path)
+      else:
+        os.link(os.path.join(self.root, rel), path)
+    made = set([top])
+    for rel in sorted(changed):
+      for parent in reversed(self._parents(rel)):
+        if parent in made or tree.get(parent, (None, None))[0] == 'dir':
+          continue
+        os.mkdir(local(parent))
+        made.add(parent)
+      if rel not in tree:
+        os.symlink(self.links[rel], local(rel))
+    return staging
+
+  def _swap(self, staging, path, tree, changed):
+    """Put the subtree built at staging in place of path"""
+    if not os.path.lexists(path):
+      os.rename(staging, path)
+      return
+    if exchange(staging, path):
+      shutil.rmtree(staging)
+      return
+    old = staging[:-len('.new')] + '.old'
+    if os.path.lexists(old):
+      shutil.rmtree(old)
+    try:
+      os.rename(path, old)
+    except OSError as e:
+      if e.errno != errno.EXDEV:
+        raise
+      # directories of a lower layer (overlay/union file systems) cannot be renamed
+      shutil.rmtree(staging)
+      self._inplace(tree, sorted([rel for rel in changed if rel not in tree]),
+                    sorted([rel for rel in changed if rel in tree]))
+      return
+    os.rename(staging, path)
+    shutil.rmtree(old)
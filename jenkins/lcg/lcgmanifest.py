@@ -0,0 +1,190 @@
+"""Install manifest and journal of an installation prefix."""
+
+import os
+import json
+import time
+import errno
+import shutil
+import tempfile
+import threading
+
+PHASES = ('extracting', 'extracted', 'postinstalled', 'installed')
+
+
+def packageKey(package):
+  return package.getPackageFilename()[:-len('.tgz')]
+
+
+class InstallManifest(object):
+  """Journal of the phases of each package (<directory>/journal) and its
+  records (records/<key>.json) and file lists (records/<key>.files)"""
+
+  def __init__(self, prefix, directory=None):
+    self.prefix = prefix
+    self.directory = directory or os.path.join(prefix, '.lcginstall')
+    self.recorddir = os.path.join(self.directory, 'records')
+    self.journalpath = os.path.join(self.directory, 'journal')
+    self.lock = threading.Lock()
+    self.state = {}
+    self.listings = {}
+    if not os.path.isdir(self.recorddir):
+      os.makedirs(self.recorddir)
+    self._replay()
+    self.journal = open(self.journalpath, 'a')
+
+  def _replay(self):
+    lines = 0
+    try:
+      with open(self.journalpath) as f:
+        for line in f:
+          lines += 1
+          try:
+            phase, key = line.split()
+          except ValueError:
+            # torn last line of an interrupted run
+            continue
+          if phase == 'removed':
+            self.state.pop(key, None)
+          else:
+            self.state[key] = phase
+    except IOError as e:
+      if e.errno != errno.ENOENT:
+        raise
+    if lines > 2 * len(self.state) + 100:
+      self._compact()
+
+  def _compact(self):
+    fd, tmp = tempfile.mkstemp(prefix='.journal-', dir=self.directory)
+    with os.fdopen(fd, 'w') as f:
+      for key in sorted(self.state):
+        f.write('{0} {1}\n'.format(self.state[key], key))
+      f.flush()
+      os.fsync(f.fileno())
+    os.rename(tmp, self.journalpath)
+
+  def _log(self, phase, key):
+    with self.lock:
+      self.journal.write('{0} {1}\n'.format(phase, key))
+      self.journal.flush()
+      os.fsync(self.journal.fileno())
+      if phase == 'removed':
+        self.state.pop(key, None)
+      else:
+        self.state[key] = phase
+
+  def close(self):
+    self.journal.close()
+
+  def phase(self, key):
+    return self.state.get(key)
+
+  def isInstalled(self, key):
+    return self.state.get(key) == 'installed'
+
+  def isIncomplete(self, key):
+    return self.state.get(key) in PHASES[:-1]
+
+  def _path(self, key, ext):
+    return os.path.join(self.recorddir, key + ext)
+
+  def begin(self, key):
+    """Start the extraction of key, returning the file its members are listed to"""
+    self._log('extracting', key)
+    listing = open(self._path(key, '.files'), 'w')
+    with self.lock:
+      self.listings[key] = listing
+    return listing
+
+  def extracted(self, key, package, extraction):
+    with self.lock:
+      listing = self.listings.pop(key)
+    listing.flush()
+    os.fsync(listing.fileno())
+    listing.close()
+    record = {'name': package.name,
+              'version': package.version,
+              'hash': package.hashstr,
+              'platform': package.platform,
+              'directory': package.directory,
+              'tarball': package.getPackageFilename(),
+              'sha256': extraction.sha256,
+              'files': extraction.files,
+              'size': extraction.bytes,
+              'downloaded': extraction.downloaded,
+              'cached': extraction.cached,
+              'seconds': extraction.seconds,
+              'time': time.time()}
+    fd, tmp = tempfile.mkstemp(prefix='.record-', dir=self.recorddir)
+    with os.fdopen(fd, 'w') as f:
+      json.dump(record, f, indent=1, sort_keys=True)
+    os.rename(tmp, self._path(key, '.json'))
+    self._log('extracted', key)
+
+  def postinstalled(self, key):
+    self._log('postinstalled', key)
+
+  def installed(self, key):
+    self._log('installed', key)
+
+  def record(self, key):
+    try:
+      with open(self._path(key, '.json')) as f:
+        return json.load(f)
+    except IOError:
+      return None
+
+  def records(self):
+    """Return the records of all the packages fully installed in the prefix"""
+    return dict((key, self.record(key)) for key in self.state if self.state[key] == 'installed')
+
+  def files(self, key):
+    try:
+      with open(self._path(key, '.files')) as f:
+        return [line.rstrip('\n') for line in f if line.strip()]
+    except IOError:
+      return []
+
+  def rollback(self, key, installpath=None):
+    """Remove everything recorded for key from the prefix.
+
+    Files and links are removed first, then the directories that became
+    empty, deepest first, so directories shared with other packages stay.
+    installpath, the directory owned by the package alone, is removed
+    whole to also catch files created by its post-install script."""
+    with self.lock:
+      listing = self.listings.pop(key, None)
+    if listing is not None:
+      listing.close()
+    dirs = []
+    for name in self.files(key):
+      path = os.path.join(self.prefix, name)
+      if os.path.isdir(path) and not os.path.islink(path):
+        dirs.append(path)
+        continue
+      try:
+        os.unlink(path)
+      except OSError as e:
+        if e.errno != errno.ENOENT:
+          raise
+    if installpath is not None and os.path.isdir(installpath):
+      shutil.rmtree(installpath)
+    for path in sorted(dirs, key=len, reverse=True):
+      try:
+        os.rmdir(path)
+      except OSError as e:
+        if e.errno not in (errno.ENOENT, errno.ENOTEMPTY):
+          raise
+    self.forget(key)
+
+  def forget(self, key):
+    """Drop what is recorded for key, leaving the prefix untouched"""
+    with self.lock:
+      listing = self.listings.pop(key, None)
+    if listing is not None:
+      listing.close()
+    for ext in ('.json', '.files'):
+      try:
+        os.unlink(self._path(key, ext))
+      except OSError:
+        pass
+    self._log('removed', key)
@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+"""Local stand-in for the lcgpackages release server."""
+
+import os
+import cgi
+import sys
+import time
+import email.utils
+import random
+import shutil
+import signal
+import socket
+import fnmatch
+import hashlib
+import binascii
+import tarfile
+import argparse
+import tempfile
+import threading
+import BaseHTTPServer
+import SocketServer
+
+PLATFORM = 'x86_64-centos7-gcc8-opt'
+BLOCKSIZE = 64 * 1024
+
+
+class Bandwidth(object):
+  """Token bucket limiting transfers to rate bytes per second"""
+
+  def __init__(self, rate):
+    self.rate = float(rate)
+    self.lock = threading.Lock()
+    self.next = time.time()
+
+  def consume(self, amount):
+    # each caller waits until its share of the link is through
+    with self.lock:
+      now = time.time()
+      self.next = max(self.next, now) + amount / self.rate
+      wait = self.next - now
+    if wait > 0:
+      time.sleep(wait)
+
+
+def generateRelease(directory, count, size=1000, version='96', platform=PLATFORM, seed=0, maxdeps=3):
+  """Write a synthetic release of count packages into directory: tarballs
+  of about size kB each and their description. Returns the description
+  file name."""
+  rng = random.Random(seed)
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+  build = tempfile.mkdtemp(prefix='.build-', dir=directory)
+  lines = ['# Synthetic release generated by lcgmockserver.py']
+  keys = []
+  try:
+    for i in range(count):
+      name = 'pkg{0:04d}'.format(i)
+      pversion = '{0}.{1}'.format(rng.randint(1, 9), rng.randint(0, 20))
+      hashstr = hashlib.sha1('{0}-{1}-{2}'.format(seed, name, pversion).encode('ascii')).hexdigest()[:5]
+      top = os.path.join(build, name, pversion, platform)
+      for sub in ('bin', 'lib', 'share'):
+        os.makedirs(os.path.join(top, sub))
+      with open(os.path.join(top, 'bin', name), 'w') as f:
+        f.write('#!/bin/sh\necho {0} {1}\n'.format(name, pversion))
+      # half random (incompressible), half repeated text, like real builds
+      nbytes = int(rng.uniform(0.5, 1.5) * size * 1024) // 2 * 2
+      with open(os.path.join(top, 'lib', 'lib{0}.so'.format(name)), 'wb') as f:
+        f.write(binascii.unhexlify('%0*x' % (nbytes, rng.getrandbits(nbytes * 4))))
+      with open(os.path.join(top, 'share', 'README'), 'w') as f:
+        f.write(('{0} {1} documentation\n'.format(name, pversion)) * (nbytes // 2 // 30 + 1))
+      with open(os.path.join(top, '.post-install.sh'), 'w') as f:
+        f.write('#!/bin/bash\ntrue\n')
+      tarball = os.path.join(directory, '{0}-{1}_{2}-{3}.tgz'.format(name, pversion, hashstr, platform))
+      tar = tarfile.open(tarball, 'w:gz')
+      try:
+        tar.add(os.path.join(build, name), arcname=name)
+      finally:
+        tar.close()
+      deps = rng.sample(keys, min(len(keys), rng.randint(0, maxdeps)))
+      lines.append('COMPILER: GNU 8.3.0, HOSTNAME: mock, HASH: {0}, DESTINATION: {1}, NAME: {1}, VERSION: {2}, '
+                   'DIRECTORY: {1}, PLATFORM: {3}, DEPENDS: {4}'.format(hashstr, name, pversion, platform,
+                                                                        ','.join(deps)))
+      keys.append('{0}-{1}'.format(name, hashstr))
+  finally:
+    shutil.rmtree(build)
+  description = 'LCG_{0}_{1}.txt'.format(version, platform)
+  with open(os.path.join(directory, description), 'w') as f:
+    f.write('\n'.join(lines) + '\n')
+  return description
+
+
+class MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, format, *args):
+    if not self.server.quiet:
+      BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+  def do_HEAD(self):
+    self.serve(False)
+
+  def do_GET(self):
+    self.serve(True)
+
+  def serve(self, body):
+    server = self.server
+    server.count('requests')
+    delay = server.latency + (server.rng().uniform(0, server.jitter) if server.jitter else 0.)
+    if delay > 0:
+      time.sleep(delay)
+    path = self.path.split('?')[0]
+    relative = os.path.normpath(path.lstrip('/')) if path.strip('/') else ''
+    if relative.startswith(os.pardir):
+      return self.error(403)
+    if server.errorrate and server.rng().random() < server.errorrate:
+      server.count('errors')
+      return self.error(503)
+    if any([fnmatch.fnmatchcase(os.path.basename(relative), x) for x in server.missing]):
+      return self.error(404)
+    fullpath = os.path.join(server.directory, relative)
+    if os.path.isdir(fullpath):
+      return self.listing(path, fullpath, body)
+    if not os.path.isfile(fullpath):
+      return self.error(404)
+    st = os.stat(fullpath)
+    etag = '"{0:x}-{1:x}"'.format(int(st.st_mtime), st.st_size)
+    modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+    if self.headers.get('If-None-Match') == etag or \
+       (self.headers.get('If-None-Match') is None and self.headers.get('If-Modified-Since') == modified):
+      server.count('not_modified')
+      self.send_response(304)
+      self.send_header('ETag', etag)
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+      return
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain' if fullpath.endswith('.txt') else 'application/x-gzip')
+    self.send_header('Content-Length', str(st.st_size))
+    self.send_header('ETag', etag)
+    self.send_header('Last-Modified', modified)
+    self.end_headers()
+    if body:
+      self.send(fullpath, st.st_size)
+
+  def send(self, fullpath, size):
+    server = self.server
+    limit = size
+    if server.truncaterate and server.rng().random() < server.truncaterate:
+      server.count('truncated')
+      limit = size // 2
+    bandwidth = Bandwidth(server.bandwidth) if server.bandwidth else None
+    sent = 0
+    with open(fullpath, 'rb') as f:
+      while sent < limit:
+        data = f.read(min(BLOCKSIZE, limit - sent))
+        if not data:
+          break
+        for bucket in (bandwidth, server.total):
+          if bucket is not None:
+            bucket.consume(len(data))
+        try:
+          self.wfile.write(data)
+        except socket.error:
+          self.close_connection = 1
+          return
+        sent += len(data)
+    server.count('bytes', sent)
+    if sent < size:
+      # the client sees a connection closed before Content-Length bytes
+      self.close_connection = 1
+
+  def listing(self, path, fullpath, body):
+    if not path.endswith('/'):
+      self.send_response(301)
+      self.send_header('Location', path + '/')
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+      return
+    lines = ['<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">',
+             '<html>', ' <head>', '  <title>Index of {0}</title>'.format(cgi.escape(path)), ' </head>', ' <body>',
+             '<h1>Index of {0}</h1>'.format(cgi.escape(path)), '<table>',
+             '<tr><th>Name</th><th>Last modified</th><th>Size</th></tr>',
+             '<tr><td><a href="../">Parent Directory</a></td><td>&nbsp;</td><td align="right">  - </td></tr>']
+    for name in sorted(os.listdir(fullpath)):
+      if name.startswith('.'):
+        continue
+      st = os.stat(os.path.join(fullpath, name))
+      if os.path.isdir(os.path.join(fullpath, name)):
+        name += '/'
+      lines.append('<tr><td><a href="{0}">{1}</a></td><td align="right">{2}  </td><td align="right">{3}</td></tr>'.format(
+        cgi.escape(name, True), cgi.escape(name), time.strftime('%Y-%m-%d %H:%M', time.localtime(st.st_mtime)),
+        '-' if name.endswith('/') else st.st_size))
+    lines += ['</table>', '</body></html>', '']
+    content = '\n'.join(lines).encode('utf-8')
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/html;charset=UTF-8')
+    self.send_header('Content-Length', str(len(content)))
+    self.end_headers()
+    if body:
+      self.wfile.write(content)
+
+  def error(self, code):
+    content = '{0} {1}\n'.format(code, self.responses.get(code, ('',))[0]).encode('ascii')
+    self.send_response(code)
+    self.send_header('Content-Type', 'text/plain')
+    self.send_header('Content-Length', str(len(content)))
+    self.end_headers()
+    if self.command != 'HEAD':
+      self.wfile.write(content)
+
+
+class MockReleaseServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """HTTP server of the release in directory; port 0 picks a free port.
+  latency and jitter are in seconds, bandwidths in bytes per second."""
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, directory, port=0, host='127.0.0.1', latency=0., jitter=0., bandwidth=None,
+               totalbandwidth=None, errorrate=0., truncaterate=0., missing=(), seed=0, quiet=True):
+    BaseHTTPServer.HTTPServer.__init__(self, (host, port), MockHandler)
+    self.directory = os.path.abspath(directory)
+    self.latency = latency
+    self.jitter = jitter
+    self.bandwidth = bandwidth
+    self.total = Bandwidth(totalbandwidth) if totalbandwidth else None
+    self.errorrate = errorrate
+    self.truncaterate = truncaterate
+    self.missing = list(missing)
+    self.quiet = quiet
+    self.random = random.Random(seed)
+    self.lock = threading.Lock()
+    self.stats = {'requests': 0, 'errors': 0, 'truncated': 0, 'not_modified': 0, 'bytes': 0}
+    self.thread = None
+
+  @property
+  def url(self):
+    return 'http://{0}:{1}'.format(*self.server_address[:2])
+
+  def rng(self):
+    # one shared generator: the sequence of injected errors only depends on the seed
+    return self.random
+
+  def count(self, name, amount=1):
+    with self.lock:
+      self.stats[name] += amount
+
+  def start(self):
+    """Serve from a background thread"""
+    self.thread = threading.Thread(target=self.serve_forever)
+    self.thread.daemon = True
+    self.thread.start()
+    return self
+
+  def stop(self):
+    self.shutdown()
+    self.server_close()
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Serve a (synthetic) LCG release over HTTP with latency, bandwidth caps and injected errors")
+  parser.add_argument('directory', help="Release directory to serve")
+  parser.add_argument('-p', '--port', help="Port to listen on", default=8000, type=int)
+  parser.add_argument('--host', help="Address to listen on", default='127.0.0.1')
+  parser.add_argument('--generate', help="First write a synthetic release of this many packages into the directory", default=0, type=int)
+  parser.add_argument('--size', help="Average size of the generated packages in kB", default=1000, type=int)
+  parser.add_argument('--version', help="LCG version of the generated release", default='96')
+  parser.add_argument('--platform', help="Platform of the generated release", default=PLATFORM)
+  parser.add_argument('--latency', help="Latency added to every request in ms", default=0., type=float)
+  parser.add_argument('--jitter', help="Random extra latency of up to this many ms", default=0., type=float)
+  parser.add_argument('--bandwidth', help="Bandwidth of each transfer in MB/s", default=None, type=float)
+  parser.add_argument('--total-bandwidth', help="Bandwidth of all the transfers together in MB/s", default=None, type=float, dest='totalbandwidth')
+  parser.add_argument('--error-rate', help="Fraction of the requests answered with HTTP 503", default=0., type=float, dest='errorrate')
+  parser.add_argument('--truncate-rate', help="Fraction of the transfers cut in the middle", default=0., type=float, dest='truncaterate')
+  parser.add_argument('--missing', help="Answer 404 for the files matching these patterns", default=[], nargs='*')
+  parser.add_argument('--seed', help="Seed of the generated release and of the injected errors", default=0, type=int)
+  parser.add_argument('-q', '--quiet', help="Do not log requests", default=False, action='store_true')
+  args = parser.parse_args()
+
+  if args.generate:
+    description = generateRelease(args.directory, args.generate, args.size, args.version, args.platform, args.seed)
+    print "Generated {0} packages and {1} in {2}".format(args.generate, description, args.directory)
+  server = MockReleaseServer(args.directory, args.port, args.host,
+                             latency=args.latency / 1e3,
+                             jitter=args.jitter / 1e3,
+                             bandwidth=args.bandwidth * 1e6 if args.bandwidth else None,
+                             totalbandwidth=args.totalbandwidth * 1e6 if args.totalbandwidth else None,
+                             errorrate=args.errorrate,
+                             truncaterate=args.truncaterate,
+                             missing=args.missing,
+                             seed=args.seed,
+                             quiet=args.quiet)
+  print "Serving {0} on {1}".format(args.directory, server.url)
+  sys.stdout.flush()
+  # stopped by kill as well as by Ctrl-C, e.g. at the end of a benchmark script
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    print "Statistics:", ', '.join(['{0} {1}'.format(k, v) for k, v in sorted(server.stats.items())])
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,98 @@
+"""Installation planning for lcginstall.py --plan."""
+
+import os
+import json
+
+from lcgfetch import statURLs
+
+
+def measuredThroughput(manifest):
+  """Return the download and extraction throughput, in bytes per second,
+  of the tarballs recorded in manifest, or None without any history"""
+  if manifest is None:
+    return None
+  downloaded = 0
+  seconds = 0.
+  for record in manifest.records().values():
+    if record is None or record.get('cached') or not record.get('seconds'):
+      continue
+    downloaded += record.get('downloaded', 0)
+    seconds += record['seconds']
+  if downloaded == 0 or seconds <= 0:
+    return None
+  return downloaded / seconds
+
+
+def makePlan(installation):
+  """Return the plan of the installation as a JSON-serializable dict.
+
+  Every package gets one action, in dependency order:
+    install  the tarball is extracted (and linked, except for nightlies)
+    link     the package is already there, only its link is created
+    skip     nothing to do
+    missing  the tarball cannot be found"""
+  packages = installation.getInstallOrder()
+  manifest = installation.manifest
+  cache = installation.cache
+  urls = dict((p, os.path.join(installation.releaseurl, p.getPackageFilename())) for p in packages)
+  tostat = [urls[p] for p in packages if (cache is None or not cache.contains(p.getPackageFilename())) and
+            (installation.delta is None or not installation.delta.isCarried(p))]
+  found = dict((url, (size, reason)) for url, size, reason in statURLs(tostat))
+
+  entries = []
+  totals = {'install': 0, 'link': 0, 'skip': 0, 'missing': 0, 'download_bytes': 0, 'tarball_bytes': 0,
+            'unknown_sizes': 0}
+  for p in packages:
+    entry = {'name': p.name, 'version': p.version, 'hash': p.hashstr, 'platform': p.platform,
+             'tarball': p.getPackageFilename(), 'bytes': None, 'cached': False}
+    if installation.delta is not None and installation.delta.isCarried(p):
+      entry['action'] = 'skip'
+    elif installation.isInstalled(p):
+      linkpath = installation.getLinkpath(p)
+      if installation.nightly or installation.updatelinks or not installation.exists(linkpath):
+        entry['action'] = 'link'
+      else:
+        entry['action'] = 'skip'
+    elif cache is not None and cache.contains(p.getPackageFilename()):
+      entry['action'] = 'install'
+      entry['cached'] = True
+      entry['bytes'] = os.path.getsize(cache.path(p.getPackageFilename()))
+    else:
+      size, reason = found[urls[p]]
+      if reason is not None:
+        entry['action'] = 'missing'
+        entry['reason'] = reason
+      else:
+        entry['action'] = 'install'
+        entry['bytes'] = size
+    totals[entry['action']] += 1
+    if entry['action'] == 'install':
+      if entry['bytes'] is None:
+        totals['unknown_sizes'] += 1
+      else:
+        totals['tarball_bytes'] += entry['bytes']
+        if not entry['cached']:
+          totals['download_bytes'] += entry['bytes']
+    entries.append(entry)
+
+  throughput = measuredThroughput(manifest)
+  estimate = None
+  if throughput:
+    estimate = totals['tarball_bytes'] / throughput
+  return {'type': installation.getType(),
+          'description': installation.description,
+          'releaseurl': installation.releaseurl,
+          'prefix': installation.prefix,
+          'packages': entries,
+          'totals': totals,
+          'throughput': throughput,
+          'estimated_seconds': estimate,
+          # outdated builds are only removed from nightly prefixes
+          'removed': [p.getPackageFilename() for p in installation.delta.outdated()]
+                     if installation.delta is not None and installation.nightly else [],
+          'nothing_to_do': totals['install'] == 0 and totals['link'] == 0}
+
+
+def writePlan(plan, filename):
+  with open(filename, 'w') as f:
+    json.dump(plan, f, indent=1, sort_keys=True)
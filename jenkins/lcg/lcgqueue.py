@@ -0,0 +1,250 @@
+"""Work queue shared by the hosts taking part in one installation."""
+
+import os
+import json
+import time
+import errno
+import shutil
+import socket
+import tempfile
+import threading
+
+from lcgfetch import Extraction, extractURL
+
+DIRECTORIES = ('tasks', 'todo', 'claimed', 'done', 'failed', 'staging')
+
+
+def _write(path, data):
+  fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(path))
+  with os.fdopen(fd, 'w') as f:
+    json.dump(data, f, indent=1, sort_keys=True)
+  os.chmod(tmp, 0o644)
+  os.rename(tmp, path)
+
+
+def _read(path):
+  try:
+    with open(path) as f:
+      return json.load(f)
+  except IOError as e:
+    if e.errno != errno.ENOENT:
+      raise
+    return None
+
+
+class WorkQueue(object):
+  """Tasks move between tasks/, todo/, claimed/ (<key>@<host>@<pid>), done/
+  and failed/ by renames, which are atomic on network file systems too"""
+
+  # claims not touched for this long belong to a dead worker
+  TIMEOUT = 300
+  # how often a working worker touches its claim
+  HEARTBEAT = 30
+
+  def __init__(self, directory, poll=1.):
+    self.directory = os.path.abspath(directory)
+    self.poll = poll
+    self.hostname = socket.gethostname()
+    for name in DIRECTORIES:
+      try:
+        os.makedirs(os.path.join(self.directory, name))
+      except OSError as e:
+        if e.errno != errno.EEXIST:
+          raise
+
+  def path(self, *names):
+    return os.path.join(self.directory, *names)
+
+  def put(self, key, task):
+    """Queue the extraction of task ({'url':, 'transform':}) as key"""
+    for stale in (self.path('done', key + '.json'), self.path('failed', key + '.json')):
+      if os.path.exists(stale):
+        os.unlink(stale)
+    if os.path.isdir(self.path('done', key)):
+      shutil.rmtree(self.path('done', key))
+    _write(self.path('tasks', key + '.json'), task)
+    open(self.path('todo', key), 'w').close()
+
+  def close(self):
+    open(self.path('closed'), 'w').close()
+
+  def isClosed(self):
+    return os.path.exists(self.path('closed'))
+
+  def reopen(self):
+    if self.isClosed():
+      os.unlink(self.path('closed'))
+    # left over by workers that died: their claim is gone
+    claims = set(os.listdir(self.path('claimed')))
+    for name in os.listdir(self.path('staging')):
+      if name.rsplit('.', 1)[0] not in claims and not name.endswith('.files'):
+        shutil.rmtree(self.path('staging', name), ignore_errors=True)
+        if os.path.exists(self.path('staging', name + '.files')):
+          os.unlink(self.path('staging', name + '.files'))
+
+  def claim(self, key=None):
+    """Take key, or any waiting task, returning (key, task, claim path)
+    or None if there is none"""
+    keys = [key] if key is not None else sorted(os.listdir(self.path('todo')))
+    for k in keys:
+      claim = self.path('claimed', '{0}@{1}@{2}'.format(k, self.hostname, os.getpid()))
+      try:
+        os.rename(self.path('todo', k), claim)
+      except OSError as e:
+        if e.errno == errno.ENOENT:
+          # taken by someone else meanwhile
+          continue
+        raise
+      return k, _read(self.path('tasks', k + '.json')), claim
+    return None
+
+  def requeueStale(self):
+    now = time.time()
+    for name in os.listdir(self.path('claimed')):
+      claim = self.path('claimed', name)
+      try:
+        if now - os.stat(claim).st_mtime < self.TIMEOUT:
+          continue
+        key = name.split('@')[0]
+        os.rename(claim, self.path('todo', key))
+        print "  Claim {0} timed out, {1} queued again".format(name, key)
+      except OSError as e:
+        if e.errno != errno.ENOENT:
+          raise
+
+  def done(self, key, staging, result):
+    """Publish the tree extracted into staging, and its listing, for key"""
+    try:
+      os.rename(staging, self.path('done', key))
+    except OSError as e:
+      if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+        raise
+      # extracted twice, by a worker thought dead and by another one
+      shutil.rmtree(staging)
+      os.unlink(staging + '.files')
+      return
+    os.rename(staging + '.files', self.path('done', key + '.files'))
+    _write(self.path('done', key + '.json'), result)
+
+  def failed(self, key, error):
+    _write(self.path('failed', key + '.json'), {'error': error, 'host': self.hostname, 'pid': os.getpid()})
+
+  def result(self, key):
+    """Return ('done', summary), ('failed', error) or (None, None) if key
+    is not finished yet"""
+    result = _read(self.path('done', key + '.json'))
+    if result is not None:
+      return 'done', result
+    failure = _read(self.path('failed', key + '.json'))
+    if failure is not None:
+      return 'failed', failure['error']
+    return None, None
+
+  def release(self, claim):
+    try:
+      os.unlink(claim)
+    except OSError as e:
+      if e.errno != errno.ENOENT:
+        raise
+
+  def forget(self, key):
+    """Drop everything about key once the coordinator is done with it"""
+    for path in (self.path('tasks', key + '.json'), self.path('done', key + '.json'),
+                 self.path('done', key + '.files'), self.path('failed', key + '.json')):
+      try:
+        os.unlink(path)
+      except OSError as e:
+        if e.errno != errno.ENOENT:
+          raise
+    shutil.rmtree(self.path('done', key), ignore_errors=True)
+
+  def process(self, key, task, claim, cache=None, throttle=None):
+    """Extract the claimed task into the staging area and publish it, in
+    one of the extraction slots of throttle"""
+    stop = threading.Event()
+
+    def heartbeat():
+      while not stop.wait(self.HEARTBEAT):
+        try:
+          os.utime(claim, None)
+        except OSError:
+          return
+    beat = threading.Thread(target=heartbeat)
+    beat.daemon = True
+    beat.start()
+    staging = tempfile.mkdtemp(prefix='{0}@{1}@{2}.'.format(key, self.hostname, os.getpid()),
+                               dir=self.path('staging'))
+    try:
+      # one of the extraction slots of this host, as for an extraction into the prefix
+      slot = throttle.acquire() if throttle is not None else None
+      try:
+        with open(staging + '.files', 'w') as listing:
+          extraction = extractURL(task['url'], staging, task['transform'], cache, listing, throttle)
+      finally:
+        if throttle is not None:
+          throttle.release(slot)
+      self.done(key, staging, {'url': extraction.url, 'files': extraction.files, 'bytes': extraction.bytes,
+                               'downloaded': extraction.downloaded, 'sha256': extraction.sha256,
+                               'first': extraction.first, 'cached': extraction.cached,
+                               'seconds': extraction.seconds, 'host': '{0}:{1}'.format(self.hostname, os.getpid())})
+      return extraction
+    except Exception as e:
+      shutil.rmtree(staging, ignore_errors=True)
+      if os.path.exists(staging + '.files'):
+        os.unlink(staging + '.files')
+      self.failed(key, str(e))
+      return None
+    finally:
+      stop.set()
+      self.release(claim)
+
+  def wait(self, key, cache=None, throttle=None):
+    """Wait until key is extracted, extracting it here if nobody took it.
+    Returns the same as result()"""
+    while True:
+      state, result = self.result(key)
+      if state is not None:
+        return state, result
+      claim = self.claim(key)
+      if claim is not None:
+        self.process(cache=cache, throttle=throttle, *claim)
+        continue
+      self.requeueStale()
+      time.sleep(self.poll)
+
+
+def extractionFromResult(result):
+  extraction = Extraction(result['url'])
+  for name in ('files', 'bytes', 'downloaded', 'sha256', 'first', 'cached', 'seconds'):
+    setattr(extraction, name, result[name])
+  return extraction
+
+
+def runWorker(queue, cache=None, throttle=None):
+  """Extract the queued tasks until the installation they belong to is
+  over (the queue is closed after having been open), returning how many
+  were extracted"""
+  count = 0
+  opened = False
+  print "Worker {0}:{1} waiting for tasks in {2}".format(queue.hostname, os.getpid(), queue.directory)
+  while True:
+    claim = queue.claim()
+    if claim is None:
+      if not queue.isClosed():
+        opened = True
+      elif opened:
+        break
+      queue.requeueStale()
+      time.sleep(queue.poll)
+      continue
+    opened = True
+    key, task, path = claim
+    print "Extract", task['url']
+    extraction = queue.process(key, task, path, cache, throttle)
+    if extraction is not None:
+      print "  {0} files, {1} bytes in {2:.1f}s".format(extraction.files, extraction.bytes, extraction.seconds)
+      count += 1
+    else:
+      print "  FAILED:", queue.result(key)[1]
+  print "Queue closed, {0} packages extracted".format(count)
+  return count
@@ -0,0 +1,74 @@
+"""Timing instrumentation of lcginstall.py runs."""
+
+import json
+import time
+import threading
+import contextlib
+
+
+class RunReport(object):
+  """Wall time per phase and package; with parallel installs the phase
+  totals can exceed the run time"""
+
+  def __init__(self):
+    self.start = time.time()
+    self.lock = threading.Lock()
+    self.phases = {}
+    self.packages = {}
+    self.status = 'running'
+    self.error = None
+
+  @contextlib.contextmanager
+  def phase(self, name, key=None):
+    """Time the enclosed block as phase name, for package key if given"""
+    start = time.time()
+    try:
+      yield
+    finally:
+      self.add(name, time.time() - start, key)
+
+  def add(self, name, seconds, key=None):
+    with self.lock:
+      phase = self.phases.setdefault(name, {'seconds': 0., 'count': 0})
+      phase['seconds'] += seconds
+      phase['count'] += 1
+      if key is not None:
+        phases = self._package(key).setdefault('phases', {})
+        phases[name] = phases.get(name, 0.) + seconds
+
+  def update(self, key, **fields):
+    with self.lock:
+      self._package(key).update(fields)
+
+  def _package(self, key):
+    return self.packages.setdefault(key, {'package': key})
+
+  def finish(self, error=None):
+    self.status = 'failed' if error is not None else 'ok'
+    self.error = error
+
+  def summary(self, slowest=10):
+    with self.lock:
+      packages = [dict(p) for p in self.packages.values()]
+      phases = dict((k, dict(v)) for k, v in self.phases.items())
+    totals = {'packages': len(packages),
+              'failed': len([p for p in packages if p.get('rc', 0) != 0]),
+              'downloaded': sum([p.get('downloaded', 0) for p in packages if not p.get('cached')]),
+              'bytes': sum([p.get('bytes', 0) for p in packages]),
+              'files': sum([p.get('files', 0) for p in packages])}
+    for p in packages:
+      p['seconds'] = p.get('phases', {}).get('install', 0.)
+    packages.sort(key=lambda p: p['seconds'], reverse=True)
+    return {'start': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.start)),
+            'wall_seconds': time.time() - self.start,
+            'status': self.status,
+            'error': self.error,
+            'phases': phases,
+            'totals': totals,
+            'slowest': [{'package': p['package'], 'seconds': p['seconds'], 'bytes': p.get('bytes', 0)}
+                        for p in packages[:slowest]],
+            'packages': sorted(packages, key=lambda p: p['package'])}
+
+  def write(self, filename, slowest=10):
+    with open(filename, 'w') as f:
+      json.dump(self.summary(slowest), f, indent=1, sort_keys=True)
@@ -0,0 +1,130 @@
+"""Staging directories for atomic package installs."""
+
+import os
+import time
+import errno
+import shutil
+import socket
+import tempfile
+import threading
+
+from lcglinks import exchange
+from lcgfetch import listDirectory
+
+
+def _alive(pid):
+  try:
+    os.kill(pid, 0)
+  except OSError as e:
+    return e.errno == errno.EPERM
+  return True
+
+
+class StagingArea(object):
+  # staging directories of other hosts older than this are left-overs
+  STALE = 2 * 24 * 3600
+
+  def __init__(self, prefix, directory=None):
+    self.prefix = prefix
+    self.directory = directory or os.path.join(prefix, '.lcginstall-staging')
+    self.hostname = socket.gethostname()
+    self.lock = threading.Lock()
+    self.cleanup()
+
+  def cleanup(self):
+    """Remove the staging directories left by installers that died"""
+    if not os.path.isdir(self.directory):
+      return
+    now = time.time()
+    for name in os.listdir(self.directory):
+      # <key>.<hostname>.<pid>.<random>, see create()
+      parts = name.rsplit('.', 2)
+      path = os.path.join(self.directory, name)
+      if len(parts) == 3 and parts[0].endswith('.' + self.hostname) and parts[1].isdigit():
+        stale = not _alive(int(parts[1]))
+      else:
+        stale = now - os.lstat(path).st_mtime > self.STALE
+      if stale:
+        shutil.rmtree(path, ignore_errors=True)
+
+  def create(self, key):
+    with self.lock:
+      if not os.path.isdir(self.directory):
+        os.makedirs(self.directory)
+      return tempfile.mkdtemp(prefix='{0}.{1}.{2}.'.format(key, self.hostname, os.getpid()), dir=self.directory)
+
+  def discard(self, staging):
+    shutil.rmtree(staging, ignore_errors=True)
+
+  def commit(self, staging, relpath):
+    """Move staging/relpath to prefix/relpath in one rename, then move what
+    else the tarball contained to the prefix and drop the staging directory"""
+    source = os.path.join(staging, relpath)
+    if os.path.isdir(source):
+      self._replace(source, os.path.join(self.prefix, relpath))
+    self._merge(staging, self.prefix)
+    shutil.rmtree(staging, ignore_errors=True)
+
+  def close(self):
+    """Remove what this process left in the staging area (when an install
+    failed), then the staging area itself if nothing else is in it"""
+    with self.lock:
+      if os.path.isdir(self.directory):
+        mine = '.{0}.{1}.'.format(self.hostname, os.getpid())
+        for name in os.listdir(self.directory):
+          if mine in name:
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+      try:
+        os.rmdir(self.directory)
+      except OSError:
+        pass
+
+  @staticmethod
+  def _makedirs(path):
+    try:
+      os.makedirs(path)
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+
+  def _replace(self, source, target):
+    self._makedirs(os.path.dirname(target))
+    if not os.path.lexists(target):
+      self._move(source, target)
+      return
+    if exchange(source, target):
+      # source now holds the previous install
+      shutil.rmtree(source)
+      return
+    old = tempfile.mkdtemp(prefix='.old-', dir=os.path.dirname(target))
+    try:
+      os.rename(target, os.path.join(old, 'tree'))
+    except OSError as e:
+      if e.errno != errno.EXDEV:
+        raise
+      # directories of a lower layer (overlay/union file systems) cannot be renamed
+      shutil.rmtree(target)
+    self._move(source, target)
+    shutil.rmtree(old)
+
+  @staticmethod
+  def _move(source, target):
+    try:
+      os.rename(source, target)
+    except OSError as e:
+      if e.errno != errno.EXDEV:
+        raise
+      # staged on another file system (shared work queue): copy
+      shutil.move(source, target)
+
+  def _merge(self, source, target):
+    for name, isdir, isfile in list(listDirectory(source)):
+      src = os.path.join(source, name)
+      dst = os.path.join(target, name)
+      if isdir and os.path.isdir(dst) and not os.path.islink(dst):
+        self._merge(src, dst)
+        continue
+      self._makedirs(target)
+      if isdir and os.path.lexists(dst):
+        os.unlink(dst)
+      self._move(src, dst)
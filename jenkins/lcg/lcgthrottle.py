@@ -0,0 +1,114 @@
+"""Host-wide I/O limits for lcginstall.py."""
+
+import os
+import time
+import errno
+import fcntl
+import contextlib
+
+DEFAULT_DIRECTORY = '/tmp/lcginstall-throttle'
+
+
+def _makedirs(directory):
+  try:
+    os.makedirs(directory)
+    os.chmod(directory, 0o1777)
+  except OSError as e:
+    if e.errno != errno.EEXIST:
+      raise
+
+
+def _open(path):
+  fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+  try:
+    # shared with the installers of other users, whatever their umask
+    os.fchmod(fd, 0o666)
+  except OSError:
+    pass
+  return fd
+
+
+class SharedTokenBucket(object):
+  """Token bucket shared by all processes through a state file.
+
+  Tokens are bytes, refilled at rate per second up to burst. consume()
+  takes what it needs even if the bucket goes into debt and then sleeps
+  for the time needed to pay it back, so every caller gets a fair share
+  with a single lock per call."""
+
+  def __init__(self, path, rate, burst=None):
+    self.path = path
+    self.rate = float(rate)
+    self.burst = float(burst if burst is not None else rate)
+
+  def consume(self, amount):
+    if amount <= 0:
+      return 0.
+    fd = _open(self.path)
+    try:
+      fcntl.flock(fd, fcntl.LOCK_EX)
+      now = time.time()
+      try:
+        last, tokens = [float(x) for x in os.read(fd, 64).split()]
+      except ValueError:
+        last, tokens = now, self.burst
+      tokens = min(self.burst, tokens + max(0., now - last) * self.rate) - amount
+      os.lseek(fd, 0, os.SEEK_SET)
+      os.ftruncate(fd, 0)
+      os.write(fd, '{0!r} {1!r}\n'.format(now, tokens).encode('ascii'))
+    finally:
+      os.close(fd)
+    wait = -tokens / self.rate if tokens < 0 else 0.
+    if wait > 0:
+      time.sleep(wait)
+    return wait
+
+
+class Throttle(object):
+  """Limits on concurrent extractions (count), download bandwidth and
+  write rate (bytes per second); None means no limit"""
+
+  def __init__(self, directory=DEFAULT_DIRECTORY, extractions=None, bandwidth=None, writerate=None, poll=0.5):
+    self.directory = directory
+    self.extractions = extractions
+    self.poll = poll
+    _makedirs(directory)
+    self.bandwidth = SharedTokenBucket(os.path.join(directory, 'download'), bandwidth) if bandwidth else None
+    self.writerate = SharedTokenBucket(os.path.join(directory, 'write'), writerate) if writerate else None
+
+  @contextlib.contextmanager
+  def extraction(self):
+    """Hold one of the host-wide extraction slots for the enclosed block"""
+    slot = self.acquire()
+    try:
+      yield
+    finally:
+      self.release(slot)
+
+  def acquire(self):
+    """Wait for a free extraction slot, to be given back to release()"""
+    if not self.extractions:
+      return None
+    while True:
+      for i in range(self.extractions):
+        fd = _open(os.path.join(self.directory, 'slot-{0}'.format(i)))
+        try:
+          fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+          return fd
+        except (IOError, OSError) as e:
+          os.close(fd)
+          if e.errno not in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK):
+            raise
+      time.sleep(self.poll)
+
+  def release(self, slot):
+    if slot is not None:
+      os.close(slot)
+
+  def downloaded(self, size):
+    if self.bandwidth is not None:
+      self.bandwidth.consume(size)
+
+  def written(self, size):
+    if self.writerate is not None:
+      self.writerate.consume(size)
@@ -0,0 +1,182 @@
+"""Integrity check of installed releases against their tarballs."""
+
+import os
+import json
+import stat
+import errno
+import hashlib
+import tarfile
+import multiprocessing
+
+from lcgfetch import CHUNKSIZE, openURL
+from lcgcache import TarballCache, MetadataCache
+from lcgmanifest import packageKey
+
+# Size of the blocks read when hashing installed files
+BLOCKSIZE = 4 << 20
+
+
+def hashFile(path):
+  sha256 = hashlib.sha256()
+  with open(path, 'rb', 0) as f:
+    while True:
+      data = f.read(BLOCKSIZE)
+      if not data:
+        break
+      sha256.update(data)
+  return sha256.hexdigest()
+
+
+def readMembers(url, cache=None):
+  """Return the members of the tarball at url as a list of
+  [name, kind, size, sha256, linkname], kind being 'file', 'dir', 'link'
+  (symbolic) or 'hardlink', and the content of its .post-install.sh"""
+  cached = cache.lookup(os.path.basename(url)) if cache is not None else None
+  fileobj = open(cached, 'rb', CHUNKSIZE) if cached is not None else openURL(url)
+  members = []
+  postinstall = ''
+  try:
+    tar = tarfile.open(fileobj=fileobj, mode='r|gz')
+    try:
+      for member in tar:
+        if member.isfile():
+          sha256 = hashlib.sha256()
+          data = tar.extractfile(member)
+          while True:
+            block = data.read(CHUNKSIZE)
+            if not block:
+              break
+            sha256.update(block)
+            if os.path.basename(member.name) == '.post-install.sh':
+              postinstall += block.decode('utf-8', 'replace')
+          members.append([member.name, 'file', member.size, sha256.hexdigest(), None])
+        elif member.isdir():
+          members.append([member.name, 'dir', 0, None, None])
+        elif member.issym():
+          members.append([member.name, 'link', 0, None, member.linkname])
+        elif member.islnk():
+          members.append([member.name, 'hardlink', 0, None, member.linkname])
+    finally:
+      tar.close()
+  finally:
+    fileobj.close()
+  return members, postinstall
+
+
+def getReference(url, cache=None, metadata=None):
+  key = 'members://' + os.path.basename(url)
+  if metadata is not None:
+    validators, content = metadata.get(key)
+    if content is not None:
+      reference = json.loads(content.decode('utf-8'))
+      return reference['members'], reference['postinstall']
+  members, postinstall = readMembers(url, cache)
+  if metadata is not None:
+    metadata.put(key, {}, json.dumps({'members': members, 'postinstall': postinstall}).encode('utf-8'))
+  return members, postinstall
+
+
+def checkFile(path, size, sha256, relocated):
+  try:
+    st = os.lstat(path)
+  except OSError as e:
+    if e.errno in (errno.ENOENT, errno.ENOTDIR):
+      return 'missing'
+    raise
+  if not stat.S_ISREG(st.st_mode):
+    return 'type'
+  if relocated:
+    return None
+  if st.st_size != size:
+    return 'size'
+  if hashFile(path) != sha256:
+    return 'content'
+  return None
+
+
+def checkLink(path, linkname):
+  try:
+    if os.readlink(path) != linkname:
+      return 'link'
+  except OSError as e:
+    if e.errno in (errno.ENOENT, errno.ENOTDIR):
+      return 'missing'
+    if e.errno == errno.EINVAL:
+      return 'type'
+    raise
+  return None
+
+
+def verifyPackage(task):
+  """Verify one package; task is a dict made by verifyRelease()"""
+  result = {'package': task['key'], 'files': 0, 'bytes': 0, 'problems': [], 'error': None}
+  try:
+    cache = TarballCache(task['cache']) if task['cache'] else None
+    metadata = MetadataCache(task['metadata']) if task['metadata'] else None
+    members, postinstall = getReference(task['url'], cache, metadata)
+  except Exception as e:
+    result['error'] = str(e)
+    return result
+  old, new = task['transform'] or ('', '')
+
+  def rename(name):
+    return name.replace(old, new) if old else name
+
+  files = dict((m[0], m) for m in members if m[1] == 'file')
+  scripts = [os.path.dirname(m[0]) for m in members if os.path.basename(m[0]) == '.post-install.sh']
+  for name, kind, size, sha256, linkname in members:
+    if kind == 'hardlink':
+      if linkname not in files:
+        continue
+      kind, size, sha256 = 'file', files[linkname][2], files[linkname][3]
+    path = os.path.join(task['prefix'], rename(name))
+    if kind == 'file':
+      relocated = any([name.startswith(d + '/') and name[len(d) + 1:] in postinstall for d in scripts])
+      problem = checkFile(path, size, sha256, relocated)
+      result['files'] += 1
+      result['bytes'] += size
+    elif kind == 'link':
+      problem = checkLink(path, rename(linkname))
+      result['files'] += 1
+    else:
+      continue
+    if problem is not None:
+      result['problems'].append([rename(name), problem])
+  return result
+
+
+def verifyRelease(installation, jobs=None):
+  """Verify all the packages installed by installation in a pool of jobs
+  processes. Returns the list of the results of verifyPackage(), with
+  skipped packages (only linked from another area) left out."""
+  tasks = []
+  for package in installation.getPackages():
+    if installation.nightly:
+      transform = None
+      if os.path.islink(installation.getLinkpath(package)):
+        # linked from the release area, not extracted in this prefix
+        continue
+    else:
+      transform = ('/{0}/{1}'.format(package.version, package.platform),
+                   '/{0}-{1}/{2}'.format(package.version, package.hashstr, package.platform))
+    tasks.append({'key': packageKey(package),
+                  'url': os.path.join(installation.releaseurl, package.getPackageFilename()),
+                  'prefix': installation.prefix,
+                  'transform': transform,
+                  'cache': installation.cache.directory if installation.cache is not None else None,
+                  'metadata': installation.metadata.directory if installation.metadata is not None else None})
+  if not tasks:
+    return []
+  pool = multiprocessing.Pool(min(jobs or multiprocessing.cpu_count(), len(tasks)))
+  try:
+    # biggest tarballs are not known in advance: hand out packages one by one
+    return pool.map(verifyPackage, tasks, chunksize=1)
+  finally:
+    pool.close()
+    pool.join()
+
+
+def writeVerification(results, filename):
+  with open(filename, 'w') as f:
+    json.dump({'packages': results,
+               'failed': [r['package'] for r in results if r['problems'] or r['error']]}, f, indent=1, sort_keys=True)
@@ -0,0 +1,52 @@
+import os
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from lcgmockserver import MockReleaseServer, generateRelease
+
+
+def parse(line):
+  """Fields of a line of a release description, as buildinfo2json.parse() of
+  lcgcmake returns them: 'KEY: value' pairs separated by commas, DEPENDS last
+  and made of the remaining comma separated items"""
+  fields = {}
+  deps = False
+  for e in line.split(','):
+    if not e.strip():
+      continue
+    if not deps:
+      k, v = [x.strip() for x in (e.split(':')[0], ':'.join(e.split(':')[1:]))]
+      if k == 'DEPENDS':
+        fields[k] = v and [v] or []
+        deps = True
+      else:
+        fields[k] = v
+    else:
+      fields['DEPENDS'].append(e.strip())
+  return fields
+
+
+# lcginstall.py imports buildinfo2json from lcgcmake, which is not part of this repository
+try:
+  import buildinfo2json
+except ImportError:
+  buildinfo2json = types.ModuleType('buildinfo2json')
+  buildinfo2json.parse = parse
+  sys.modules['buildinfo2json'] = buildinfo2json
+
+
+@pytest.fixture
+def release(tmpdir):
+  """A synthetic release of 4 packages served by the mock release server,
+  as (url, description)"""
+  directory = str(tmpdir.join('release'))
+  description = generateRelease(directory, 4, size=2)
+  server = MockReleaseServer(directory).start()
+  try:
+    yield server.url, description
+  finally:
+    server.stop()
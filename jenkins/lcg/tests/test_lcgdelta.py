@@ -0,0 +1,41 @@
+import os
+
+from lcgdelta import Delta, readPrevious, savePrevious
+
+
+class Package(object):
+  def __init__(self, name, version, hashstr):
+    self.name = name
+    self.version = version
+    self.hashstr = hashstr
+
+  def getPackageFilename(self):
+    return '{0}-{1}_{2}-x86_64-centos7-gcc8-opt.tgz'.format(self.name, self.version, self.hashstr)
+
+
+def test_classification():
+  previous = [Package('a', '1.0', 'aaaaa'), Package('b', '1.0', 'bbbbb'), Package('c', '1.0', 'ccccc'),
+              Package('d', '1.0', 'ddddd')]
+  current = [Package('a', '1.0', 'aaaaa'), Package('b', '1.0', 'b2222'), Package('c', '2.0', 'ccccc'),
+             Package('e', '1.0', 'eeeee')]
+  delta = Delta(previous, current)
+  assert [p.name for p in delta.unchanged] == ['a']
+  assert [(old.hashstr, new.hashstr) for old, new in delta.rebuilt] == [('bbbbb', 'b2222'), ('ccccc', 'ccccc')]
+  assert [p.name for p in delta.added] == ['e']
+  assert [p.name for p in delta.removed] == ['d']
+  assert sorted([(p.name, p.version) for p in delta.outdated()]) == [('b', '1.0'), ('c', '1.0'), ('d', '1.0')]
+  assert delta.isCarried(current[0])
+  assert not delta.isCarried(current[1])
+  assert delta.summary() == "1 unchanged, 2 rebuilt, 1 added, 1 removed"
+
+  delta.forget(current[0])
+  assert not delta.isCarried(current[0])
+  assert [p.name for p in delta.added] == ['e', 'a']
+
+
+def test_previous(tmpdir):
+  path = str(tmpdir.join('.lcginstall-previous', 'LCG_96_x86_64-centos7-gcc8-opt.txt'))
+  assert readPrevious(path) is None
+  savePrevious(path, 'description\n')
+  assert readPrevious(path) == 'description\n'
+  assert os.listdir(os.path.dirname(path)) == ['LCG_96_x86_64-centos7-gcc8-opt.txt']
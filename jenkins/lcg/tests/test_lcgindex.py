@@ -0,0 +1,17 @@
+import os
+
+from lcgindex import PathIndex
+
+
+def test_links_follow_their_target(tmpdir):
+  base = str(tmpdir)
+  os.makedirs(os.path.join(base, 'data'))
+  os.symlink(os.path.join(base, 'data'), os.path.join(base, 'good'))
+  os.symlink(os.path.join(base, 'missing'), os.path.join(base, 'dangling'))
+  index = PathIndex()
+  index.load([os.path.join(base, name) for name in ('data', 'good', 'dangling', 'other')])
+  for name in ('data', 'good', 'dangling', 'other'):
+    path = os.path.join(base, name)
+    assert index.exists(path) == os.path.exists(path)
+    assert index.isdir(path) == os.path.isdir(path)
+  assert index.reads == 1
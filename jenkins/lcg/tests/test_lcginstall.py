@@ -0,0 +1,144 @@
+import os
+import sys
+import shutil
+
+import pytest
+
+from lcgmockserver import MockReleaseServer, generateRelease
+from lcginstall import InstallNightlyProcess, InstallOptions, InstallReleaseProcess, InstallScheduler
+from lcgmanifest import InstallManifest, packageKey
+from lcgplan import makePlan
+from lcgstaging import StagingArea
+
+
+def install(url, description, prefix, version, installType=InstallReleaseProcess):
+  manifest = InstallManifest(prefix)
+  installation = installType(url, description, prefix, version, nightly=installType is InstallNightlyProcess,
+                             options=InstallOptions(manifest=manifest, staging=StagingArea(prefix)))
+  try:
+    for package in installation.getInstallOrder():
+      assert installation.install(package)
+  finally:
+    manifest.close()
+  return installation
+
+
+def links(installation):
+  return [installation.getLinkpath(p) for p in installation.getPackages()]
+
+
+def test_second_release_into_same_prefix(release, tmpdir):
+  url, description = release
+  prefix = str(tmpdir.join('prefix'))
+  first = install(url, description, prefix, '96')
+  installed = dict((p.name, os.stat(first.getDatapath(p)).st_ino) for p in first.getPackages())
+
+  second = install(url, description, prefix, '97')
+  for link in links(second):
+    assert os.path.islink(link)
+    assert os.path.isdir(link)
+  assert all([os.path.islink(link) for link in links(first)])
+  # nothing extracted again
+  assert installed == dict((p.name, os.stat(second.getDatapath(p)).st_ino) for p in second.getPackages())
+
+
+def test_deleted_package_is_installed_again(release, tmpdir):
+  url, description = release
+  prefix = str(tmpdir.join('prefix'))
+  installation = install(url, description, prefix, '96')
+  package = installation.getPackages()[1]
+  shutil.rmtree(os.path.join(prefix, package.name))
+
+  manifest = InstallManifest(prefix)
+  plan = makePlan(InstallReleaseProcess(url, description, prefix, '96', nocheck=True,
+                                        options=InstallOptions(manifest=manifest)))
+  manifest.close()
+  actions = dict((entry['name'], entry['action']) for entry in plan['packages'])
+  assert actions.pop(package.name) == 'install'
+  assert set(actions.values()) == set(['skip'])
+
+  installation = install(url, description, prefix, '96')
+  assert os.path.isdir(installation.getDatapath(package))
+  assert os.path.isdir(installation.getLinkpath(package))
+  assert InstallManifest(prefix).isInstalled(packageKey(package))
+
+
+def test_parallel_install_with_link_farm(release, tmpdir):
+  url, description = release
+  prefix = str(tmpdir.join('prefix'))
+  manifest = InstallManifest(prefix)
+  options = InstallOptions(manifest=manifest, staging=StagingArea(prefix), linkfarm=True)
+  installation = InstallReleaseProcess(url, description, prefix, '96', options=options)
+  try:
+    assert InstallScheduler(installation, 3).run()
+    installation.createLinkFarm()
+  finally:
+    manifest.close()
+  for package in installation.getPackages():
+    assert os.path.isdir(installation.getLinkpath(package))
+    assert InstallManifest(prefix).isInstalled(packageKey(package))
+
+
+def test_stdout_restored_when_installation_fails(release, tmpdir, capsys):
+  url, description = release
+  prefix = str(tmpdir.join('prefix'))
+  installation = InstallReleaseProcess(url, description, prefix, '96',
+                                       options=InstallOptions(staging=StagingArea(prefix)))
+  broken = installation.getInstallOrder()[0]
+  install = installation.install
+
+  def failing(package, force=False):
+    if package is broken:
+      raise IOError("disk full")
+    return install(package, force=force)
+
+  installation.install = failing
+  stdout = sys.stdout
+  with pytest.raises(RuntimeError):
+    InstallScheduler(installation, 2).run()
+  assert sys.stdout is stdout
+  assert "installation of {0} failed: disk full".format(broken.getName()) in capsys.readouterr().out
+
+
+def test_delta_carries_unchanged_packages(release, tmpdir):
+  url, description = release
+  prefix = str(tmpdir.join('prefix'))
+  first = install(url, description, prefix, '96')
+  installation = InstallReleaseProcess(url, description, prefix, '96',
+                                       options=InstallOptions(previous=first.descriptiontext))
+  assert installation.delta.summary() == "4 unchanged, 0 rebuilt, 0 added, 0 removed"
+  assert all([installation.delta.isCarried(p) for p in installation.getPackages()])
+
+  shutil.rmtree(os.path.join(prefix, first.getPackages()[0].name))
+  installation = InstallReleaseProcess(url, description, prefix, '96',
+                                       options=InstallOptions(previous=first.descriptiontext))
+  assert installation.delta.summary() == "3 unchanged, 0 rebuilt, 1 added, 0 removed"
+
+
+def test_outdated_nightly_builds_removed_after_install(tmpdir):
+  releases = []
+  for seed in (0, 1):
+    directory = str(tmpdir.join('release{0}'.format(seed)))
+    description = generateRelease(directory, 3, size=1, seed=seed)
+    releases.append((MockReleaseServer(directory).start(), description))
+  prefix = str(tmpdir.join('prefix'))
+  try:
+    (first, description), (second, description) = releases
+    old = install(first.url, description, prefix, 'dev3', InstallNightlyProcess)
+    new = InstallNightlyProcess(second.url, description, prefix, 'dev3', nightly=True,
+                                options=InstallOptions(previous=old.descriptiontext))
+    assert new.delta.summary() == "0 unchanged, 3 rebuilt, 0 added, 0 removed"
+    for package in new.getInstallOrder():
+      assert new.install(package)
+    # the old builds stay until the new ones are installed
+    assert all([os.path.isdir(old.getLinkpath(p)) for p in old.getPackages()])
+    assert not new.failed
+    new.removeOutdated()
+  finally:
+    for server, description in releases:
+      server.stop()
+  for package in new.getPackages():
+    assert os.path.isdir(new.getLinkpath(package))
+  for package in old.getPackages():
+    if old.getLinkpath(package) not in [new.getLinkpath(p) for p in new.getPackages()]:
+      assert not os.path.exists(old.getLinkpath(package))
@@ -0,0 +1,81 @@
+import os
+import errno
+
+import lcglinks
+from lcglinks import LinkFarm, scanTree
+
+
+def make_data(base, names):
+  for name in names:
+    os.makedirs(os.path.join(base, 'data', name))
+
+
+def farm(base, links, updatelinks=False):
+  root = os.path.join(base, 'LCG_97')
+  result = LinkFarm(root, updatelinks=updatelinks)
+  for data, link in links:
+    result.add(os.path.join(base, 'data', data), os.path.join(root, link))
+  return result
+
+
+def test_diff():
+  links = LinkFarm('/prefix/LCG_97', updatelinks=True)
+  for name in ('a', 'b', 'c', 'd', 'e'):
+    links.add('/prefix/{0}/1.0-hash/plat'.format(name), '/prefix/LCG_97/{0}/1.0/plat'.format(name))
+  tree = {'b': ('dir', None), 'b/1.0': ('dir', None), 'b/1.0/plat': ('link', '../../../b/1.0-hash/plat'),
+          'c': ('dir', None), 'c/1.0': ('dir', None), 'c/1.0/plat': ('link', '../../../c/0.9-hash/plat'),
+          'd': ('dir', None), 'd/1.0': ('dir', None), 'd/1.0/plat': ('dir', None),
+          'e': ('file', None)}
+  assert links.diff(tree) == (['a/1.0/plat'], ['c/1.0/plat'], ['b/1.0/plat'], ['d/1.0/plat', 'e/1.0/plat'])
+  links.updatelinks = False
+  assert links.diff(tree) == (['a/1.0/plat'], [], ['b/1.0/plat', 'c/1.0/plat'], ['d/1.0/plat', 'e/1.0/plat'])
+
+
+def test_update_one_link(tmpdir):
+  base = str(tmpdir)
+  make_data(base, ['a1', 'a2', 'b1'])
+  root = os.path.join(base, 'LCG_97')
+  assert farm(base, [('a1', 'a/1.0/plat'), ('b1', 'b/1.0/plat')]).build() == (['a/1.0/plat', 'b/1.0/plat'], [], [], [])
+  open(os.path.join(root, 'a', 'README'), 'w').close()
+  untouched = os.stat(os.path.join(root, 'b')).st_ino
+
+  result = farm(base, [('a2', 'a/1.0/plat'), ('b1', 'b/1.0/plat')], updatelinks=True).build()
+  assert result == ([], ['a/1.0/plat'], ['b/1.0/plat'], [])
+  tree = scanTree(root)
+  assert tree['a/1.0/plat'] == ('link', '../../../data/a2')
+  assert tree['a/README'] == ('file', None)
+  assert os.stat(os.path.join(root, 'b')).st_ino == untouched
+  assert sorted(os.listdir(root)) == ['a', 'b']
+
+
+def test_update_in_place_when_directories_cannot_be_renamed(tmpdir, monkeypatch):
+  base = str(tmpdir)
+  make_data(base, ['a1', 'a2'])
+  root = os.path.join(base, 'LCG_97')
+  farm(base, [('a1', 'a/1.0/plat')]).build()
+
+  rename = os.rename
+
+  # directories of the lower layer of an overlay file system: all but the new ones
+  def overlay_rename(source, target):
+    if os.path.isdir(source) and not os.path.islink(source) and not os.path.basename(source).startswith('.'):
+      raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+    return rename(source, target)
+  monkeypatch.setattr(lcglinks, 'exchange', lambda a, b: False)
+  monkeypatch.setattr(os, 'rename', overlay_rename)
+
+  result = farm(base, [('a2', 'a/1.0/plat')], updatelinks=True).build()
+  assert result == ([], ['a/1.0/plat'], [], [])
+  assert os.readlink(os.path.join(root, 'a', '1.0', 'plat')) == '../../../data/a2'
+  assert os.listdir(root) == ['a']
+
+
+def test_build_in_place(tmpdir):
+  base = str(tmpdir)
+  make_data(base, ['a1', 'a2', 'b1'])
+  root = os.path.join(base, 'LCG_97')
+  farm(base, [('a1', 'a/1.0/plat')]).build(atomic=False)
+  result = farm(base, [('a2', 'a/1.0/plat'), ('b1', 'b/1.0/plat')], updatelinks=True).build(atomic=False)
+  assert result == (['b/1.0/plat'], ['a/1.0/plat'], [], [])
+  assert os.readlink(os.path.join(root, 'a', '1.0', 'plat')) == '../../../data/a2'
+  assert os.readlink(os.path.join(root, 'b', '1.0', 'plat')) == '../../../data/b1'
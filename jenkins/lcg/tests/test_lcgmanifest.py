@@ -0,0 +1,48 @@
+import os
+
+from lcgmanifest import InstallManifest
+
+
+def test_replay(tmpdir):
+  prefix = str(tmpdir)
+  manifest = InstallManifest(prefix)
+  manifest.begin('a-1.0_aaaaa-plat').close()
+  manifest.installed('a-1.0_aaaaa-plat')
+  manifest.begin('b-1.0_bbbbb-plat')
+  manifest.postinstalled('b-1.0_bbbbb-plat')
+  manifest.installed('c-1.0_ccccc-plat')
+  manifest.forget('c-1.0_ccccc-plat')
+  manifest.close()
+  # torn last line of an interrupted run
+  with open(manifest.journalpath, 'a') as f:
+    f.write('extracting')
+
+  manifest = InstallManifest(prefix)
+  assert manifest.isInstalled('a-1.0_aaaaa-plat')
+  assert manifest.phase('b-1.0_bbbbb-plat') == 'postinstalled'
+  assert manifest.isIncomplete('b-1.0_bbbbb-plat')
+  assert manifest.phase('c-1.0_ccccc-plat') is None
+
+
+def test_rollback(tmpdir):
+  prefix = str(tmpdir)
+  os.makedirs(os.path.join(prefix, 'shared', 'other'))
+  manifest = InstallManifest(prefix)
+  listing = manifest.begin('a-1.0_aaaaa-plat')
+  for name in ('a', 'a/1.0', 'a/1.0/plat', 'a/1.0/plat/bin', 'shared', 'shared/a.txt'):
+    path = os.path.join(prefix, name)
+    if name.endswith('.txt'):
+      open(path, 'w').close()
+    elif not os.path.isdir(path):
+      os.mkdir(path)
+    listing.write(name + '\n')
+  listing.flush()
+  # created by the post-install script, not listed
+  open(os.path.join(prefix, 'a', '1.0', 'plat', 'generated'), 'w').close()
+
+  manifest.rollback('a-1.0_aaaaa-plat', os.path.join(prefix, 'a', '1.0', 'plat'))
+  assert not os.path.exists(os.path.join(prefix, 'a'))
+  assert not os.path.exists(os.path.join(prefix, 'shared', 'a.txt'))
+  assert os.path.isdir(os.path.join(prefix, 'shared', 'other'))
+  assert manifest.phase('a-1.0_aaaaa-plat') is None
+  assert manifest.files('a-1.0_aaaaa-plat') == []
@@ -0,0 +1,65 @@
+import os
+import time
+import multiprocessing
+
+from lcgqueue import WorkQueue, runWorker
+from lcgthrottle import Throttle
+
+
+def worker(directory, throttledir):
+  runWorker(WorkQueue(directory, poll=0.05), throttle=Throttle(throttledir, extractions=2))
+
+
+def test_claim_and_requeue(tmpdir):
+  queue = WorkQueue(str(tmpdir), poll=0.05)
+  queue.put('a', {'url': 'http://localhost/a.tgz', 'transform': None})
+  queue.put('b', {'url': 'http://localhost/b.tgz', 'transform': None})
+  key, task, claim = queue.claim()
+  assert (key, task['url']) == ('a', 'http://localhost/a.tgz')
+  assert queue.claim('a') is None
+  # the claim of a worker that died is not touched anymore
+  os.utime(claim, (time.time() - 2 * WorkQueue.TIMEOUT,) * 2)
+  queue.requeueStale()
+  assert os.listdir(queue.path('claimed')) == []
+  assert sorted(os.listdir(queue.path('todo'))) == ['a', 'b']
+
+  queue.failed('b', 'broken')
+  assert queue.result('b') == ('failed', 'broken')
+  assert queue.result('a') == (None, None)
+  queue.close()
+  assert queue.isClosed()
+  queue.reopen()
+  assert not queue.isClosed()
+
+
+def test_workers(release, tmpdir):
+  url, description = release
+  directory = str(tmpdir.join('queue'))
+  queue = WorkQueue(directory, poll=0.05)
+  tarballs = sorted([name for name in os.listdir(str(tmpdir.join('release'))) if name.endswith('.tgz')])
+  keys = [name[:-len('.tgz')] for name in tarballs]
+  for key, name in zip(keys, tarballs):
+    queue.put(key, {'url': '{0}/{1}'.format(url, name), 'transform': None})
+  # taken by a worker killed before it could finish
+  key, task, claim = queue.claim(keys[0])
+  os.utime(claim, (time.time() - 2 * WorkQueue.TIMEOUT,) * 2)
+
+  workers = [multiprocessing.Process(target=worker, args=(directory, str(tmpdir.join('throttle'))))
+             for i in range(3)]
+  for process in workers:
+    process.start()
+  try:
+    deadline = time.time() + 60
+    while not all([queue.result(key)[0] for key in keys]) and time.time() < deadline:
+      time.sleep(0.05)
+  finally:
+    queue.close()
+    for process in workers:
+      process.join(10)
+  assert [process.exitcode for process in workers] == [0, 0, 0]
+  assert [queue.result(key)[0] for key in keys] == ['done'] * len(keys)
+  for key in keys:
+    assert os.path.isdir(queue.path('done', key))
+    assert os.path.getsize(queue.path('done', key + '.files')) > 0
+  assert os.listdir(queue.path('claimed')) == []
+  assert os.listdir(queue.path('staging')) == []
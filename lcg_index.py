@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+# Index the packages of LCG releases in an SQLite database, to answer
+# questions like "which LCG releases ship ROOT 6.14 for centos7-gcc8" or
+# "which hash of Geant4 is in LCG_96b" without going through the LCG_*.txt
+# files again, and to write packages.yaml entries straight from the index.
+#
+# Usage:
+#     lcg_index.py update "/cvmfs/sft.cern.ch/lcg/releases/LCG_9*" /cvmfs/sft.cern.ch/lcg/nightlies/dev3/Mon
+#     lcg_index.py query --name root --version 6.14 --platform centos7-gcc8 --releases
+#     lcg_index.py query --name geant4 --release LCG_96b
+#     lcg_index.py packages --release LCG_96b --platform x86_64-centos7-gcc8-opt -o LCG_96b_packages.yaml
+#
+# Each argument of update is a release directory, or a pattern of release
+# directories. Only the LCG files added or modified since the last update
+# are read again. Releases are named after their directory, nightlies after
+# their last two directories (dev3/Mon).
+
+import os
+import sys
+import glob
+import time
+import sqlite3
+import argparse
+
+import yamlio
+import create_lcg_package_specs as lcg
+
+WEEKDAYS = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS releases (name TEXT PRIMARY KEY, directory TEXT, updated REAL);
+CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, release TEXT, position INTEGER, type TEXT,
+    arch TEXT, os TEXT, compiler TEXT, build_type TEXT, lcg_compiler TEXT, size INTEGER, mtime REAL);
+CREATE TABLE IF NOT EXISTS packages (file TEXT, release TEXT, platform TEXT, line INTEGER, name TEXT,
+    spack_name TEXT, version TEXT, spack_version TEXT, hash TEXT, path TEXT);
+CREATE INDEX IF NOT EXISTS packages_name ON packages (spack_name, spack_version);
+CREATE INDEX IF NOT EXISTS packages_release ON packages (release, platform);
+CREATE INDEX IF NOT EXISTS packages_hash ON packages (hash);
+CREATE INDEX IF NOT EXISTS packages_file ON packages (file);
+CREATE INDEX IF NOT EXISTS files_release ON files (release);
+"""
+
+
+def open_index(filename):
+    db = sqlite3.connect(filename)
+    db.executescript(SCHEMA)
+    return db
+
+
+def release_name(directory):
+    directory = os.path.normpath(directory)
+    name = os.path.basename(directory)
+    if name in WEEKDAYS:
+        return os.path.basename(os.path.dirname(directory)) + "/" + name
+    return name
+
+
+def read_lcg_file(spec):
+    """Return the compiler (name@version) of an LCG file, its packages
+    as (line, name, hash, version, path) and the warnings about skipped lines"""
+    qualifiers, rows, messages = lcg.read_lcg_spec_file(spec["fname"])
+    return qualifiers.get("COMPILER"), rows, messages
+
+
+def update_release(db, directory, jobs=1):
+    """Index the LCG files of directory that changed since the last update,
+    returning how many were read"""
+    release = release_name(directory)
+    row = db.execute("SELECT directory FROM releases WHERE name=?", (release,)).fetchone()
+    if row is not None and row[0] != os.path.abspath(directory):
+        print("%s was indexed from %s, replaced by %s" % (release, row[0], os.path.abspath(directory)))
+        forget_release(db, release)
+    spec_files, contrib_files = lcg.discover_lcg_spec_files(directory)
+    known = dict((row[0], (row[1], row[2])) for row in
+                 db.execute("SELECT path, size, mtime FROM files WHERE release=?", (release,)))
+    changed = []
+    for position, spec in enumerate(spec_files):
+        st = os.stat(spec["fname"])
+        spec["position"] = position
+        spec["size"], spec["mtime"] = st.st_size, st.st_mtime
+        if known.pop(spec["fname"], None) != (st.st_size, st.st_mtime):
+            changed.append(spec)
+        else:
+            # discovery order decides which file wins, keep it up to date
+            db.execute("UPDATE files SET position=? WHERE path=?", (position, spec["fname"]))
+
+    for path in known:
+        db.execute("DELETE FROM packages WHERE file=?", (path,))
+        db.execute("DELETE FROM files WHERE path=?", (path,))
+
+    basepath = lcg.get_basepath(directory)
+    for spec, (compiler, rows, messages) in zip(changed, lcg.parse_files(read_lcg_file, changed, jobs)):
+        for message in messages:
+            print(message)
+        platform = lcg.get_platform(spec)
+        db.execute("DELETE FROM packages WHERE file=?", (spec["fname"],))
+        db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                   (spec["fname"], release, spec["position"], spec["type"], spec["arch"], spec["os"],
+                    spec["compiler"], spec["build_type"], compiler, spec["size"], spec["mtime"]))
+        db.executemany("INSERT INTO packages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                       [(spec["fname"], release, platform, line, name, lcg.spack_package_name(name), version,
+                         lcg.spack_package_version(lcg.spack_package_name(name), version), sha,
+                         os.path.abspath(os.path.join(basepath, path)))
+                        for line, name, sha, version, path in rows])
+    db.execute("INSERT OR REPLACE INTO releases VALUES (?, ?, ?)", (release, os.path.abspath(directory), time.time()))
+    db.commit()
+    return len(changed)
+
+
+def forget_release(db, release):
+    for table, column in (("packages", "release"), ("files", "release"), ("releases", "name")):
+        db.execute("DELETE FROM %s WHERE %s=?" % (table, column), (release,))
+
+
+def prune_releases(db):
+    """Forget the releases whose directory is gone"""
+    gone = [row[0] for row in db.execute("SELECT name, directory FROM releases") if not os.path.isdir(row[1])]
+    for release in gone:
+        forget_release(db, release)
+    db.commit()
+    return gone
+
+
+def query_packages(db, name=None, version=None, release=None, platform=None, sha=None):
+    """Return (release, platform, name, version, hash, path) of the packages matching all the
+    given criteria: name (LCG or spack, * for any characters), version prefix (LCG or spack),
+    release (* for any characters), platform part and hash prefix"""
+    conditions, values = [], []
+    if name is not None:
+        pattern = name.lower().replace("*", "%")
+        conditions.append("(lower(name) LIKE ? OR spack_name LIKE ?)")
+        values += [pattern, pattern]
+    if version is not None:
+        conditions.append("(version LIKE ? OR spack_version LIKE ?)")
+        values += [version + "%", version + "%"]
+    if release is not None:
+        conditions.append("release LIKE ?")
+        values.append(release.replace("*", "%"))
+    if platform is not None:
+        conditions.append("platform LIKE ?")
+        values.append("%" + platform + "%")
+    if sha is not None:
+        conditions.append("hash LIKE ?")
+        values.append(sha + "%")
+    sql = "SELECT release, platform, name, version, hash, path FROM packages"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    return db.execute(sql + " ORDER BY release, platform, spack_name, spack_version", values).fetchall()
+
+
+def packages_from_index(db, release, platforms=None, excluded=None):
+    """Return the packages dict create_lcg_package_specs.py makes from the LCG files of
+    release (all its platforms by default) without reading them"""
+    if excluded is None:
+        excluded = lcg.blacklist
+    files = db.execute("SELECT path, arch, os, compiler, build_type, lcg_compiler FROM files "
+                       "WHERE release=? ORDER BY position", (release,)).fetchall()
+    packages_dict = {"packages": {}}
+    for path, arch, os_name, compiler, build_type, lcg_compiler in files:
+        spec = {"arch": arch, "os": os_name, "compiler": compiler, "build_type": build_type}
+        if platforms and lcg.get_platform(spec) not in platforms:
+            continue
+        rows = db.execute("SELECT spack_name, spack_version, path FROM packages WHERE file=? ORDER BY line",
+                          (path,))
+        selected = []
+        for pkg, version, pkg_path in lcg.select_highest_versions(rows, excluded):
+            selected.append((str(pkg), str(lcg.spack_spec_string(pkg, version, lcg_compiler, spec)),
+                             str(pkg_path)))
+        lcg.merge_lcg_packages(packages_dict, selected)
+    return packages_dict
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Index of the packages of LCG releases")
+    parser.add_argument("--index", default="lcg_index.sqlite", help="SQLite database file")
+    commands = parser.add_subparsers(dest="command")
+
+    update = commands.add_parser("update", help="Index releases, reading only new or modified files")
+    update.add_argument("releases", nargs="*", help="Release directories, or patterns of release directories")
+    update.add_argument("--prune", action="store_true", help="Forget the releases whose directory is gone")
+    update.add_argument("-j", "--jobs", type=int, default=1, help="Number of files read in parallel (processes)")
+
+    query = commands.add_parser("query", help="List the packages matching all the given criteria")
+    query.add_argument("--name", help="LCG or spack name, * matches any characters")
+    query.add_argument("--version", help="Version prefix (6.14 matches v6-14-04 for ROOT)")
+    query.add_argument("--release", help="Release, * matches any characters")
+    query.add_argument("--platform", help="Part of the platform (centos7-gcc8)")
+    query.add_argument("--hash", dest="sha", help="Hash prefix")
+    query.add_argument("--releases", action="store_true", help="Only list the releases")
+
+    packages = commands.add_parser("packages", help="Write the packages.yaml entries of a release")
+    packages.add_argument("--release", required=True)
+    packages.add_argument("--platform", nargs="*", help="Platforms to include, all by default")
+    packages.add_argument("--blacklist", default=None, help="Blacklist packages defined in a given YAML file")
+    packages.add_argument("-o", "--output", default=None, help="Output file, standard output by default")
+
+    args = parser.parse_args()
+    db = open_index(args.index)
+
+    if args.command == "update":
+        for pattern in args.releases:
+            directories = [d for d in sorted(glob.glob(pattern)) if os.path.isdir(d)]
+            if not directories:
+                print("No release directory matches %s" % pattern)
+            for directory in directories:
+                start = time.time()
+                count = update_release(db, directory, args.jobs)
+                print("%-20s %4d files read in %.1fs" % (release_name(directory), count, time.time() - start))
+        if args.prune:
+            for release in prune_releases(db):
+                print("%-20s removed" % release)
+
+    elif args.command == "query":
+        rows = query_packages(db, args.name, args.version, args.release, args.platform, args.sha)
+        if args.releases:
+            for release in sorted(set(row[0] for row in rows)):
+                print(release)
+        else:
+            for row in rows:
+                print("%-14s %-26s %-20s %-14s %-8s %s" % row)
+        if not rows:
+            sys.exit(1)
+
+    elif args.command == "packages":
+        if args.blacklist:
+            lcg.update_blacklist(filename=args.blacklist)
+        packages_dict = packages_from_index(db, args.release, args.platform)
+        if args.output:
+            yamlio.dump_file(packages_dict, args.output)
+        else:
+            yamlio.dump(packages_dict, sys.stdout)
+
+
+if __name__ == "__main__":
+    main()
@@ -11,7 +11,7 @@
 # This script overwrites the target file with the merged content.
 
 import argparse
-import yaml
+import yamlio
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Merge two packages.yaml files")
@@ -22,10 +22,10 @@ if __name__ == "__main__":
     args = parser.parse_args()
     
     with open(args.source, 'r') as f:
-        source_dict = yaml.load(f.read())
+        source_dict = yamlio.load(f)
 
     with open(args.target, 'r') as f:
-        target_dict = yaml.load(f.read())
+        target_dict = yamlio.load(f)
 
     for pkg in source_dict['packages'].keys():
         if pkg in target_dict['packages']:
@@ -33,7 +33,7 @@ if __name__ == "__main__":
 
     try:
         with open(args.target, 'w') as f:
-            f.write(yaml.dump(target_dict))
+            yamlio.dump(target_dict, f)
             print("Content of %s successfully updated" % args.target)
 	    print("The following packages were updated:")
             for pkg in sorted(source_dict['packages'].keys()):
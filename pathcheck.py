@@ -0,0 +1,146 @@
+"""Check that the prefixes of generated external specs exist."""
+
+import os
+import time
+import errno
+import threading
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# threads listing directories, mostly waiting for the file system
+POOLSIZE = 16
+
+CHECK_MODES = ("no", "warn", "drop")
+# what the scripts and create_packages.sh do unless told otherwise
+DEFAULT_MODE = "warn"
+
+
+class PathCache(object):
+    """Listings and directory checks shared between threads and calls"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.listings = {}
+        self.dirs = {}
+        self.lookups = 0
+
+    def listing(self, directory):
+        """Return {name: True for a directory, False for a file, None when unknown
+        (symbolic links)} for directory, None if it cannot be listed"""
+        with self.lock:
+            if directory in self.listings:
+                return self.listings[directory]
+        try:
+            if scandir is not None:
+                names = dict((entry.name, None if entry.is_symlink() else entry.is_dir(follow_symlinks=False))
+                             for entry in scandir(directory))
+            else:
+                names = dict((name, None) for name in os.listdir(directory))
+        except OSError as e:
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                raise
+            names = None
+        with self.lock:
+            self.listings[directory] = names
+            self.lookups += 1
+        return names
+
+    def isdir(self, path):
+        with self.lock:
+            if path in self.dirs:
+                return self.dirs[path]
+        result = os.path.isdir(path)
+        with self.lock:
+            self.dirs[path] = result
+            self.lookups += 1
+        return result
+
+    def exists(self, path, listed=True):
+        """Whether path is a directory, listing its parent first when listed"""
+        path = os.path.normpath(path)
+        if not listed:
+            return self.isdir(path)
+        names = self.listing(os.path.dirname(path))
+        if names is None:
+            return False
+        isdir = names.get(os.path.basename(path), False)
+        return isdir if isdir is not None else self.isdir(path)
+
+
+class CheckResult(object):
+    def __init__(self):
+        self.checked = 0
+        self.directories = 0
+        self.seconds = 0.
+        # [(package, spec, prefix)]
+        self.missing = []
+        # packages left without any prefix, removed when dropping
+        self.removed = []
+
+    def summary(self):
+        return "%d prefixes in %d directories checked in %.2fs, %d missing" % (self.checked, self.directories,
+                                                                                self.seconds, len(self.missing))
+
+
+def check_prefixes(prefixes, cache=None, jobs=POOLSIZE):
+    """Return the set of the prefixes that are not directories, and the number of parent directories"""
+    if cache is None:
+        cache = PathCache()
+    groups = {}
+    for prefix in set(prefixes):
+        groups.setdefault(os.path.dirname(os.path.normpath(prefix)), []).append(prefix)
+
+    def check_group(group):
+        return [prefix for prefix in group if not cache.exists(prefix, len(group) > 1)]
+
+    missing = set()
+    if groups:
+        pool = ThreadPool(max(1, min(jobs, len(groups))))
+        try:
+            for found in pool.map(check_group, list(groups.values())):
+                missing.update(found)
+        finally:
+            pool.close()
+            pool.join()
+    return missing, len(groups)
+
+
+def check_packages(packages_dict, mode="warn", cache=None, jobs=POOLSIZE):
+    """Check the prefixes of the "paths" of packages_dict ({"packages": {...}}); with mode
+    "drop", the missing ones are removed, and the packages left without any"""
+    result = CheckResult()
+    if mode == "no":
+        return result
+    start = time.time()
+    packages = packages_dict["packages"]
+    entries = [(pkg, spec, prefix) for pkg in sorted(packages)
+               for spec, prefix in sorted(packages[pkg].get("paths", {}).items())]
+    missing, result.directories = check_prefixes([prefix for pkg, spec, prefix in entries], cache, jobs)
+    result.checked = len(entries)
+    result.missing = [entry for entry in entries if entry[2] in missing]
+    if mode == "drop":
+        for pkg, spec, prefix in result.missing:
+            del packages[pkg]["paths"][spec]
+            if not packages[pkg]["paths"]:
+                del packages[pkg]
+                result.removed.append(pkg)
+    result.seconds = time.time() - start
+    return result
+
+
+def print_check(result, mode):
+    if mode == "no":
+        return
+    print("Checking prefixes: %s" % result.summary())
+    action = "removed" if mode == "drop" else "missing"
+    for pkg, spec, prefix in result.missing:
+        print("  %s %s: %s" % (action, spec, prefix))
+    if result.removed:
+        print("  packages left without prefix, removed: %s" % ", ".join(result.removed))
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+# Compare the load and dump times of the pure Python PyYAML implementation
+# with the ones of yamlio, used by the configuration scripts, and check that
+# both write the same files.
+#
+# Usage:
+#     python scripts/benchmark-yaml.py [-n REPEAT] [FILE ...]
+#
+# Without files, the largest config/packages-*.yaml are used. Generated files
+# such as $WORKSPACE/packages.yaml or <LCG_VERSION>_packages.yaml are more
+# representative, pass them as arguments.
+#
+# Output:
+#
+#     yamlio uses libyaml: True
+#     file                                     size   py load    c load   py dump    c dump
+#     LCG_96_packages.yaml                   256389   497.5ms    37.2ms   345.1ms    57.8ms
+
+import os
+import sys
+import glob
+import time
+import argparse
+
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import yamlio
+
+
+def best_of(repeat, function, *args):
+    """Return the result of function and the shortest of repeat runs in seconds"""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = function(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return result, best
+
+
+def python_load(text):
+    return yaml.load(text, Loader=yaml.SafeLoader)
+
+
+def python_dump(data):
+    return yaml.dump(data, Dumper=yaml.SafeDumper)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark YAML loading and dumping")
+    parser.add_argument("files", nargs="*", help="YAML files to load and dump")
+    parser.add_argument("-n", "--repeat", type=int, default=5, help="Runs per measurement, the best is kept")
+    parser.add_argument("--largest", type=int, default=3, help="Number of config/packages-*.yaml used without files")
+    args = parser.parse_args()
+
+    files = args.files
+    if not files:
+        config = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "config")
+        files = sorted(glob.glob(os.path.join(config, "packages-*.yaml")), key=os.path.getsize, reverse=True)
+        files = files[:args.largest]
+
+    print("yamlio uses libyaml: %s" % yamlio.LIBYAML)
+    print("%-36s %8s %9s %9s %9s %9s" % ("file", "size", "py load", "c load", "py dump", "c dump"))
+    different = []
+    for filename in files:
+        with open(filename, 'r') as f:
+            text = f.read()
+        data, py_load = best_of(args.repeat, python_load, text)
+        c_data, c_load = best_of(args.repeat, yamlio.load, text)
+        py_text, py_dump = best_of(args.repeat, python_dump, data)
+        c_text, c_dump = best_of(args.repeat, yamlio.dump, data)
+        if c_data != data or c_text != py_text:
+            different.append(filename)
+        print("%-36s %8d %7.1fms %7.1fms %7.1fms %7.1fms" % (os.path.basename(filename), len(text),
+              py_load * 1000, c_load * 1000, py_dump * 1000, c_dump * 1000))
+
+    for filename in different:
+        print("WARNING: %s is not loaded or dumped the same way by both" % filename)
+    sys.exit(1 if different else 0)
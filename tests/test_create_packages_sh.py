@@ -0,0 +1,40 @@
+import os
+import stat
+import subprocess
+
+THIS = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(THIS, os.pardir, "create_packages.sh")
+
+# stands for the python of create_packages.sh: records its arguments, writes lcg_compiler.txt
+FAKE_PYTHON = """#!/bin/bash
+echo "$@" > python-args.txt
+echo 8.2.0 > lcg_compiler.txt
+"""
+
+
+def source(tmpdir, **env):
+    bindir = tmpdir.mkdir("bin")
+    python = bindir.join("python")
+    python.write(FAKE_PYTHON)
+    python.chmod(python.stat().mode | stat.S_IXUSR)
+    environment = dict(os.environ, PATH="%s:%s" % (bindir, os.environ["PATH"]), LCG_VERSION="LCG_96b",
+                       FCC_VERSION="96b.0.0", PLATFORM="x86_64-centos7-gcc8-opt", WORKSPACE=str(tmpdir),
+                       weekday="Mon")
+    environment.pop("LCG_SPEC_CACHE", None)
+    environment.update(env)
+    # what jk-setup-spack.sh uses after sourcing the script
+    command = 'source %s > /dev/null 2>&1; echo "$OS $COMPILER ${!compilerversion} $COMPILER_TWO_DIGITS"' % SCRIPT
+    output = subprocess.check_output(["bash", "-c", command], cwd=str(tmpdir), env=environment)
+    return output.decode().split(), tmpdir.join("python-args.txt").read().split()
+
+
+def test_platform_variables(tmpdir):
+    variables, args = source(tmpdir, COMPILER="gcc62")
+    assert variables == ["centos7", "gcc8", "8.2.0", "82"]
+
+
+def test_cache_is_opt_in(tmpdir):
+    variables, args = source(tmpdir.mkdir("default"))
+    assert "--cache" not in args
+    variables, args = source(tmpdir.mkdir("cache"), LCG_SPEC_CACHE="/tmp/lcg-specs")
+    assert args[args.index("--cache") + 1] == "/tmp/lcg-specs"
@@ -0,0 +1,82 @@
+import os
+
+import yamlio
+import lcg_index
+import create_lcg_package_specs as lcg
+
+HEADER = "PLATFORM: x86_64-centos7-gcc8-{0}\nVERSION: 96\nCOMPILER: GNU;8.3.0\n"
+LINES = [
+    "ROOT; aaaaa; v6-16-00; ./ROOT/v6-16-00-aaaaa/x86_64-centos7-gcc8-{0}",
+    "ROOT; bbbbb; v6-18-00; ./ROOT/v6-18-00-bbbbb/x86_64-centos7-gcc8-{0}",
+    "CMake; ccccc; 3.14.2; ./CMake/3.14.2-ccccc/x86_64-centos7-gcc8-{0}",
+    "CMake; ddddd; 3.14.2; ./CMake/3.14.2-ddddd/x86_64-centos7-gcc8-{0}",
+    "PyYAML; eeeee; 5.1; ./pyyaml/5.1-eeeee/x86_64-centos7-gcc8-{0}",
+    "blas; fffff; 0.3.5; ./blas/0.3.5-fffff/x86_64-centos7-gcc8-{0}",
+    "pytest; 11111; 4.4.0; ./pytest/4.4.0-11111/x86_64-centos7-gcc8-{0}",
+]
+
+
+def write_release(directory, lines=LINES):
+    os.makedirs(directory)
+    for build_type in ("opt", "dbg"):
+        with open(os.path.join(directory, "LCG_externals_x86_64-centos7-gcc8-%s.txt" % build_type), "w") as f:
+            f.write(HEADER.format(build_type))
+            for line in lines:
+                f.write(line.format(build_type) + "\n")
+    return directory
+
+
+def test_read_lcg_spec_file(tmpdir):
+    release = write_release(str(tmpdir.join("LCG_96")))
+    qualifiers, rows, messages = lcg.read_lcg_spec_file(os.path.join(release, "LCG_externals_x86_64-centos7-gcc8-opt.txt"))
+    assert qualifiers["COMPILER"] == "GNU@8.3.0"
+    assert qualifiers["VERSION"] == "96"
+    assert rows[0] == (3, "ROOT", "aaaaa", "v6-16-00", "./ROOT/v6-16-00-aaaaa/x86_64-centos7-gcc8-opt")
+    assert len(rows) == len(LINES)
+    assert messages == []
+
+
+def test_read_lcg_spec_file_warns_on_malformed_lines(tmpdir):
+    fname = tmpdir.join("LCG_externals_x86_64-centos7-gcc8-opt.txt")
+    fname.write("COMPILER: GNU;8.3.0\nROOT; aaaaa; v6-16-00\n\nfmt; bbbbb; 5.3.0; ./fmt/5.3.0-bbbbb\n")
+    qualifiers, rows, messages = lcg.read_lcg_spec_file(str(fname))
+    assert [row[1] for row in rows] == ["fmt"]
+    assert len(messages) == 1 and "ROOT; aaaaa; v6-16-00" in messages[0]
+
+
+def test_select_highest_versions():
+    packages = [("root", "6.16.00", "/a"), ("root", "6.18.00", "/b"), ("cmake", "3.14.2", "/c"),
+                ("cmake", "3.14.2", "/d"), ("blas", "0.3.5", "/e"), ("py-pyyaml", "5.1", "/f")]
+    highest = lcg.select_highest_versions(packages, excluded=["py-pyyaml"])
+    assert sorted(highest) == [("cmake", "3.14.2", "/d"), ("root", "6.18.00", "/b")]
+
+
+def test_packages_from_index_match_lcg_files(tmpdir):
+    release = write_release(str(tmpdir.join("LCG_96")))
+    db = lcg_index.open_index(str(tmpdir.join("index.sqlite")))
+    assert lcg_index.update_release(db, release) == 2
+    spec_files, contrib_files = lcg.discover_lcg_spec_files(release)
+    from_files = lcg.create_packages_dict(spec_files, lcg.get_basepath(release))
+    from_index = lcg_index.packages_from_index(db, "LCG_96")
+    assert yamlio.dump(from_index) == yamlio.dump(from_files)
+    assert sorted(from_index["packages"]) == ["cmake", "py-pytest", "root"]
+    assert sorted(from_index["packages"]["cmake"]["paths"].values()) == [
+        os.path.join(release, "CMake/3.14.2-ddddd/x86_64-centos7-gcc8-%s" % build_type) for build_type in ("dbg", "opt")]
+
+
+def test_incremental_update(tmpdir):
+    release = write_release(str(tmpdir.join("LCG_96")))
+    db = lcg_index.open_index(str(tmpdir.join("index.sqlite")))
+    assert lcg_index.update_release(db, release) == 2
+    assert lcg_index.update_release(db, release) == 0
+
+    opt = os.path.join(release, "LCG_externals_x86_64-centos7-gcc8-opt.txt")
+    with open(opt, "a") as f:
+        f.write("Geant4; 22222; 10.5.1; ./Geant4/10.5.1-22222/x86_64-centos7-gcc8-opt\n")
+    assert lcg_index.update_release(db, release) == 1
+    assert [row[1] for row in lcg_index.query_packages(db, name="geant4")] == ["x86_64-centos7-gcc8-opt"]
+
+    os.unlink(opt)
+    assert lcg_index.update_release(db, release) == 0
+    assert lcg_index.query_packages(db, name="geant4") == []
+    assert set(row[1] for row in lcg_index.query_packages(db, release="LCG_96")) == set(["x86_64-centos7-gcc8-dbg"])
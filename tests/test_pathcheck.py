@@ -0,0 +1,58 @@
+import os
+
+import pathcheck
+
+
+def make_packages(tmpdir):
+    base = str(tmpdir)
+    os.makedirs(os.path.join(base, "root", "6.18.00-aaaaa", "x86_64-centos7-gcc8-opt"))
+    os.makedirs(os.path.join(base, "cmake", "3.14.2", "x86_64-centos7-gcc8-opt"))
+    os.makedirs(os.path.join(base, "real"))
+    os.symlink(os.path.join(base, "real"), os.path.join(base, "cmake", "3.14.2", "x86_64-centos7-gcc8-dbg"))
+    open(os.path.join(base, "cmake", "3.14.2", "x86_64-slc6-gcc8-opt"), "w").close()
+    return {"packages": {
+        "root": {"buildable": False, "paths": {
+            "root@6.18.00 arch=x86_64-centos7": os.path.join(base, "root", "6.18.00-aaaaa", "x86_64-centos7-gcc8-opt")}},
+        "geant4": {"buildable": False, "paths": {
+            "geant4@10.5.1 arch=x86_64-centos7": os.path.join(base, "geant4", "10.5.1-bbbbb", "x86_64-centos7-gcc8-opt")}},
+        "cmake": {"buildable": False, "paths": {
+            "cmake@3.14.2 arch=x86_64-centos7": os.path.join(base, "cmake", "3.14.2", "x86_64-centos7-gcc8-opt"),
+            "cmake@3.14.2+debug arch=x86_64-centos7": os.path.join(base, "cmake", "3.14.2", "x86_64-centos7-gcc8-dbg"),
+            "cmake@3.14.2 arch=x86_64-slc6": os.path.join(base, "cmake", "3.14.2", "x86_64-slc6-gcc8-opt"),
+            "cmake@3.14.2+debug arch=x86_64-slc6": os.path.join(base, "cmake", "3.14.2", "x86_64-slc6-gcc8-dbg")}},
+    }}
+
+
+def test_warn_keeps_packages(tmpdir):
+    packages = make_packages(tmpdir)
+    result = pathcheck.check_packages(packages, "warn")
+    assert result.checked == 6
+    assert result.directories == 3
+    assert sorted(spec for pkg, spec, prefix in result.missing) == [
+        "cmake@3.14.2 arch=x86_64-slc6", "cmake@3.14.2+debug arch=x86_64-slc6", "geant4@10.5.1 arch=x86_64-centos7"]
+    assert len(packages["packages"]["cmake"]["paths"]) == 4
+    assert "geant4" in packages["packages"]
+
+
+def test_drop_removes_missing_prefixes(tmpdir):
+    packages = make_packages(tmpdir)
+    result = pathcheck.check_packages(packages, "drop")
+    assert result.removed == ["geant4"]
+    assert sorted(packages["packages"]) == ["cmake", "root"]
+    assert sorted(packages["packages"]["cmake"]["paths"]) == [
+        "cmake@3.14.2 arch=x86_64-centos7", "cmake@3.14.2+debug arch=x86_64-centos7"]
+
+
+def test_single_prefix_is_not_listed(tmpdir):
+    packages = make_packages(tmpdir)
+    cache = pathcheck.PathCache()
+    pathcheck.check_packages(packages, "warn", cache)
+    # root and geant4 alone in their directory, cmake listed once
+    assert list(cache.listings) == [os.path.join(str(tmpdir), "cmake", "3.14.2")]
+
+
+def test_no_check(tmpdir):
+    packages = make_packages(tmpdir)
+    result = pathcheck.check_packages(packages, "no")
+    assert result.checked == 0
+    assert "geant4" in packages["packages"]
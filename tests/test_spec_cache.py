@@ -0,0 +1,30 @@
+import os
+import errno
+
+import create_lcg_package_specs as lcg
+from test_lcg_index import write_release
+
+
+def test_cache(tmpdir):
+    release = write_release(str(tmpdir.join("LCG_96")))
+    spec_files, contrib_files = lcg.discover_lcg_spec_files(release)
+    cache = lcg.SpecCache(str(tmpdir.join("cache")))
+    first = lcg.create_packages_dict(spec_files, release, cache=cache)
+    assert (cache.hits, cache.misses) == (0, 2)
+    assert lcg.create_packages_dict(spec_files, release, cache=cache) == first
+    assert (cache.hits, cache.misses) == (2, 2)
+
+    with open(spec_files[0]["fname"], "a") as f:
+        f.write("Geant4; 22222; 10.5.1; ./Geant4/10.5.1-22222/x86_64-centos7-gcc8-opt\n")
+    assert "geant4" in lcg.create_packages_dict(spec_files, release, cache=cache)["packages"]
+    assert (cache.hits, cache.misses) == (3, 3)
+
+
+def test_entry_evicted_while_read(tmpdir, monkeypatch):
+    cache = lcg.SpecCache(str(tmpdir))
+    cache.put("key", "result")
+
+    def utime(path, times):
+        raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+    monkeypatch.setattr(os, "utime", utime)
+    assert cache.get("key") == "result"
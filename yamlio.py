@@ -0,0 +1,34 @@
+"""YAML input/output shared by the configuration scripts, with libyaml when available."""
+
+import yaml
+
+try:
+    from yaml import CSafeLoader as Loader, CSafeDumper as Dumper
+    LIBYAML = True
+except ImportError:
+    from yaml import SafeLoader as Loader, SafeDumper as Dumper
+    LIBYAML = False
+
+
+def load(stream):
+    """Load one YAML document from a string or a file object"""
+    return yaml.load(stream, Loader=Loader)
+
+
+def load_file(filename):
+    with open(filename, 'r') as fobj:
+        return load(fobj)
+
+
+def dump_all(documents, stream=None, **kwargs):
+    """Write documents to stream, or return them as a string if there is none"""
+    return yaml.dump_all(documents, stream, Dumper=Dumper, **kwargs)
+
+
+def dump(data, stream=None, **kwargs):
+    return dump_all([data], stream, **kwargs)
+
+
+def dump_file(data, filename, **kwargs):
+    with open(filename, 'w') as fobj:
+        dump(data, fobj, **kwargs)